@@ -1,38 +1,96 @@
 from flask import Flask, request, render_template_string, jsonify, redirect, flash, url_for
 from datetime import datetime
-import json, os, requests
+import json, os, requests, time
+import bms_metrics as metrics
+import bms_profiling
+import bms_alarms
+import bms_derived
+import bms_records
+import bms_dedup
+import bms_delta
+import bms_warmstart
+import bms_config
+import bms_query
+import bms_downsample
+import bms_ratelimit
+import bms_capture
+import bms_latency
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
+metrics.instrument_app(app)
+bms_profiling.install_profiler(app)
+bms_capture.install(app)      # BMS_CAPTURE=<file>: raw ingest bodies for replay_traffic.py
+alarm_engine = bms_alarms.AlarmEngine()
+derived = bms_derived.DerivedMetrics('BMS_SERVER2')
+dedup = bms_dedup.DedupCache()
 
-# ─── in-memory store of ALL packets you ever got ────────────────
-received_data = []             # <--- UNCHANGED
+# ─── in-memory store of ALL slave records you ever got ─────────
+received_data = bms_delta.new_history()             # SlaveRecord per slave per packet
+metrics.register_store(lambda: received_data)
 
-ESP32_IP   = "169.254.185.250"  # send config / FW here
-ESP32_PORT = 80
+# ─── Journal of accepted records; its tail refills the store on restart ─
+journal = bms_warmstart.Journal('BMS_SERVER2')
+_restored, _ = bms_warmstart.restore_records(journal, bms_delta.HISTORY_MAX)
+received_data.extend(_restored)
+bms_warmstart.replay_rollups(_restored, alarm_engine, derived)
+del _restored
+
+ESP32_IP   = os.environ.get("ESP32_IP", "169.254.185.250")  # send config / FW here
+ESP32_PORT = int(os.environ.get("ESP32_PORT", 80))
+ESP32_KEY  = f"{ESP32_IP}:{ESP32_PORT}"
+config_store = bms_config.ConfigStore('esp32_config.json')
 
 # ────────────────────────────────────────────────────────────────
 #  1) ESP32 pushes BMS data  (now may contain "slaves":[…])
 # ────────────────────────────────────────────────────────────────
 @app.route('/update', methods=['POST'])
 def update():
+    device = request.remote_addr
+    limited = bms_ratelimit.http_guard(request, '/update')   # before the body is read
+    if limited:
+        return limited
+    t0 = time.perf_counter()
     data = request.get_json(silent=True)
     if data is None:           # legacy x-www-form-urlencoded body
         raw = request.form.get('data', '')
         if not raw:
+            metrics.PACKETS.inc('/update', device, 'empty')
             return "No data provided", 400
         try:
             data = json.loads(raw)
         except:
+            metrics.PACKETS.inc('/update', device, 'bad_json')
             return "Bad JSON", 400
+    if not isinstance(data, dict):
+        # Records are built from an object; a list or bare value would be ACKed and then dropped
+        metrics.PACKETS.inc('/update', device, 'invalid')
+        return "Expected a JSON object", 400
+    device = bms_records.device_id(data, device)
+    key = bms_dedup.message_key(data, device)
+    if dedup.is_duplicate(key):
+        # A retry of something we already stored: ACK it so the ESP32 moves on
+        metrics.PACKETS.inc('/update', device, 'duplicate')
+        return "ACK", 200, {"Connection":"close"}
+    ts_ns = time.time_ns()          # formatted only when shown
+    try:
+        records = bms_records.normalize(data, device, ts_ns)
+        t1 = time.perf_counter()
+        metrics.DECODE_SECONDS.observe(t1 - t0, '/update')
 
-    entry = {
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "data":      data
-    }
-    received_data.append(entry)
+        journal.write([r.to_dict(text_time=False) for r in records])
+    except Exception:
+        dedup.forget(key)       # not stored: the ESP32's retry must not count as a duplicate
+        raise
+    # Into memory only once journaled, so a failed write leaves nothing for the retry to double
+    received_data.extend(records)
+    metrics.STORE_SECONDS.observe(time.perf_counter() - t1, '/update')
+    metrics.PACKETS.inc('/update', device, 'accepted')
+    bms_latency.committed('/update', device, records)
+    alarm_engine.evaluate(device, records)
+    derived.update(device, records)
 
-    print(f"\n[ BMS DATA RECEIVED at {entry['timestamp']} ]")
+    print(f"\n[ BMS DATA RECEIVED at {bms_records.format_ns(ts_ns)} ]")
     print(json.dumps(data, indent=2))
     return "ACK", 200, {"Connection":"close"}
 
@@ -51,12 +109,55 @@ def receive_config():
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"\n[ CONFIG RECEIVED at {ts} ]")
     print(json.dumps(data, indent=2))
+    # What it runs now: later dashboard pushes of the same values are skipped
+    config_store.record_reported(f"{request.remote_addr}:{ESP32_PORT}", data)
     return "CONFIG-ACK", 200, {"Connection":"close"}
 
 # ─── 2) historical JSON dump  (unchanged) ───────────────────────
 @app.route('/data')
 def get_data():
-    return jsonify(received_data)
+    metrics.DASHBOARD_POLLS.inc()
+    at = request.args.get('at')
+    if at:
+        try:
+            at_ns = bms_records.parse_time(at)
+        except ValueError:
+            return jsonify({"error": f"bad at {at!r}"}), 400
+        return jsonify([r.to_dict() for r in bms_delta.records_at(received_data, at_ns)])
+    body = [r.to_dict() for r in bms_delta.iter_records(received_data)]
+    bms_latency.delivered(request)
+    if request.args.get('trace') == '1':
+        bms_latency.add_trace(body)
+    return jsonify(body)
+
+# ─── 2.1) per-hop latency: sample -> receive -> commit -> poll ──
+@app.route('/api/latency', methods=['GET'])
+def get_latency():
+    body, status = bms_latency.latency_view(request)
+    return jsonify(body), status
+
+# ─── 2.5) active alarms & recent raise/clear events ─────────────
+@app.route('/api/alarms')
+def get_alarms():
+    return jsonify(bms_alarms.alarms_view(alarm_engine, request))
+
+# ─── 2.6) energy / Ah / C-rate / SOC drift per slave ────────────
+@app.route('/api/derived')
+def get_derived():
+    return jsonify(derived.query(request.args.get('device'), request.args.get('slave'),
+                                 request.args.get('day')))
+
+# ─── 2.7) aggregation queries (?metric=&agg=&bucket=&last=) ─────
+@app.route('/api/query')
+def query():
+    body, status = bms_query.query_view(received_data, request)
+    return jsonify(body), status
+
+# ─── 2.8) chart series downsampled to a pixel width (LTTB/minmax) ─
+@app.route('/api/series')
+def series():
+    body, status = bms_downsample.series_view(received_data, request)
+    return jsonify(body), status
 
 # ─── 3) dashboard & config page  (UNCHANGED back-end) ───────────
 @app.route('/', methods=['GET','POST'])
@@ -66,9 +167,12 @@ def index():
           ('localIP','gateway','subnet','serverIP','serverPort',
            'modbusInterval','networkInterval')}
         try:
-            r=requests.post(f"http://{ESP32_IP}:{ESP32_PORT}/config",
-                             json=new_config, timeout=5)
-            flash("✅ Configuration sent" if r.ok
+            changes,r=bms_config.push(config_store, ESP32_KEY, new_config,
+                lambda cfg: metrics.proxy_call('config_post', requests.post,
+                                f"http://{ESP32_IP}:{ESP32_PORT}/config",
+                                json=cfg, timeout=5))
+            flash("✅ ESP32 already runs this configuration" if r is None
+                  else "✅ Configuration sent" if r.ok
                   else f"⚠️ ESP32: {r.status_code} {r.text}")
         except Exception as e:
             flash(f"❌ {e}")
@@ -78,9 +182,11 @@ def index():
                                 'serverPort','modbusInterval',
                                 'networkInterval'),'')
     try:
-        cfg=requests.get(f"http://{ESP32_IP}:{ESP32_PORT}/config",timeout=3)
+        cfg=metrics.proxy_call('config_get', requests.get,
+                               f"http://{ESP32_IP}:{ESP32_PORT}/config",timeout=3)
         if cfg.ok:
             esp_config.update(cfg.json())
+            config_store.record_reported(ESP32_KEY, esp_config)
     except Exception as e:
         print(f"⚠️ Could not fetch ESP32 /config: {e}")
 
@@ -108,7 +214,8 @@ def fw_upload():
     temp=os.path.join('/tmp',file.filename); file.save(temp)
     try:
         with open(temp,'rb') as fd:
-            r=requests.post(f"http://{ESP32_IP}:{ESP32_PORT}/update",
+            r=metrics.proxy_call('firmware', requests.post,
+                            f"http://{ESP32_IP}:{ESP32_PORT}/update",
                             data=fd, headers={"Content-Type":"application/octet-stream"},
                             timeout=60)
         flash(f"ESP32: {r.status_code} {r.text}")
@@ -119,7 +226,7 @@ def fw_upload():
     return redirect(url_for('fw_form'))
 
 
-# ─── HTML template (only JS changed) ────────────────────────────
+# ─── HTML template (JS renders normalized records) ──────────────
 DASHBOARD_HTML = '''
 <!DOCTYPE html><html><head><meta charset="utf-8">
 <title>BMS Monitoring Dashboard</title>
@@ -135,47 +242,24 @@ DASHBOARD_HTML = '''
 async function fetchData(){
   const resp = await fetch('/data'); const arr = await resp.json();
   const box  = document.getElementById('data-container'); box.innerHTML='';
-  arr.slice().reverse().forEach(entry=>{
-    const ts = entry.timestamp;
-    const d  = entry.data;
-
-    /* ── CASE A: new multi-slave payload ───────────────────── */
-    if (d.slaves){
-      d.slaves.forEach(s=>{
-        const div=document.createElement('div'); div.className='card';
-        div.innerHTML=`<div class="timestamp">${ts}</div>
-          <h3>Slave ${s.id}</h3>
-          <div class="grid">
-            <div>Voltage:   ${s.V} V</div>
-            <div>Current:   ${s.I} A</div>
-            <div>Rem Cap:   ${s.RemAh} Ah</div>
-            <div>Temp:      ${s.Temp} °C</div>
-            <div>Warn:      ${s.Warn}</div>
-            <div>Prot:      ${s.Prot}</div>
-          </div>`;
-        box.appendChild(div);
-      });
-    }
-    /* ── CASE B: legacy single-slave packet ─────────────────── */
-    else{
-      const div=document.createElement('div'); div.className='card';
-      div.innerHTML=`<div class="timestamp">${ts}</div>
-        <h3>BMS Status</h3>
-        <div class="grid">
-          <div>Pack Voltage:       ${d.pack_voltage} V</div>
-          <div>Current:            ${d.current} A</div>
-          <div>Remaining Capacity: ${d.capacity_remaining} Ah</div>
-          <div>SOC:                ${d.soc}%</div>
-          <div>SOH:                ${d.soh}%</div>
-          <div>Avg Cell Temp:      ${d.avg_cell_temp} °C</div>
-          <div>Env Temp:           ${d.env_temp} °C</div>
-          <div>Cycles:             ${d.cycles}</div>
-          <div>Max Cell Voltage:   ${d.max_cell_voltage} V</div>
-          <div>Min Cell Voltage:   ${d.min_cell_voltage} V</div>
-          <div>Modbus Error:       ${d.modbusError ? "Yes":"No"}</div>
-        </div>`;
-      box.appendChild(div);
-    }
+  /* every entry is a normalized slave record (bms_records), whatever
+     payload shape the ESP32 sent; absent metrics are simply omitted */
+  const rows=[['pack_voltage','Voltage','V'],['current','Current','A'],
+              ['capacity_remaining','Rem Cap','Ah'],['soc','SOC','%'],
+              ['soh','SOH','%'],['avg_cell_temp','Temp','°C'],
+              ['env_temp','Env Temp','°C'],['cycles','Cycles',''],
+              ['max_cell_voltage','Max Cell','V'],['min_cell_voltage','Min Cell','V'],
+              ['warn','Warn',''],['prot','Prot','']];
+  arr.slice().reverse().forEach(r=>{
+    const div=document.createElement('div'); div.className='card';
+    div.innerHTML=`<div class="timestamp">${r.timestamp}</div>
+      <h3>${r.device} · Slave ${r.slave}</h3>
+      <div class="grid">
+        ${rows.filter(([k])=>k in r).map(([k,label,unit])=>
+          `<div>${label}: ${r[k]} ${unit}</div>`).join('')}
+        ${'modbus_error' in r ? `<div>Modbus Error: ${r.modbus_error ? "Yes":"No"}</div>` : ''}
+      </div>`;
+    box.appendChild(div);
   });
 }
 setInterval(fetchData,1000); window.onload=fetchData;
@@ -1,23 +1,58 @@
 from flask import Flask, request, render_template_string, jsonify, redirect, flash, url_for
-from datetime import datetime
-import json, os, requests
+import json, os, requests, time
+import bms_metrics as metrics
+import bms_profiling
+import bms_alarms
+import bms_derived
+import bms_records
+import bms_dedup
+import bms_warmstart
+import bms_config
+import bms_ratelimit
+import bms_capture
+import bms_latency
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
+metrics.instrument_app(app)
+bms_profiling.install_profiler(app)
+bms_capture.install(app)      # BMS_CAPTURE=<file>: raw ingest bodies for replay_traffic.py
+alarm_engine = bms_alarms.AlarmEngine()
+derived = bms_derived.DerivedMetrics('BMSs-Server')
+dedup = bms_dedup.DedupCache()
 
 # --- In-memory store ---
-# We will only store the MOST RECENT data packet from the ESP32
+# We will only store the records of the MOST RECENT packet from the ESP32
 latest_data_entry = {
-    "timestamp": "Never",
-    "data": {"slaves": []} # Initialize with an empty slaves array
+    "ts_ns": None,         # epoch ns; "Never" until the first packet
+    "records": []          # SlaveRecord per slave (see bms_records)
 }
+metrics.register_store(lambda: latest_data_entry["records"], name='latest_records')
+
+# --- Journal of accepted records ---
+# On restart its tail restores the latest packet and replays alarms/derived
+RESTORE_RECORDS = 20_000
+journal = bms_warmstart.Journal('BMSs-Server')
+_restored, _ = bms_warmstart.restore_records(journal, RESTORE_RECORDS)
+if _restored:
+    _last = _restored[-1]
+    latest_data_entry = {
+        "ts_ns": _last.ts_ns,
+        # one record per slave of the last packet
+        "records": list({r.slave: r for r in _restored
+                         if (r.ts_ns, r.device) == (_last.ts_ns, _last.device)}.values())
+    }
+bms_warmstart.replay_rollups(_restored, alarm_engine, derived)
+del _restored
 
 # --- Configuration ---
 # IMPORTANT: Update this to the IP your ESP32 will actually have.
 # Based on your config, this should be 192.168.100.250
-ESP32_IP   = "192.168.100.250"
-ESP32_PORT = 80      # The port for the configuration web server
-OTA_PORT   = 8080    # The port for the firmware update server
+ESP32_IP   = os.environ.get("ESP32_IP", "192.168.100.250")
+ESP32_PORT = int(os.environ.get("ESP32_PORT", 80))       # The port for the configuration web server
+OTA_PORT   = int(os.environ.get("ESP32_OTA_PORT", 8080))  # The port for the firmware update server
+ESP32_KEY  = f"{ESP32_IP}:{ESP32_PORT}"
+config_store = bms_config.ConfigStore('esp32_config.json')
 
 # ─────────────────────────────────────────────────────────────────────
 # 1) Endpoint for ESP32 to push multi-slave BMS data
@@ -25,23 +60,51 @@ OTA_PORT   = 8080    # The port for the firmware update server
 @app.route('/update', methods=['POST'])
 def update():
     global latest_data_entry
+    device = request.remote_addr
+    limited = bms_ratelimit.http_guard(request, '/update')   # before the body is read
+    if limited:
+        return limited
+    t0 = time.perf_counter()
     raw = request.form.get('data', '')
     if not raw:
+        metrics.PACKETS.inc('/update', device, 'empty')
         return "No data in form", 400
     try:
         data = json.loads(raw)
         # Basic validation to ensure the expected 'slaves' key exists
-        if 'slaves' not in data or not isinstance(data['slaves'], list):
+        if not isinstance(data, dict) or not isinstance(data.get('slaves'), list):
+            metrics.PACKETS.inc('/update', device, 'invalid')
             return "Invalid JSON structure", 400
     except json.JSONDecodeError:
+        metrics.PACKETS.inc('/update', device, 'bad_json')
         return "Bad JSON format", 400
+    device = bms_records.device_id(data, device)
+    key = bms_dedup.message_key(data, device)
+    if dedup.is_duplicate(key):
+        # A retry of something we already stored: ACK it so the ESP32 moves on
+        metrics.PACKETS.inc('/update', device, 'duplicate')
+        return "ACK", 200
+    ts_ns = time.time_ns()          # formatted only when shown
+    try:
+        records = bms_records.normalize(data, device, ts_ns)
+        t1 = time.perf_counter()
+        metrics.DECODE_SECONDS.observe(t1 - t0, '/update')
 
-    # Update the single latest data entry
+        journal.write([r.to_dict(text_time=False) for r in records])
+    except Exception:
+        dedup.forget(key)       # not stored: the ESP32's retry must not count as a duplicate
+        raise
+    # Update the single latest data entry (only once journaled)
     latest_data_entry = {
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "data": data
+        "ts_ns": ts_ns,
+        "records": records
     }
-    print(f"\n[ BMS DATA RECEIVED at {latest_data_entry['timestamp']} ]")
+    metrics.STORE_SECONDS.observe(time.perf_counter() - t1, '/update')
+    metrics.PACKETS.inc('/update', device, 'accepted')
+    bms_latency.committed('/update', device, records)
+    alarm_engine.evaluate(device, records)
+    derived.update(device, records)
+    print(f"\n[ BMS DATA RECEIVED at {bms_records.format_ns(ts_ns)} ]")
     print(json.dumps(data, indent=2))
     return "ACK", 200
 
@@ -50,7 +113,39 @@ def update():
 # ─────────────────────────────────────────────────────────────────────
 @app.route('/data', methods=['GET'])
 def get_data():
-    return jsonify(latest_data_entry)
+    metrics.DASHBOARD_POLLS.inc()
+    records = [r.to_dict() for r in latest_data_entry["records"]]
+    # Only the latest packet is shown: ones it replaced were never delivered
+    bms_latency.delivered(request, newest_only=True)
+    if request.args.get('trace') == '1':
+        bms_latency.add_trace(records)
+    return jsonify({
+        "timestamp": bms_records.format_ns(latest_data_entry["ts_ns"]) or "Never",
+        "records": records
+    })
+
+# ─────────────────────────────────────────────────────────────────────
+# 2.1) Per-hop latency: device sample -> receive -> commit -> /data poll
+# ─────────────────────────────────────────────────────────────────────
+@app.route('/api/latency', methods=['GET'])
+def get_latency():
+    body, status = bms_latency.latency_view(request)
+    return jsonify(body), status
+
+# ─────────────────────────────────────────────────────────────────────
+# 2.5) Active alarms & recent raise/clear events
+# ─────────────────────────────────────────────────────────────────────
+@app.route('/api/alarms', methods=['GET'])
+def get_alarms():
+    return jsonify(bms_alarms.alarms_view(alarm_engine, request))
+
+# ─────────────────────────────────────────────────────────────────────
+# 2.6) Energy / Ah / C-rate / SOC drift per slave
+# ─────────────────────────────────────────────────────────────────────
+@app.route('/api/derived', methods=['GET'])
+def get_derived():
+    return jsonify(derived.query(request.args.get('device'), request.args.get('slave'),
+                                 request.args.get('day')))
 
 # ─────────────────────────────────────────────────────────────────────
 # 3) Dashboard & Config Page
@@ -69,13 +164,16 @@ def index():
         }
         try:
             # CORRECTED: Send as form data, not JSON
-            resp = requests.post(
-                f"http://{ESP32_IP}:{ESP32_PORT}/config",
-                data=new_config,
-                timeout=5
-            )
-            if resp.ok:
-                flash("✅ Configuration sent to ESP32 successfully!")
+            changes, resp = bms_config.push(config_store, ESP32_KEY, new_config,
+                lambda cfg: metrics.proxy_call('config_post', requests.post,
+                    f"http://{ESP32_IP}:{ESP32_PORT}/config",
+                    data=cfg,
+                    timeout=5
+                ))
+            if resp is None:
+                flash("✅ ESP32 already runs this configuration – nothing sent")
+            elif resp.ok:
+                flash(f"✅ Configuration sent to ESP32 successfully! (changed: {', '.join(changes) or '-'})")
             else:
                 flash(f"⚠️ ESP32 responded: {resp.status_code} {resp.text}")
         except Exception as e:
@@ -85,9 +183,11 @@ def index():
     # Fetch current config from ESP32 to populate the form
     esp_config = {}
     try:
-        cfg_resp = requests.get(f"http://{ESP32_IP}:{ESP32_PORT}/config", timeout=3)
+        cfg_resp = metrics.proxy_call('config_get', requests.get,
+                                      f"http://{ESP32_IP}:{ESP32_PORT}/config", timeout=3)
         if cfg_resp.ok:
             esp_config = cfg_resp.json()
+            config_store.record_reported(ESP32_KEY, esp_config)
     except Exception as e:
         print(f"⚠️ Could not fetch ESP32 /config: {e}")
 
@@ -118,7 +218,7 @@ def fw_upload():
         firmware_data = file.read()
         print(f"Uploading {len(firmware_data)} bytes to {url}")
         
-        resp = requests.post(
+        resp = metrics.proxy_call('firmware', requests.post,
             url,
             data=firmware_data,
             headers={"Content-Type": "application/octet-stream"},
@@ -171,32 +271,33 @@ DASHBOARD_HTML = '''
         timestampEl.textContent = `Last Update: ${json_data.timestamp}`;
         container.innerHTML = ''; // Clear previous cards
 
-        if (json_data.data.slaves && json_data.data.slaves.length > 0) {
-            json_data.data.slaves.forEach(slave => {
+        const fx = (v, digits) => (typeof v === 'number') ? v.toFixed(digits) : '–';
+        if (json_data.records && json_data.records.length > 0) {
+            json_data.records.forEach(slave => {
                 const card = document.createElement('div');
                 let cardContent = '';
 
-                if (slave.status === 'connected') {
+                if (slave.connected) {
                     card.className = 'card connected';
                     cardContent = `
                         <div class="card-header">
-                            <span class="slave-id">BMS Slave #${slave.id}</span>
+                            <span class="slave-id">BMS Slave #${slave.slave}</span>
                             <span class="status connected">Connected</span>
                         </div>
                         <div class="data-grid">
-                            <div class="data-item"><span>Pack Voltage:</span> <span>${slave.pack_voltage.toFixed(2)} V</span></div>
-                            <div class="data-item"><span>Current:</span> <span>${slave.current.toFixed(2)} A</span></div>
-                            <div class="data-item"><span>SOC:</span> <span>${slave.soc.toFixed(1)}%</span></div>
-                            <div class="data-item"><span>SOH:</span> <span>${slave.soh.toFixed(1)}%</span></div>
-                            <div class="data-item"><span>Avg Temp:</span> <span>${slave.avg_cell_temp.toFixed(1)} °C</span></div>
-                            <div class="data-item"><span>Cycles:</span> <span>${slave.cycles}</span></div>
+                            <div class="data-item"><span>Pack Voltage:</span> <span>${fx(slave.pack_voltage, 2)} V</span></div>
+                            <div class="data-item"><span>Current:</span> <span>${fx(slave.current, 2)} A</span></div>
+                            <div class="data-item"><span>SOC:</span> <span>${fx(slave.soc, 1)}%</span></div>
+                            <div class="data-item"><span>SOH:</span> <span>${fx(slave.soh, 1)}%</span></div>
+                            <div class="data-item"><span>Avg Temp:</span> <span>${fx(slave.avg_cell_temp, 1)} °C</span></div>
+                            <div class="data-item"><span>Cycles:</span> <span>${slave.cycles ?? '–'}</span></div>
                         </div>
                     `;
                 } else {
                     card.className = 'card disconnected';
                     cardContent = `
                         <div class="card-header">
-                            <span class="slave-id">BMS Slave #${slave.id}</span>
+                            <span class="slave-id">BMS Slave #${slave.slave}</span>
                             <span class="status disconnected">Disconnected</span>
                         </div>
                     `;
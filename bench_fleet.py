@@ -0,0 +1,445 @@
+"""
+Fleet load generator / ingest benchmark.
+
+Simulates N virtual ESP32 devices with M BMS slaves each.  Every device
+posts packets to the HTTP ingest route (form-encoded ``data=<json>`` or a
+raw JSON body) and/or streams them to the raw TCP listener, at a fixed
+per-device rate.  ACK latency, throughput, error counts and the server's
+RSS over time are written to a JSON file so runs can be compared across
+versions:
+
+    python bench_fleet.py --server "python server2.py" --devices 50 --slaves 8 \
+        --rate 2 --duration 30 --mode both --out results/server2.json
+
+With ``--keepalive`` each virtual device keeps one HTTP/1.1 connection open
+and a launched server is started with ``BMS_KEEPALIVE=1``; the server's CPU
+time over the run is reported either way, so the two modes can be compared.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlencode
+
+# ─── Where each server module listens ───────────────────────────────
+# (http port, ingest path, body encoding, tcp port or None)
+TARGETS = {
+    "bms_server.py":     (5000, "/update",     "form", None),
+    "BMS_SERVER2.py":    (5000, "/update",     "form", None),
+    "BMSs-Server.py":    (5000, "/update",     "form", None),
+    "python server2.py": (8000, "/api/update", "json", 5000),
+    "python server3.py": (8000, "/api/update", "json", None),
+    "python server4.py": (5000, "/api/update", "json", None),
+    "python server5.py": (5000, "/update",     "form", None),
+}
+
+
+# ─────────────────────────────────────────────────────────────────────
+#  Packet generation (same three shapes the servers already accept)
+# ─────────────────────────────────────────────────────────────────────
+def make_packet(shape, device, seq, slaves):
+    if shape == "legacy":
+        return {
+            "device": device, "seq": seq,
+            "pack_voltage": round(random.uniform(48, 54), 2),
+            "current": round(random.uniform(-20, 20), 2),
+            "capacity_remaining": round(random.uniform(10, 100), 1),
+            "soc": round(random.uniform(20, 100), 1),
+            "soh": 98.5,
+            "avg_cell_temp": round(random.uniform(20, 35), 1),
+            "env_temp": 25.0,
+            "cycles": 120,
+            "max_cell_voltage": 3.41,
+            "min_cell_voltage": 3.32,
+            "modbusError": False,
+        }
+    if shape == "short":
+        return {"device": device, "seq": seq, "slaves": [{
+            "id": i + 1,
+            "V": round(random.uniform(48, 54), 2),
+            "I": round(random.uniform(-20, 20), 2),
+            "RemAh": round(random.uniform(10, 100), 1),
+            "Temp": round(random.uniform(20, 35), 1),
+            "Warn": 0, "Prot": 0,
+        } for i in range(slaves)]}
+    return {"device": device, "seq": seq, "slaves": [{
+        "id": i + 1,
+        "status": "connected",
+        "pack_voltage": round(random.uniform(48, 54), 2),
+        "current": round(random.uniform(-20, 20), 2),
+        "soc": round(random.uniform(20, 100), 1),
+        "soh": 98.5,
+        "avg_cell_temp": round(random.uniform(20, 35), 1),
+        "cycles": 120,
+    } for i in range(slaves)]}
+
+
+# ─────────────────────────────────────────────────────────────────────
+#  Result bookkeeping
+# ─────────────────────────────────────────────────────────────────────
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {"http": [], "tcp": []}
+        self.errors = {"http": {}, "tcp": {}}
+        self.sent = {"http": 0, "tcp": 0}
+
+    def ok(self, path, seconds):
+        with self.lock:
+            self.sent[path] += 1
+            self.latencies[path].append(seconds)
+
+    def fail(self, path, reason):
+        with self.lock:
+            self.sent[path] += 1
+            self.errors[path][reason] = self.errors[path].get(reason, 0) + 1
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(results, elapsed):
+    summary = {}
+    for path in ("http", "tcp"):
+        lat = sorted(results.latencies[path])
+        sent = results.sent[path]
+        if not sent:
+            continue
+        failed = sum(results.errors[path].values())
+        summary[path] = {
+            "sent": sent,
+            "acked": len(lat),
+            "errors": results.errors[path],
+            "error_rate": failed / sent,
+            "throughput_pps": len(lat) / elapsed if elapsed else 0.0,
+            "latency_ms": {
+                "p50": _ms(percentile(lat, 50)),
+                "p95": _ms(percentile(lat, 95)),
+                "p99": _ms(percentile(lat, 99)),
+                "max": _ms(lat[-1] if lat else None),
+                "mean": _ms(sum(lat) / len(lat) if lat else None),
+            },
+        }
+    return summary
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000.0, 3)
+
+
+# ─────────────────────────────────────────────────────────────────────
+#  Virtual devices
+# ─────────────────────────────────────────────────────────────────────
+def http_device(args, device, results, stop):
+    """One virtual ESP32 posting to the HTTP ingest route."""
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+    seq = 0
+    conn = None
+    next_send = time.perf_counter() + random.uniform(0, interval)
+    while not stop.is_set():
+        pause = next_send - time.perf_counter()
+        if pause > 0:
+            time.sleep(pause)
+        next_send += interval
+        seq += 1
+        packet = make_packet(args.shape, device, seq, args.slaves)
+        if args.encoding == "form":
+            body = urlencode({"data": json.dumps(packet)})
+            headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        else:
+            body = json.dumps(packet)
+            headers = {"Content-Type": "application/json"}
+        # Same as the firmware: fresh TCP connection per sample, unless
+        # --keepalive (http.client reconnects by itself if the server closes)
+        if conn is None or not args.keepalive:
+            conn = http.client.HTTPConnection(args.host, args.http_port, timeout=args.timeout)
+        t0 = time.perf_counter()
+        try:
+            conn.request("POST", args.path, body=body, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            if 200 <= resp.status < 300:
+                results.ok("http", time.perf_counter() - t0)
+            else:
+                results.fail("http", f"http_{resp.status}")
+        except socket.timeout:
+            results.fail("http", "timeout")
+            conn.close()
+        except (OSError, http.client.HTTPException) as e:
+            results.fail("http", type(e).__name__)
+            conn.close()
+        finally:
+            if not args.keepalive:
+                conn.close()
+    if conn is not None:
+        conn.close()
+
+
+def tcp_device(args, device, results, stop):
+    """One virtual ESP32 streaming JSON packets to the raw TCP listener."""
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+    seq = 0
+    sock = None
+    next_send = time.perf_counter() + random.uniform(0, interval)
+    while not stop.is_set():
+        pause = next_send - time.perf_counter()
+        if pause > 0:
+            time.sleep(pause)
+        next_send += interval
+        seq += 1
+        payload = json.dumps(make_packet(args.shape, device, seq, args.slaves)).encode()
+        try:
+            if sock is None:
+                sock = socket.create_connection((args.host, args.tcp_port), timeout=args.timeout)
+            t0 = time.perf_counter()
+            sock.sendall(payload)
+            ack = sock.recv(64)
+            if ack.startswith(b"ACK"):
+                results.ok("tcp", time.perf_counter() - t0)
+            else:
+                results.fail("tcp", "closed" if not ack else "bad_ack")
+                sock.close()
+                sock = None
+        except socket.timeout:
+            results.fail("tcp", "timeout")
+            sock.close()
+            sock = None
+        except OSError as e:
+            results.fail("tcp", type(e).__name__)
+            if sock is not None:
+                sock.close()
+            sock = None
+    if sock is not None:
+        sock.close()
+
+
+# ─────────────────────────────────────────────────────────────────────
+#  Server process + RSS sampling
+# ─────────────────────────────────────────────────────────────────────
+def process_tree(pid):
+    """``pid`` plus its children (Flask's reloader forks one), or None."""
+    pids = {pid}
+    try:
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                if int(fields[1]) in pids:
+                    pids.add(int(entry))
+            except OSError:
+                continue
+    except OSError:
+        return None
+    return pids
+
+
+def process_tree_cpu(pid):
+    """User + system CPU seconds used so far by ``pid`` and its children."""
+    pids = process_tree(pid)
+    if pids is None:
+        return None
+    ticks = 0
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            ticks += int(fields[11]) + int(fields[12])
+        except OSError:
+            continue
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+
+def process_tree_rss(pid):
+    """RSS in bytes of ``pid`` plus its children."""
+    pids = process_tree(pid)
+    if pids is None:
+        return None
+    total = 0
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+def sample_rss(pid, samples, stop, start, every):
+    while not stop.is_set():
+        rss = process_tree_rss(pid)
+        if rss is not None:
+            samples.append({"t": round(time.perf_counter() - start, 3), "rss_bytes": rss})
+        stop.wait(every)
+
+
+def wait_for_port(host, port, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ─────────────────────────────────────────────────────────────────────
+#  Main
+# ─────────────────────────────────────────────────────────────────────
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Simulate a fleet of ESP32 BMS gateways")
+    p.add_argument('--server', help="server module to launch, e.g. 'bms_server.py' or 'python server2.py'")
+    p.add_argument('--pid', type=int, help="sample RSS of an already running server")
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--http-port', type=int)
+    p.add_argument('--tcp-port', type=int)
+    p.add_argument('--path', help="HTTP ingest route (default depends on --server)")
+    p.add_argument('--encoding', choices=('form', 'json'))
+    p.add_argument('--mode', choices=('http', 'tcp', 'both'), default='http')
+    p.add_argument('--shape', choices=('legacy', 'short', 'long'), default='long')
+    p.add_argument('--devices', type=int, default=10)
+    p.add_argument('--slaves', type=int, default=4)
+    p.add_argument('--rate', type=float, default=2.0, help="packets per second per device")
+    p.add_argument('--duration', type=float, default=10.0, help="seconds")
+    p.add_argument('--timeout', type=float, default=5.0)
+    p.add_argument('--rss-interval', type=float, default=1.0)
+    p.add_argument('--keepalive', action='store_true',
+                   help="reuse one HTTP/1.1 connection per device (launched server gets BMS_KEEPALIVE=1)")
+    p.add_argument('--rate-limit', action='store_true',
+                   help="turn the launched server's ingest rate limiter on (all virtual devices share 127.0.0.1)")
+    p.add_argument('--out', default='bench_results.json')
+    args = p.parse_args(argv)
+
+    http_port, path, encoding, tcp_port = TARGETS.get(
+        os.path.basename(args.server or ''), (5000, "/update", "form", 5000))
+    args.http_port = args.http_port or http_port
+    args.path = args.path or path
+    args.encoding = args.encoding or encoding
+    args.tcp_port = args.tcp_port or tcp_port or 5000
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    proc = None
+    pid = args.pid
+    if args.server:
+        # Own session so the Flask reloader child is torn down with it
+        env = dict(os.environ)
+        if args.keepalive:
+            env['BMS_KEEPALIVE'] = '1'
+        env['BMS_RATE_LIMIT'] = '1' if args.rate_limit else '0'
+        proc = subprocess.Popen([sys.executable, args.server], stdin=subprocess.PIPE,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                start_new_session=True, env=env)
+        pid = proc.pid
+        print(f"🚀 Started {args.server} (pid {pid})")
+        port = args.tcp_port if args.mode == 'tcp' else args.http_port
+        if not wait_for_port(args.host, port, 15):
+            os.killpg(proc.pid, signal.SIGKILL)
+            sys.exit(f"❌ {args.server} never opened port {port}")
+
+    results = Results()
+    stop = threading.Event()
+    rss_samples = []
+    started_at = datetime.now().isoformat()
+    start = time.perf_counter()
+    threads = []
+    if pid:
+        threads.append(threading.Thread(target=sample_rss, daemon=True,
+                                        args=(pid, rss_samples, stop, start, args.rss_interval)))
+    for n in range(args.devices):
+        device = f"sim-{n:04d}"
+        if args.mode in ('http', 'both'):
+            threads.append(threading.Thread(target=http_device, daemon=True,
+                                            args=(args, device, results, stop)))
+        if args.mode in ('tcp', 'both'):
+            threads.append(threading.Thread(target=tcp_device, daemon=True,
+                                            args=(args, device, results, stop)))
+
+    print(f"📡 {args.devices} devices × {args.slaves} slaves @ {args.rate}/s for {args.duration}s "
+          f"({args.mode}{', keep-alive' if args.keepalive else ''})")
+    cpu_start = process_tree_cpu(pid) if pid else None
+    for t in threads:
+        t.start()
+    try:
+        time.sleep(args.duration)
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    for t in threads:
+        t.join(timeout=args.timeout + 1)
+    elapsed = time.perf_counter() - start
+    cpu_end = process_tree_cpu(pid) if pid else None
+
+    if proc is not None:
+        os.killpg(proc.pid, signal.SIGTERM)
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+
+    report = {
+        "started_at": started_at,
+        "revision": git_revision(),
+        "config": {k: v for k, v in vars(args).items()},
+        "elapsed_s": round(elapsed, 3),
+        "summary": summarize(results, elapsed),
+        "rss": rss_samples,
+    }
+    if cpu_start is not None and cpu_end is not None:
+        cpu_s = cpu_end - cpu_start
+        acked = sum(v["acked"] for v in report["summary"].values())
+        report["server_cpu"] = {
+            "cpu_seconds": round(cpu_s, 3),
+            "cpu_percent": round(100.0 * cpu_s / elapsed, 1) if elapsed else None,
+            "cpu_ms_per_sample": round(1000.0 * cpu_s / acked, 3) if acked else None,
+        }
+    out_dir = os.path.dirname(args.out)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for path, s in report["summary"].items():
+        lat = s["latency_ms"]
+        print(f"📊 {path.upper()}: {s['acked']}/{s['sent']} acked, {s['throughput_pps']:.1f} pkt/s, "
+              f"p50={lat['p50']}ms p95={lat['p95']}ms p99={lat['p99']}ms, error rate {s['error_rate']:.2%}")
+    if rss_samples:
+        print(f"🧠 Server RSS: {rss_samples[0]['rss_bytes'] >> 20} → {rss_samples[-1]['rss_bytes'] >> 20} MiB")
+    if "server_cpu" in report:
+        cpu = report["server_cpu"]
+        print(f"⚙️ Server CPU: {cpu['cpu_seconds']}s ({cpu['cpu_percent']}% of a core), "
+              f"{cpu['cpu_ms_per_sample']} ms per sample")
+    print(f"💾 Results written to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
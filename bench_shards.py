@@ -0,0 +1,181 @@
+"""
+Store contention benchmark: one global deque + lock (what ``python
+server2.py`` used to do) against ``bms_shards.ShardedStore``.
+
+Every thread plays a few devices and loops decode → store, like an ingest
+thread.  For each thread count it reports throughput, the p50/p99 time
+spent inside the store call, and how many lock acquisitions found the lock
+already taken:
+
+    python bench_shards.py --threads 1,2,4,8,16 --seconds 3 --out results/shards.json
+
+``--path ingest`` times what ``store_entries`` really does – store append
+*and* journal write – for the old global store with an inline journal,
+the sharded store with an inline journal, and the sharded store with the
+group-committed journal (``bms_warmstart.Journal``), writing real journal
+files to a temporary directory.  The contention figure is then the inline
+journal lock's (the group-committed journal has none).
+
+CPython's GIL caps the pure-Python part, so throughput does not grow
+linearly with threads in either store; what sharding removes is the lock
+queue, which shows as contended acquisitions and store-latency tail.
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import bms_shards
+import bms_warmstart
+from bench_fleet import _ms, make_packet, percentile
+
+
+class CountingLock:
+    """A lock that counts acquisitions that had to wait."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contended = 0
+        self.acquired = 0
+
+    def __enter__(self):
+        if not self.lock.acquire(blocking=False):
+            self.contended += 1
+            self.lock.acquire()
+        self.acquired += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+
+class GlobalStore:
+    def __init__(self, maxlen):
+        self.items = deque(maxlen=maxlen)
+        self.locks = [CountingLock()]
+
+    def extend(self, device, entries):
+        with self.locks[0]:
+            self.items.extend(entries)
+
+
+class InstrumentedShards(bms_shards.ShardedStore):
+    """ShardedStore whose shard locks count contention."""
+
+    def shard(self, device):
+        shard = self.shards.get(device)
+        if shard is None:
+            shard = super().shard(device)
+            shard.lock = CountingLock()
+        return shard
+
+    @property
+    def locks(self):
+        return [s.lock for s in self.shards.values()]
+
+
+class Ingest:
+    """``store_entries`` of ``python server2.py``: store append, then journal write."""
+
+    def __init__(self, store, journal):
+        self.store, self.journal = store, journal
+        self.locks = [journal.lock] if journal.queue is None else []
+
+    def extend(self, device, entries):
+        self.store.extend(device, entries)
+        self.journal.write(entries)
+
+
+INGEST_KINDS = {
+    'global+inline': ('global', False),
+    'sharded+inline': ('sharded', False),
+    'sharded+group': ('sharded', True),
+}
+
+
+def make_ingest(kind, journal_dir):
+    store_kind, group_commit = INGEST_KINDS[kind]
+    store = GlobalStore(100_000) if store_kind == 'global' else bms_shards.ShardedStore(max_total=100_000)
+    journal = bms_warmstart.Journal(kind.replace('+', '_'), journal_dir, group_commit=group_commit)
+    journal.lock = CountingLock()
+    return Ingest(store, journal)
+
+
+def worker(store, devices, stop, latencies, counts, idx):
+    payloads = {d: json.dumps(make_packet('long', d, 0, 4)) for d in devices}
+    lat = []
+    n = 0
+    while not stop.is_set():
+        for device in devices:
+            data = json.loads(payloads[device])
+            entry = {"timestamp": datetime.now().isoformat(), "source": "bench", "type": "json", "data": data}
+            t0 = time.perf_counter()
+            store.extend(device, [entry])
+            lat.append(time.perf_counter() - t0)
+            n += 1
+    latencies[idx] = lat
+    counts[idx] = n
+
+
+def run(kind, threads, seconds, devices_per_thread, journal_dir=None):
+    if kind in INGEST_KINDS:
+        store = make_ingest(kind, journal_dir)
+    elif kind == 'global':
+        store = GlobalStore(100_000)
+    else:
+        store = InstrumentedShards(per_device=bms_shards.SHARD_MAX)
+    stop = threading.Event()
+    latencies, counts = [None] * threads, [0] * threads
+    workers = [threading.Thread(target=worker, args=(
+        store, [f"dev-{t}-{d}" for d in range(devices_per_thread)], stop, latencies, counts, t))
+        for t in range(threads)]
+    t0 = time.perf_counter()
+    for w in workers:
+        w.start()
+    time.sleep(seconds)
+    stop.set()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - t0
+    lat = sorted(x for run_lat in latencies for x in run_lat)
+    locks = store.locks
+    acquired = sum(l.acquired for l in locks)
+    contended = sum(l.contended for l in locks)
+    return {"store": kind, "threads": threads, "entries_per_s": round(sum(counts) / elapsed),
+            "store_p50_ms": _ms(percentile(lat, 50)), "store_p99_ms": _ms(percentile(lat, 99)),
+            "store_max_ms": _ms(lat[-1] if lat else None),
+            "contended_ratio": round(contended / acquired, 4) if acquired else 0.0}
+
+
+def main():
+    p = argparse.ArgumentParser(description="Global-lock vs sharded store under concurrent ingest")
+    p.add_argument('--threads', default='1,2,4,8,16')
+    p.add_argument('--seconds', type=float, default=3.0)
+    p.add_argument('--devices-per-thread', type=int, default=4)
+    p.add_argument('--path', choices=('store', 'ingest'), default='store',
+                   help="time the store call only, or store + journal write like the server")
+    p.add_argument('--out', default='bench_shards.json')
+    args = p.parse_args()
+
+    kinds = ('global', 'sharded') if args.path == 'store' else tuple(INGEST_KINDS)
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench_journal_') as journal_dir:
+        for threads in (int(t) for t in args.threads.split(',')):
+            for kind in kinds:
+                r = run(kind, threads, args.seconds, args.devices_per_thread, journal_dir)
+                results.append(r)
+                print(f"{kind:14s} {threads:3d} threads: {r['entries_per_s']:>8d}/s  "
+                      f"p50 {r['store_p50_ms']} ms  p99 {r['store_p99_ms']} ms  "
+                      f"contended {r['contended_ratio']:.2%}")
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    with open(args.out, 'w') as f:
+        json.dump({"generated_at": datetime.now().isoformat(), "results": results}, f, indent=2)
+    print(f"📝 Results written to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+"""
+Adaptive reporting intervals: slow idle devices down, speed them up in
+transients.
+
+``IntervalController.observe()`` is called from ``update()`` with each
+packet's normalized records.  Per device it keeps an EWMA of how much the
+watched metrics move between consecutive samples, each change divided by
+the metric's scale in ``SCALES`` (5 A of current counts as much as 0.5 V
+of pack voltage).  A background thread evaluates every ``eval_s``:
+
+* volatility above ``busy``  → halve both intervals (at once: transients
+  must not be undersampled), unless the server's ingest rate is above
+  ``load_high_pps``;
+* volatility below ``calm``  → double them, but only ``hold_s`` after the
+  device's last change;
+* in between                 → keep them (the hysteresis band).
+
+Nothing is decided for a device until it has sent ``min_samples`` packets
+since its last change.
+
+Intervals stay within the configured bounds and are pushed through the
+device's ``/config`` like an operator change, via :func:`bms_config.push`,
+so a device that already runs them is not called.  Bandwidth saved is
+measured against the ``baseline`` intervals from ``config.json``
+(500/2000 ms): every evaluation adds ``elapsed × (1/baseline − 1/current)``
+packets times the device's average packet size – for devices that sent
+anything since the previous evaluation only, so one that went quiet stops
+"saving".  A device silent for ``idle_s`` is forgotten (its savings so
+far stay in the totals).
+
+Settings come from ``adaptive.json`` when present (keys as in
+``DEFAULT_SETTINGS``); the controller only runs with ``BMS_ADAPTIVE=1``.
+"""
+import json
+import os
+import threading
+import time
+
+import bms_config
+import bms_metrics as metrics
+
+ENABLED = os.environ.get('BMS_ADAPTIVE') == '1'
+ADAPTIVE_FILE = 'adaptive.json'
+
+DEFAULT_SETTINGS = {
+    "networkInterval": {"min": 500, "max": 10000, "baseline": 2000},
+    "modbusInterval":  {"min": 250, "max": 5000,  "baseline": 500},
+    "calm": 0.05,
+    "busy": 0.5,
+    "alpha": 0.3,
+    "hold_s": 120,
+    "min_samples": 5,
+    "eval_s": 15,
+    "load_high_pps": 500,
+    "idle_s": 600,
+}
+
+# Metric -> change that counts as one unit of volatility
+SCALES = {"current": 5.0, "pack_voltage": 0.5, "avg_cell_temp": 1.0, "soc": 1.0,
+          "max_cell_voltage": 0.02, "min_cell_voltage": 0.02}
+
+INTERVAL_MS = metrics.Gauge('bms_adaptive_interval_ms', 'Reporting interval currently set per device',
+                            ('device', 'field'))
+CHANGES = metrics.Counter('bms_adaptive_changes_total', 'Interval adjustments pushed', ('direction',))
+BYTES_SAVED = metrics.Gauge('bms_adaptive_bytes_saved', 'Net ingest bytes saved against the baseline intervals')
+
+
+def load_settings(path=ADAPTIVE_FILE):
+    settings = json.loads(json.dumps(DEFAULT_SETTINGS))
+    if os.path.exists(path):
+        with open(path) as f:
+            for key, value in json.load(f).items():
+                if isinstance(value, dict) and isinstance(settings.get(key), dict):
+                    settings[key].update(value)
+                else:
+                    settings[key] = value
+    return settings
+
+
+def _clamp(value, bounds):
+    return int(min(max(value, bounds["min"]), bounds["max"]))
+
+
+class _DeviceState:
+    __slots__ = ('addr', 'last', 'volatility', 'bytes_avg', 'packets', 'since_change', 'recent', 'seen_at',
+                 'network', 'modbus', 'changed_at', 'saved_bytes', 'saved_packets')
+
+    def __init__(self, addr, settings):
+        self.addr = addr
+        self.last = {}              # (slave, metric) -> last value
+        self.volatility = 0.0
+        self.bytes_avg = 0.0
+        self.packets = 0
+        self.since_change = 0
+        self.recent = 0             # packets since the last evaluation
+        self.seen_at = time.monotonic()
+        self.network = settings["networkInterval"]["baseline"]
+        self.modbus = settings["modbusInterval"]["baseline"]
+        self.changed_at = float('-inf')
+        self.saved_bytes = 0.0
+        self.saved_packets = 0.0
+
+
+class IntervalController:
+    def __init__(self, store, send, fetch=None, key=str, settings=None):
+        """``send(addr, config)``/``fetch(addr)`` talk to a device's ``/config``;
+        ``key(addr)`` is its name in the config store."""
+        self.store = store
+        self.send = send
+        self.fetch = fetch
+        self.key = key
+        self.settings = settings or load_settings()
+        self.lock = threading.Lock()
+        self.devices = {}           # device -> _DeviceState
+        self.packets = 0            # all devices, since the last evaluation
+        self.last_eval = time.monotonic()
+        self.retired_bytes = 0.0    # savings of devices forgotten after idle_s
+        self.retired_packets = 0.0
+
+    # ─── ingest side (cheap, under the lock) ───────────────────────
+    def observe(self, device, records, addr, nbytes=0):
+        alpha = self.settings["alpha"]
+        with self.lock:
+            st = self.devices.get(device)
+            if st is None:
+                st = self.devices[device] = _DeviceState(addr, self.settings)
+                known = self.store.reported(self.key(addr)) or {}
+                st.network = known.get("networkInterval", st.network)
+                st.modbus = known.get("modbusInterval", st.modbus)
+            st.addr = addr
+            st.packets += 1
+            st.since_change += 1
+            st.recent += 1
+            st.seen_at = time.monotonic()
+            self.packets += 1
+            st.bytes_avg += alpha * (nbytes - st.bytes_avg) if st.bytes_avg else nbytes
+            move = 0.0
+            for r in records:
+                for metric, scale in SCALES.items():
+                    value = getattr(r, metric, None)
+                    if not isinstance(value, (int, float)):
+                        continue
+                    key = (r.slave, metric)
+                    prev = st.last.get(key)
+                    st.last[key] = value
+                    if prev is not None:
+                        move = max(move, abs(value - prev) / scale)
+            st.volatility += alpha * (move - st.volatility)
+
+    # ─── control loop ──────────────────────────────────────────────
+    def decide(self, st, now, load_pps):
+        """Factor to apply to the device's intervals (1 = keep)."""
+        s = self.settings
+        if st.since_change < s["min_samples"]:
+            return 1.0
+        if st.volatility > s["busy"] and load_pps <= s["load_high_pps"]:
+            return 0.5
+        if st.volatility < s["calm"] and now - st.changed_at >= s["hold_s"]:
+            return 2.0
+        return 1.0
+
+    def evaluate(self):
+        now = time.monotonic()
+        s = self.settings
+        with self.lock:
+            elapsed = max(now - self.last_eval, 1e-6)
+            load_pps = self.packets / elapsed
+            self.packets = 0
+            self.last_eval = now
+            plan = []
+            for device, st in list(self.devices.items()):
+                if not st.recent:
+                    # Silent since the last evaluation: nothing was saved, nothing to decide
+                    if now - st.seen_at >= s["idle_s"]:
+                        self._forget(device, st)
+                    continue
+                st.recent = 0
+                # Bandwidth accounting for the interval that was in force
+                saved = elapsed * (1000.0 / s["networkInterval"]["baseline"] - 1000.0 / st.network)
+                st.saved_packets += saved
+                st.saved_bytes += saved * st.bytes_avg
+                factor = self.decide(st, now, load_pps)
+                network = _clamp(st.network * factor, s["networkInterval"])
+                modbus = _clamp(st.modbus * factor, s["modbusInterval"])
+                if (network, modbus) != (st.network, st.modbus) and st.addr:
+                    plan.append((device, st, network, modbus))
+            BYTES_SAVED.set(self.retired_bytes + sum(st.saved_bytes for st in self.devices.values()))
+        for device, st, network, modbus in plan:
+            self.apply(device, st, network, modbus, now)
+        return load_pps
+
+    def _forget(self, device, st):
+        # Caller holds self.lock
+        del self.devices[device]
+        self.retired_bytes += st.saved_bytes
+        self.retired_packets += st.saved_packets
+        INTERVAL_MS.remove(device, 'networkInterval')
+        INTERVAL_MS.remove(device, 'modbusInterval')
+
+    def apply(self, device, st, network, modbus, now):
+        key = self.key(st.addr)
+        config = self.store.reported(key)
+        if config is None and self.fetch is not None:
+            try:
+                resp = self.fetch(st.addr)
+                if resp.ok:
+                    self.store.record_reported(key, resp.json())
+                    config = self.store.reported(key)
+            except Exception as e:
+                print(f"⚠️ Adaptive: could not read /config of {device} ({st.addr}): {e}")
+                return
+        config = dict(config or {})
+        config.update(networkInterval=network, modbusInterval=modbus)
+        try:
+            _, resp = bms_config.push(self.store, key, config, lambda cfg: self.send(st.addr, cfg))
+        except Exception as e:
+            print(f"⚠️ Adaptive: could not push intervals to {device} ({st.addr}): {e}")
+            return
+        if resp is not None and not resp.ok:
+            return
+        direction = 'down' if network < st.network else 'up'
+        CHANGES.inc(direction)
+        print(f"🎚️ {device}: networkInterval {st.network}→{network} ms, modbusInterval "
+              f"{st.modbus}→{modbus} ms (volatility {st.volatility:.3f})")
+        with self.lock:
+            st.network, st.modbus, st.changed_at = network, modbus, now
+            st.since_change = 0
+        INTERVAL_MS.set(network, device, 'networkInterval')
+        INTERVAL_MS.set(modbus, device, 'modbusInterval')
+
+    def run(self):
+        while True:
+            time.sleep(self.settings["eval_s"])
+            try:
+                self.evaluate()
+            except Exception as e:
+                print(f"⚠️ Adaptive interval evaluation failed: {e}")
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def view(self):
+        with self.lock:
+            devices = {d: {"addr": st.addr, "volatility": round(st.volatility, 4),
+                           "networkInterval": st.network, "modbusInterval": st.modbus,
+                           "packets": st.packets, "saved_packets": round(st.saved_packets),
+                           "saved_bytes": round(st.saved_bytes)}
+                       for d, st in self.devices.items()}
+            retired_bytes, retired_packets = self.retired_bytes, self.retired_packets
+        return {"settings": self.settings, "devices": devices,
+                "saved_bytes": round(retired_bytes) + sum(d["saved_bytes"] for d in devices.values()),
+                "saved_packets": round(retired_packets) + sum(d["saved_packets"] for d in devices.values())}
@@ -0,0 +1,234 @@
+"""
+Declarative threshold / alarm rules evaluated at ingest.
+
+Each rule names a record metric (see ``bms_records.METRICS``), a
+comparison and a threshold, plus optional hysteresis (``clear``),
+debounce (``for_s``) and rate-of-change mode (``rate``: the metric's
+slope in units per second is compared instead of its value).  Slopes are
+taken over the device's own sample times (``sample_ns``) when the packets
+carry them, else over arrival time, and only across at least
+``min_gap_s``: back-to-back packets (retries, TCP reads, replays) would
+otherwise turn a small step into a huge slope.  Each rate rule keeps its
+own baseline, so two rules on one metric with different gaps do not
+disturb each other.
+
+``AlarmEngine.evaluate()`` is called from ``update()`` with the
+normalized records of a whole packet: every rule pulls its metric column
+for all slaves once and compares the column in a single pass, so the
+per-packet cost is O(rules × slaves).
+
+Rules are loaded from ``alarm_rules.json`` when present, e.g.::
+
+    [{"name": "cell_overvoltage", "metric": "max_cell_voltage", "op": ">",
+      "threshold": 3.65, "clear": 3.55, "for_s": 2, "severity": "critical"}]
+
+Active alarms live in a table keyed by (device, slave, rule) with a
+secondary index per device; ``GET /api/alarms`` serves it.
+"""
+import json
+import operator
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import bms_metrics as metrics
+from bms_records import METRICS
+
+ALARM_RULES_FILE = 'alarm_rules.json'
+
+DEFAULT_RULES = [
+    {"name": "cell_overvoltage", "metric": "max_cell_voltage", "op": ">", "threshold": 3.65,
+     "clear": 3.55, "for_s": 2, "severity": "critical"},
+    {"name": "cell_undervoltage", "metric": "min_cell_voltage", "op": "<", "threshold": 2.8,
+     "clear": 2.95, "for_s": 2, "severity": "critical"},
+    {"name": "over_temperature", "metric": "avg_cell_temp", "op": ">", "threshold": 55,
+     "clear": 50, "for_s": 5, "severity": "major"},
+    {"name": "bms_warning", "metric": "warn", "op": "!=", "threshold": 0, "severity": "minor"},
+    {"name": "bms_protection", "metric": "prot", "op": "!=", "threshold": 0, "severity": "critical"},
+    {"name": "modbus_error", "metric": "modbus_error", "op": "!=", "threshold": 0,
+     "for_s": 5, "severity": "major"},
+    {"name": "voltage_slew", "metric": "pack_voltage", "op": ">", "threshold": 2.0,
+     "rate": True, "abs": True, "min_gap_s": 0.5, "max_gap_s": 30, "severity": "minor"},
+]
+
+OPS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le,
+       '==': operator.eq, '!=': operator.ne}
+
+EVAL_SECONDS = metrics.Histogram('bms_alarm_eval_seconds', 'Alarm rule evaluation time per packet')
+ACTIVE_ALARMS = metrics.Gauge('bms_alarms_active', 'Currently active alarms by severity', ('severity',))
+TRANSITIONS = metrics.Counter('bms_alarm_transitions_total', 'Alarm raise/clear events', ('rule', 'event'))
+
+
+def _num(value):
+    if value is None or isinstance(value, str):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Rule:
+    __slots__ = ('name', 'metric', 'op', 'cmp', 'threshold', 'clear', 'for_s',
+                 'rate', 'abs', 'min_gap_s', 'max_gap_s', 'severity')
+
+    def __init__(self, spec):
+        self.name = spec['name']
+        self.metric = spec['metric']
+        if self.metric not in METRICS:
+            raise ValueError(f"rule {self.name}: unknown metric {self.metric!r}")
+        self.op = spec.get('op', '>')
+        if self.op not in OPS:
+            raise ValueError(f"rule {self.name}: unknown op {self.op!r}")
+        self.cmp = OPS[self.op]
+        self.threshold = float(spec['threshold'])
+        # Hysteresis: once raised, the alarm stays until the value no longer
+        # satisfies the comparison against ``clear``
+        self.clear = float(spec.get('clear', self.threshold))
+        self.for_s = float(spec.get('for_s', 0))
+        self.rate = bool(spec.get('rate', False))
+        self.abs = bool(spec.get('abs', False))
+        self.min_gap_s = float(spec.get('min_gap_s', 0.5))
+        self.max_gap_s = float(spec.get('max_gap_s', 60))
+        self.severity = spec.get('severity', 'minor')
+
+    def column(self, records):
+        return [_num(getattr(r, self.metric)) for r in records]
+
+
+def load_rules(path=ALARM_RULES_FILE):
+    specs = DEFAULT_RULES
+    if os.path.exists(path):
+        with open(path) as f:
+            specs = json.load(f)
+    return [Rule(spec) for spec in specs]
+
+
+class AlarmEngine:
+    def __init__(self, rules=None, keep_events=500):
+        self.rules = rules if rules is not None else load_rules()
+        self.rate_rules = [r for r in self.rules if r.rate]
+        self.lock = threading.Lock()
+        self.active = {}          # (device, slave, rule) -> alarm record
+        self.by_device = {}       # device -> set of active keys
+        self.pending = {}         # (device, slave, rule) -> monotonic time the condition began
+        self.previous = {}        # (device, slave, rule) -> (t, value, on_sample_clock) for rate rules
+        self.events = deque(maxlen=keep_events)
+
+    def evaluate(self, device, records, now=None):
+        """Evaluate every rule against the records of one packet."""
+        t0 = time.perf_counter()
+        if not records:
+            return []
+        now = time.monotonic() if now is None else now
+        ids = [r.slave for r in records]
+        # Rate rules: device sample time when present (seconds), else arrival
+        times = [(r.sample_ns / 1e9, True) if r.sample_ns is not None else (now, False)
+                 for r in records] if self.rate_rules else None
+        changes = []
+        with self.lock:
+            columns = {}
+            for rule in self.rules:
+                col = columns.get(rule.metric)
+                if col is None:
+                    col = columns[rule.metric] = rule.column(records)
+                if rule.rate:
+                    col = self._slopes(device, ids, rule, col, times)
+                if rule.abs:
+                    col = [None if v is None else abs(v) for v in col]
+                th, cl, cmp = rule.threshold, rule.clear, rule.cmp
+                raise_mask = [v is not None and cmp(v, th) for v in col]
+                hold_mask = [v is not None and cmp(v, cl) for v in col]
+                for slave_id, v, trip, hold in zip(ids, col, raise_mask, hold_mask):
+                    key = (device, slave_id, rule.name)
+                    if key in self.active:
+                        if v is None or hold:
+                            if v is not None:
+                                self.active[key]['value'] = v
+                        else:
+                            changes.append(self._clear(key, v))
+                    elif trip:
+                        since = self.pending.setdefault(key, now)
+                        if now - since >= rule.for_s:
+                            del self.pending[key]
+                            changes.append(self._raise(key, rule, v))
+                    else:
+                        self.pending.pop(key, None)
+            for rule in self.rate_rules:
+                for slave_id, v, (t, on_sample) in zip(ids, columns[rule.metric], times):
+                    if v is None:
+                        continue
+                    key = (device, slave_id, rule.name)
+                    prev = self.previous.get(key)
+                    # Too soon after the baseline: keep it, so the next slope spans min_gap_s
+                    if prev is None or prev[2] != on_sample or not 0 <= t - prev[0] < rule.min_gap_s:
+                        self.previous[key] = (t, v, on_sample)
+        EVAL_SECONDS.observe(time.perf_counter() - t0)
+        return changes
+
+    def _slopes(self, device, ids, rule, col, times):
+        out = []
+        for slave_id, v, (t, on_sample) in zip(ids, col, times):
+            prev = self.previous.get((device, slave_id, rule.name))
+            if v is None or prev is None or prev[2] != on_sample:
+                out.append(None)
+                continue
+            dt = t - prev[0]
+            # Too short a gap amplifies noise, a long one says nothing: skip rather than alarm
+            out.append((v - prev[1]) / dt if rule.min_gap_s <= dt <= rule.max_gap_s and dt > 0 else None)
+        return out
+
+    def _raise(self, key, rule, value):
+        device, slave_id, name = key
+        alarm = {
+            "device": device, "slave": slave_id, "rule": name,
+            "metric": rule.metric, "severity": rule.severity,
+            "threshold": rule.threshold, "value": value,
+            "raised_at": datetime.now().isoformat(),
+        }
+        self.active[key] = alarm
+        self.by_device.setdefault(device, set()).add(key)
+        ACTIVE_ALARMS.inc(rule.severity)
+        TRANSITIONS.inc(name, 'raised')
+        event = dict(alarm, event="raised")
+        self.events.append(event)
+        print(f"🚨 ALARM {name} on {device} slave {slave_id}: {value}")
+        return event
+
+    def _clear(self, key, value):
+        alarm = self.active.pop(key)
+        keys = self.by_device.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_device[key[0]]
+        ACTIVE_ALARMS.dec(alarm['severity'])
+        TRANSITIONS.inc(key[2], 'cleared')
+        event = dict(alarm, event="cleared", value=value, cleared_at=datetime.now().isoformat())
+        self.events.append(event)
+        print(f"✅ CLEARED {key[2]} on {key[0]} slave {key[1]}")
+        return event
+
+    def active_alarms(self, device=None, severity=None):
+        with self.lock:
+            if device is not None:
+                alarms = [self.active[k] for k in self.by_device.get(device, ())]
+            else:
+                alarms = list(self.active.values())
+        if severity is not None:
+            alarms = [a for a in alarms if a['severity'] == severity]
+        return [dict(a) for a in alarms]
+
+    def recent_events(self, limit=100):
+        with self.lock:
+            return list(self.events)[-limit:]
+
+
+def alarms_view(engine, req):
+    """Body for ``GET /api/alarms`` (``?device=&severity=&events=``)."""
+    return {
+        "active": engine.active_alarms(req.args.get('device'), req.args.get('severity')),
+        "events": engine.recent_events(req.args.get('events', 100, type=int)),
+    }
@@ -0,0 +1,68 @@
+"""
+Raw capture of device traffic, for ``replay_traffic.py``.
+
+With ``BMS_CAPTURE=<file>`` every body posted to an ingest route, every raw
+TCP read and every UDP datagram is appended to ``<file>`` as one JSON line,
+byte for byte and before rate limiting or dedup, so retries and floods are
+recorded too:
+
+    {"t": 1718000000.123, "transport": "http", "path": "/update",
+     "content_type": "application/x-www-form-urlencoded", "peer": "10.0.0.7",
+     "body": "data=%7B%22slaves%22..."}
+
+Bodies that are not UTF-8 go to ``body_b64`` instead.  Capture is off
+(and costs nothing) when the variable is unset.
+"""
+import base64
+import json
+import os
+import threading
+import time
+
+CAPTURE_FILE = os.environ.get('BMS_CAPTURE')
+ROUTES = ('/update', '/api/update')
+
+
+class Capture:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+        print(f"🎙️ Capturing device traffic to {path}")
+
+    def write(self, transport, peer, body, path=None, content_type=None):
+        line = {"t": round(time.time(), 6), "transport": transport, "peer": peer}
+        if path is not None:
+            line["path"] = path
+        if content_type:
+            line["content_type"] = content_type
+        try:
+            line["body"] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            line["body_b64"] = base64.b64encode(body).decode()
+        blob = json.dumps(line) + '\n'
+        with self.lock:
+            self.file.write(blob)
+            self.file.flush()
+
+
+capture = Capture(CAPTURE_FILE) if CAPTURE_FILE else None
+
+
+def install(app, routes=ROUTES):
+    """Capture POST bodies to ``routes`` of a Flask app (no-op unless BMS_CAPTURE is set)."""
+    if capture is None:
+        return
+    from flask import request
+
+    @app.before_request
+    def _capture_body():
+        if request.method == 'POST' and request.path in routes:
+            # cache=True: the route can still read the body / parse the form
+            capture.write('http', request.remote_addr, request.get_data(cache=True),
+                          request.path, request.content_type)
+
+
+def record_frame(transport, peer, data):
+    if capture is not None:
+        capture.write(transport, peer, data)
@@ -0,0 +1,274 @@
+"""
+Compressed, block-indexed cold storage for closed day files.
+
+``compact_day()`` turns ``data/<type>_<date>.jsonl`` into
+
+    <type>_<date>.blk        independently zlib-compressed blocks of
+                             ~BLOCK_BYTES of JSON lines each
+    <type>_<date>.blk.idx    JSON index: per block its byte offset/length,
+                             entry count, first/last timestamp and the
+                             device ids, slave ids and streams it contains
+
+and removes the ``.jsonl`` once the block file has been verified.  Delta
+lines (``bms_delta``) are expanded to full entries first so every block
+decodes on its own; zlib recovers the redundancy anyway.
+
+``read_range()`` consults the index and decompresses only the blocks that
+overlap the requested time range (and device, if given); ``state_at()``
+walks blocks backwards from a timestamp and stops as soon as every stream
+in the index has been found.
+
+A line written to a day after it was compacted (a clock set back, a
+manual run) lands in a fresh ``.jsonl`` next to the ``.blk``.  Readers
+serve both (``read_day()`` / ``day_state_at()``) and the next compaction
+folds the late lines into the block file.  Today's file is never
+compacted, since it is still being written.
+
+Run as a job:
+
+    python bms_coldstore.py --data-dir data --min-age-days 1
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from datetime import date, timedelta
+from itertools import chain
+
+import bms_delta
+
+BLOCK_BYTES = 256 * 1024
+COMPRESS_LEVEL = 9
+INDEX_VERSION = 1
+
+_DAY_FILE = re.compile(r'^(?P<type>.+)_(?P<date>\d{4}-\d{2}-\d{2})\.jsonl$')
+
+
+def block_path(data_dir, data_type, date_str):
+    return os.path.join(data_dir, f"{data_type}_{date_str}.blk")
+
+
+def _ids(entry):
+    data = entry.get("data")
+    devices, slaves = set(), set()
+    if not isinstance(data, dict):
+        return devices, slaves
+    if data.get("device") is not None:
+        devices.add(str(data["device"]))
+    if data.get("slave") is not None:
+        slaves.add(data["slave"])
+    for s in data.get("slaves") or ():
+        if isinstance(s, dict) and s.get("id") is not None:
+            slaves.add(s["id"])
+    return devices, slaves
+
+
+def compact_day(jsonl_path, block_bytes=BLOCK_BYTES, level=COMPRESS_LEVEL, remove=True):
+    """Compact one closed day file; returns the index written.
+
+    If the day was compacted before, its blocks and the late lines are
+    merged in timestamp order into a new block file.
+    """
+    out_path = jsonl_path[:-len('.jsonl')] + '.blk'
+    tmp_path = out_path + '.tmp'
+    blocks = []
+    raw_bytes = 0
+    entries = bms_delta.read_log(jsonl_path)
+    if os.path.exists(out_path):
+        entries = sorted(chain(read_range(out_path), entries), key=lambda e: e.get("timestamp", ""))
+
+    with open(tmp_path, 'wb') as out:
+        buf, count, t_min, t_max = [], 0, None, None
+        devices, slaves, streams = set(), set(), set()
+
+        def flush():
+            nonlocal buf, count, t_min, t_max, devices, slaves, streams
+            if not buf:
+                return
+            payload = zlib.compress(''.join(buf).encode('utf-8'), level)
+            blocks.append({
+                "offset": out.tell(), "length": len(payload), "count": count,
+                "t_min": t_min, "t_max": t_max,
+                "devices": sorted(devices), "slaves": sorted(slaves, key=str),
+                "streams": sorted(streams),
+            })
+            out.write(payload)
+            buf, count, t_min, t_max = [], 0, None, None
+            devices, slaves, streams = set(), set(), set()
+
+        size = 0
+        for entry in entries:
+            line = json.dumps(entry) + '\n'
+            buf.append(line)
+            size += len(line)
+            raw_bytes += len(line)
+            count += 1
+            ts = entry.get("timestamp")
+            if ts is not None:
+                t_min = ts if t_min is None or ts < t_min else t_min
+                t_max = ts if t_max is None or ts > t_max else t_max
+            d, s = _ids(entry)
+            devices |= d
+            slaves |= s
+            streams.add(bms_delta.stream_key(entry))
+            if size >= block_bytes:
+                flush()
+                size = 0
+        flush()
+
+    index = {
+        "version": INDEX_VERSION, "codec": "zlib", "source": os.path.basename(jsonl_path),
+        "entries": sum(b["count"] for b in blocks), "raw_bytes": raw_bytes,
+        "compressed_bytes": sum(b["length"] for b in blocks), "blocks": blocks,
+    }
+    # Verify before anything is deleted
+    with open(tmp_path, 'rb') as f:
+        for b in blocks:
+            f.seek(b["offset"])
+            zlib.decompress(f.read(b["length"]))
+    with open(out_path + '.idx.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, out_path)
+    os.replace(out_path + '.idx.tmp', out_path + '.idx')
+    if remove:
+        os.remove(jsonl_path)
+        if os.path.exists(jsonl_path + '.idx'):
+            os.remove(jsonl_path + '.idx')      # bms_logindex sidecar
+    return index
+
+
+def load_index(blk_path):
+    with open(blk_path + '.idx') as f:
+        return json.load(f)
+
+
+def _wanted(entry, start, end, device):
+    ts = entry.get("timestamp")
+    if start is not None and ts is not None and ts < start:
+        return False
+    if end is not None and ts is not None and ts > end:
+        return False
+    # The index keeps device ids as text, so numeric ids are compared the same way
+    dev = entry["data"].get("device") if isinstance(entry.get("data"), dict) else None
+    return device is None or dev is None or str(dev) == device
+
+
+def read_range(blk_path, start=None, end=None, device=None):
+    """Yield entries with ``start <= timestamp <= end`` from a block file."""
+    device = None if device is None else str(device)
+    index = load_index(blk_path)
+    with open(blk_path, 'rb') as f:
+        for b in index["blocks"]:
+            if start is not None and b["t_max"] is not None and b["t_max"] < start:
+                continue
+            if end is not None and b["t_min"] is not None and b["t_min"] > end:
+                continue
+            if device is not None and b["devices"] and device not in b["devices"]:
+                continue
+            f.seek(b["offset"])
+            for line in zlib.decompress(f.read(b["length"])).decode('utf-8').splitlines():
+                entry = json.loads(line)
+                if _wanted(entry, start, end, device):
+                    yield entry
+
+
+def read_day(blk_path, jsonl_path, start=None, end=None, device=None):
+    """``read_range()`` plus lines written to ``jsonl_path`` after the day was compacted."""
+    yield from read_range(blk_path, start, end, device)
+    if os.path.exists(jsonl_path):
+        device = None if device is None else str(device)
+        yield from (e for e in bms_delta.read_log(jsonl_path) if _wanted(e, start, end, device))
+
+
+def state_at(blk_path, timestamp):
+    """Latest entry of every stream at or before ``timestamp``."""
+    index = load_index(blk_path)
+    candidates = [b for b in index["blocks"] if b["t_min"] is None or b["t_min"] <= timestamp]
+    wanted = set()
+    for b in candidates:
+        wanted.update(b["streams"])
+    latest = {}
+    with open(blk_path, 'rb') as f:
+        for b in reversed(candidates):
+            f.seek(b["offset"])
+            entries = [json.loads(line) for line in
+                       zlib.decompress(f.read(b["length"])).decode('utf-8').splitlines()]
+            for entry in reversed(entries):
+                if entry.get("timestamp", "") > timestamp:
+                    continue
+                latest.setdefault(bms_delta.stream_key(entry), entry)
+            if wanted <= latest.keys():
+                break
+    return sorted(latest.values(), key=lambda e: e["timestamp"])
+
+
+def day_state_at(blk_path, jsonl_path, timestamp):
+    """``state_at()`` over a compacted day and any late lines in ``jsonl_path``."""
+    latest = {}
+    late = bms_delta.state_at(jsonl_path, timestamp) if os.path.exists(jsonl_path) else []
+    for entry in state_at(blk_path, timestamp) + late:
+        key = bms_delta.stream_key(entry)
+        if key not in latest or entry["timestamp"] >= latest[key]["timestamp"]:
+            latest[key] = entry
+    return sorted(latest.values(), key=lambda e: e["timestamp"])
+
+
+def compact_closed_days(data_dir, min_age_days=1, verbose=True):
+    """Compact every day file at least ``min_age_days`` old; returns a summary per file.
+
+    A file that fails is logged, listed with its ``"error"`` and left as
+    ``.jsonl`` for the next run; the remaining files are still compacted.
+    """
+    # Never today's file: it is still being appended to
+    cutoff = (date.today() - timedelta(days=max(min_age_days, 1))).isoformat()
+    done = []
+    for name in sorted(os.listdir(data_dir)):
+        m = _DAY_FILE.match(name)
+        if not m or m.group('date') > cutoff:
+            continue
+        path = os.path.join(data_dir, name)
+        t0 = time.perf_counter()
+        try:
+            index = compact_day(path)
+        except Exception as e:
+            # One corrupt or unreadable day must not hold back the ones after it
+            print(f"⚠️ Could not compact {name}: {e}")
+            try:
+                os.remove(path[:-len('.jsonl')] + '.blk.tmp')
+            except OSError:
+                pass
+            done.append({"file": name, "error": str(e)})
+            continue
+        ratio = index["raw_bytes"] / index["compressed_bytes"] if index["compressed_bytes"] else 0
+        done.append({"file": name, "entries": index["entries"], "blocks": len(index["blocks"]),
+                     "ratio": round(ratio, 1), "seconds": round(time.perf_counter() - t0, 3)})
+        if verbose:
+            print(f"🧊 Compacted {name}: {index['entries']} entries, {len(index['blocks'])} blocks, "
+                  f"{index['raw_bytes']} → {index['compressed_bytes']} bytes ({ratio:.1f}x)")
+    return done
+
+
+def start_compactor(data_dir, interval_s=3600, min_age_days=1):
+    """Background thread that compacts closed days once an ``interval_s``."""
+    def loop():
+        while True:
+            try:
+                compact_closed_days(data_dir, min_age_days)
+            except Exception as e:
+                print(f"⚠️ Compaction failed: {e}")
+            time.sleep(interval_s)
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compact closed day files into compressed block files")
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--min-age-days', type=int, default=1)
+    args = parser.parse_args()
+    compact_closed_days(args.data_dir, args.min_age_days)
@@ -0,0 +1,200 @@
+"""
+Versioned ESP32 config store with change-only pushes.
+
+Keeps, per device, the *desired* config (what the operator last saved) and
+the *reported* config (what the device last said it runs), each with a
+content hash.  Every change that actually alters the desired config bumps
+a store-wide version and appends ``{version, device, diff}`` to a bounded
+history; saving an identical config is a no-op and does not touch the
+file.  The file is replaced atomically (write temp, fsync, rename), so a
+crash mid-save leaves the previous version intact.
+
+Pushing a new network config makes the firmware restart its Ethernet
+stack, so :func:`push` only calls the device when its reported config
+differs from what is being saved:
+
+    changes, resp = bms_config.push(store, device, new_config, send)
+    # resp is None when the device already runs new_config
+
+Empty form fields mean "leave unchanged", like the firmware treats them.
+An old flat ``device_config.json`` is imported as device ``"default"``.
+"""
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+import bms_metrics as metrics
+
+FIELDS = ('localIP', 'gateway', 'subnet', 'serverIP', 'serverPort',
+          'modbusInterval', 'networkInterval')
+INT_FIELDS = ('serverPort', 'modbusInterval', 'networkInterval')
+DEFAULT_DEVICE = 'default'
+HISTORY_KEEP = 200
+
+PUSHES = metrics.Counter('bms_config_pushes_total', 'Config pushes to devices by outcome', ('outcome',))
+
+
+def normalize(config):
+    """Canonical form: empty values dropped, strings stripped, intervals/ports as ints."""
+    out = {}
+    for key, value in (config or {}).items():
+        if isinstance(value, str):
+            value = value.strip()
+            if key in INT_FIELDS and value.lstrip('-').isdigit():
+                value = int(value)
+        if value is None or value == '':
+            continue
+        out[key] = value
+    return out
+
+
+def config_hash(config):
+    blob = json.dumps(normalize(config), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+
+def diff(old, new):
+    """``{key: [old, new]}`` for every key of ``new`` whose value differs from ``old``."""
+    old = normalize(old)
+    return {k: [old.get(k), v] for k, v in normalize(new).items() if old.get(k) != v}
+
+
+class ConfigStore:
+    def __init__(self, path, defaults=None, history_keep=HISTORY_KEEP):
+        self.path = path
+        self.defaults = normalize(defaults)
+        self.history_keep = history_keep
+        self.lock = threading.Lock()
+        self.version = 0
+        self.devices = {}       # device -> {config, hash, version, reported, reported_hash, reported_at}
+        self.history = []
+        self.load()
+
+    # ─── persistence ───────────────────────────────────────────────
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Could not load {self.path}: {e}")
+            return
+        if "devices" not in saved:
+            # Flat config from before the store existed
+            saved = {"version": 1, "devices": {DEFAULT_DEVICE: {
+                "config": normalize(saved), "hash": config_hash(saved), "version": 1}}}
+        self.version = saved.get("version", 0)
+        self.devices = saved["devices"]
+        self.history = saved.get("history", [])
+
+    def _save(self):
+        # Caller holds the lock
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({"version": self.version, "devices": self.devices, "history": self.history},
+                      f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    # ─── desired / reported ────────────────────────────────────────
+    def desired(self, device=DEFAULT_DEVICE):
+        with self.lock:
+            entry = self.devices.get(device)
+            return dict(entry["config"]) if entry else dict(self.defaults)
+
+    def set_desired(self, device, new_config):
+        """Merge ``new_config`` into the device's desired config; returns the diff ({} if unchanged)."""
+        with self.lock:
+            entry = self.devices.get(device)
+            current = entry["config"] if entry else self.defaults
+            changes = diff(current, new_config)
+            if not changes:
+                return {}
+            config = dict(current)
+            config.update({k: v for k, (_, v) in changes.items()})
+            self.version += 1
+            entry = self.devices.setdefault(device, {})
+            entry.update(config=config, hash=config_hash(config), version=self.version)
+            self.history.append({"version": self.version, "device": device,
+                                 "at": datetime.now().isoformat(timespec='seconds'), "diff": changes})
+            del self.history[:-self.history_keep]
+            self._save()
+            return changes
+
+    def reported(self, device=DEFAULT_DEVICE):
+        """Last config the device reported, or ``None`` if it never did."""
+        with self.lock:
+            entry = self.devices.get(device) or {}
+            return dict(entry["reported"]) if "reported" in entry else None
+
+    def record_reported(self, device, reported):
+        """Remember what the device says it runs (saved only when it changed)."""
+        reported = normalize(reported)
+        h = config_hash(reported)
+        with self.lock:
+            entry = self.devices.setdefault(device, {"config": dict(self.defaults),
+                                                     "hash": config_hash(self.defaults), "version": 0})
+            if entry.get("reported_hash") == h:
+                return
+            entry.update(reported=reported, reported_hash=h,
+                         reported_at=datetime.now().isoformat(timespec='seconds'))
+            self._save()
+
+    def record_applied(self, device, applied):
+        """The device accepted ``applied``: fold it into what it reports."""
+        with self.lock:
+            reported = dict((self.devices.get(device) or {}).get("reported") or {})
+        reported.update(normalize(applied))
+        self.record_reported(device, reported)
+
+    def pending(self, device=DEFAULT_DEVICE, config=None):
+        """Fields the device still has to get (``None`` while its config is unknown)."""
+        with self.lock:
+            entry = self.devices.get(device) or {}
+            if "reported" not in entry:
+                return None
+            target = config if config is not None else entry.get("config", self.defaults)
+            return diff(entry["reported"], target)
+
+    def info(self, device=DEFAULT_DEVICE):
+        with self.lock:
+            entry = self.devices.get(device) or {}
+            known = "reported" in entry
+            return {"device": device, "version": entry.get("version", 0),
+                    "hash": entry.get("hash", config_hash(self.defaults)),
+                    "reported_hash": entry.get("reported_hash"),
+                    "in_sync": known and not diff(entry["reported"], entry.get("config", self.defaults))}
+
+    def changes(self, device=None, since=0):
+        with self.lock:
+            return [h for h in self.history
+                    if h["version"] > since and (device is None or h["device"] == device)]
+
+
+def push(store, device, new_config, send):
+    """Save ``new_config`` for ``device`` and ``send(config)`` it only if the device differs.
+
+    Returns ``(changes, response)``; ``response`` is ``None`` when the push
+    was skipped.  ``send`` returns a ``requests`` response and any
+    exception it raises propagates.
+    """
+    store.set_desired(device, new_config)
+    changes = store.pending(device, new_config)
+    if changes == {}:
+        PUSHES.inc('skipped')
+        return changes, None
+    try:
+        resp = send(new_config)
+    except Exception:
+        PUSHES.inc('failed')
+        raise
+    if resp.ok:
+        PUSHES.inc('sent')
+        store.record_applied(device, new_config)
+    else:
+        PUSHES.inc('failed')
+    return (changes if changes is not None else diff({}, new_config)), resp
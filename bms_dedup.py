@@ -0,0 +1,132 @@
+"""
+Idempotent ingest: drop retried packets before they reach the store.
+
+The ESP32 retries ``/update`` when the ``Connection: close`` ACK times out,
+so the same sample can arrive twice.  Packets that carry a message id
+(``"msg_id"``) or a per-device sequence number (``"seq"``) are checked
+against a bounded, time-expiring set in O(1); a repeat is ACKed but not
+stored.  Packets with neither are always accepted.
+
+A key is remembered as soon as it is checked, so two copies racing in
+cannot both be stored; if storing the packet then fails, the server calls
+:meth:`DedupCache.forget` so the device's retry is stored instead of being
+ACKed as a duplicate.
+
+An ESP32 starts ``seq`` over after a reboot (a config push or OTA is
+enough), which would make fresh samples look like repeats for the whole
+TTL.  A packet may carry a ``"boot"`` id, which becomes part of its key;
+without one, a ``seq`` that falls back to 0 or more than ``SEQ_REORDER``
+below the device's highest is taken as a restart and starts a new key
+epoch for that device (like ``bms_loss.RESTART_GAP``, but tighter: a
+retry repeats the latest few numbers, never old ones).
+
+The set is an insertion-ordered dict of key -> expiry: expired keys are
+evicted from the front as new keys arrive, and the oldest key is dropped
+once ``max_entries`` is reached, so memory stays bounded under any load.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import bms_metrics as metrics
+from bms_records import id_text
+
+DEDUP_TTL_S = 300.0
+DEDUP_MAX_ENTRIES = 100_000
+SEQ_REORDER = 16             # how far back a genuine retry / reordered packet can be
+
+CHECKS = metrics.Counter('bms_dedup_checks_total', 'Dedup lookups by result', ('result',))
+SEQ_RESTARTS = metrics.Counter('bms_dedup_seq_restarts_total', 'Devices whose seq started over', ())
+
+
+def message_key(data, device):
+    """Dedup key for a decoded packet, or None if it carries no id."""
+    if not isinstance(data, dict):
+        return None
+    msg_id = data.get('msg_id')
+    if msg_id is not None:
+        return (device, 'id', _part(msg_id))
+    seq = data.get('seq')
+    if seq is not None:
+        boot = data.get('boot')
+        if boot is not None:
+            return (device, 'seq', _part(seq), _part(boot))
+        return (device, 'seq', _part(seq))
+    return None
+
+
+def _part(value):
+    return value if isinstance(value, (str, int, float)) else id_text(value)
+
+
+class DedupCache:
+    def __init__(self, ttl_s=DEDUP_TTL_S, max_entries=DEDUP_MAX_ENTRIES):
+        self.ttl = ttl_s
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()     # key -> expiry (monotonic)
+        self.seqs = {}                   # (device[, boot]) -> [highest seq, epoch]
+        self.hits = 0
+        self.misses = 0
+        metrics.Gauge('bms_dedup_hit_ratio', 'Share of id-carrying packets dropped as duplicates',
+                      fn=self.hit_ratio)
+        metrics.Gauge('bms_dedup_entries', 'Message ids currently remembered', fn=lambda: len(self.entries))
+
+    def is_duplicate(self, key, now=None):
+        """Record ``key`` and report whether it was already seen within the TTL."""
+        if key is None:
+            return False
+        now = time.monotonic() if now is None else now
+        entries = self.entries
+        with self.lock:
+            key = self._epoch_key(key, advance=True)
+            while entries:
+                oldest, expiry = next(iter(entries.items()))
+                if expiry > now and len(entries) < self.max_entries:
+                    break
+                del entries[oldest]
+            expiry = entries.get(key)
+            if expiry is not None and expiry > now:
+                self.hits += 1
+                CHECKS.inc('duplicate')
+                return True
+            entries[key] = now + self.ttl
+            entries.move_to_end(key)
+            self.misses += 1
+        CHECKS.inc('new')
+        return False
+
+    def forget(self, key):
+        """Drop ``key`` again: its packet was checked but could not be stored."""
+        if key is None:
+            return
+        with self.lock:
+            self.entries.pop(self._epoch_key(key, advance=False), None)
+
+    def _epoch_key(self, key, advance):
+        if key[1] != 'seq' or type(key[2]) is not int:
+            return key
+        source, seq = (key[0],) + key[3:], key[2]
+        st = self.seqs.get(source)
+        if st is None:
+            if not advance:
+                return key + (0,)
+            if len(self.seqs) >= self.max_entries:
+                del self.seqs[next(iter(self.seqs))]
+            st = self.seqs[source] = [seq, 0]
+        elif advance:
+            if seq < st[0] - SEQ_REORDER or seq == 0 < st[0]:
+                st[0] = seq
+                st[1] += 1
+                SEQ_RESTARTS.inc()
+            elif seq > st[0]:
+                st[0] = seq
+        return key + (st[1],)
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": round(self.hit_ratio(), 6),
+                "entries": len(self.entries), "ttl_s": self.ttl, "max_entries": self.max_entries}
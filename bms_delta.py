@@ -0,0 +1,255 @@
+"""
+Change-only storage for slowly varying BMS fields.
+
+``soh``, ``cycles``, ``warn``/``prot`` and capacity change perhaps once an
+hour but arrive in every 500 ms packet.  In delta mode each (device, slave)
+stream remembers its last full record and stores only the fields that
+changed since, with a full keyframe every ``KEYFRAME_EVERY`` samples (and
+always as the first sample of a stream, so every day file and every fresh
+in-memory history is self-contained).
+
+Both stores are covered:
+
+  * in memory – ``new_history()`` returns a :class:`DeltaHistory` (a list of
+    :class:`DeltaRecord`) instead of a plain list of ``SlaveRecord``;
+  * day files – ``DayLogEncoder`` writes delta lines that ``read_log()``
+    expands back into full entries.
+
+Readers never see deltas: ``iter_records()``, ``DeltaHistory.at()``,
+``read_log()`` and ``state_at()`` all reconstruct full records.
+
+Select the mode with ``BMS_STORAGE_MODE=delta`` (default ``full``).
+
+In-memory histories are ring buffers of at most ``HISTORY_MAX`` records
+(``BMS_HISTORY_MAX``): a plain ``deque`` in full mode; in delta mode the
+oldest entries are dropped in chunks and the first surviving delta of each
+stream is promoted to a keyframe, so the history still decodes on its own.
+"""
+import json
+import os
+import threading
+from bisect import bisect_right
+from collections import deque
+
+from bms_records import METRICS, SlaveRecord, parse_time
+
+STORAGE_MODE = os.environ.get('BMS_STORAGE_MODE', 'full')
+KEYFRAME_EVERY = 120
+HISTORY_MAX = int(os.environ.get('BMS_HISTORY_MAX', 200_000))
+
+_FIELDS = ('connected',) + METRICS
+
+
+class DeltaRecord:
+    __slots__ = ('ts_ns', 'sample_ns', 'device', 'slave', 'keyframe', 'fields')
+
+    def __init__(self, ts_ns, device, slave, keyframe, fields, sample_ns=None):
+        self.ts_ns = ts_ns
+        self.sample_ns = sample_ns    # per packet, so never delta-encoded
+        self.device = device
+        self.slave = slave
+        self.keyframe = keyframe
+        self.fields = fields          # changed field -> value (all fields on a keyframe)
+
+
+class DeltaEncoder:
+    def __init__(self, keyframe_every=KEYFRAME_EVERY):
+        self.keyframe_every = keyframe_every
+        self.last = {}                # (device, slave) -> [values tuple, samples since keyframe]
+
+    def encode(self, rec):
+        values = tuple(getattr(rec, f) for f in _FIELDS)
+        key = (rec.device, rec.slave)
+        prev = self.last.get(key)
+        if prev is None or prev[1] + 1 >= self.keyframe_every:
+            self.last[key] = [values, 0]
+            return DeltaRecord(rec.ts_ns, rec.device, rec.slave, True,
+                               {f: v for f, v in zip(_FIELDS, values) if v is not None}, rec.sample_ns)
+        changed = {f: v for f, v, old in zip(_FIELDS, values, prev[0]) if v != old}
+        prev[0] = values
+        prev[1] += 1
+        return DeltaRecord(rec.ts_ns, rec.device, rec.slave, False, changed, rec.sample_ns)
+
+
+class DeltaDecoder:
+    def __init__(self):
+        self.state = {}               # (device, slave) -> dict of current field values
+
+    def apply(self, delta):
+        key = (delta.device, delta.slave)
+        if delta.keyframe:
+            current = self.state[key] = dict(delta.fields)
+        else:
+            current = self.state.setdefault(key, {})
+            current.update(delta.fields)
+        return SlaveRecord(delta.ts_ns, delta.device, delta.slave,
+                           current.get('connected', True), delta.sample_ns,
+                           **{m: current.get(m) for m in METRICS})
+
+
+class DeltaHistory(list):
+    """In-memory history holding :class:`DeltaRecord` s.
+
+    ``append``/``extend`` take full ``SlaveRecord`` s and encode them; list
+    length and indexing expose the compact entries, while ``iter_records()``
+    and ``at()`` hand back full records.
+    """
+
+    def __init__(self, keyframe_every=KEYFRAME_EVERY, maxlen=None):
+        super().__init__()
+        self.encoder = DeltaEncoder(keyframe_every)
+        self.maxlen = maxlen
+        self.lock = threading.Lock()
+
+    def append(self, rec):
+        with self.lock:
+            super().append(self.encoder.encode(rec))
+            self._trim()
+
+    def extend(self, records):
+        with self.lock:
+            super().extend([self.encoder.encode(r) for r in records])
+            self._trim()
+
+    def _trim(self):
+        # Trim in chunks of maxlen/8 so the re-keyframing cost is amortized
+        if self.maxlen is None or len(self) <= self.maxlen + self.maxlen // 8:
+            return
+        cut = len(self) - self.maxlen
+        decoder = DeltaDecoder()
+        for delta in self[:cut]:
+            decoder.apply(delta)
+        pending = set(decoder.state)
+        for i in range(cut, len(self)):
+            if not pending:
+                break
+            delta = self[i]
+            key = (delta.device, delta.slave)
+            if key not in pending:
+                continue
+            pending.discard(key)
+            if not delta.keyframe:
+                decoder.apply(delta)
+                self[i] = DeltaRecord(delta.ts_ns, delta.device, delta.slave, True,
+                                      {f: v for f, v in decoder.state[key].items() if v is not None},
+                                      delta.sample_ns)
+        del self[:cut]
+
+    def iter_records(self):
+        decoder = DeltaDecoder()
+        for delta in list(self):
+            yield decoder.apply(delta)
+
+    def at(self, ts_ns):
+        """Latest full record of every slave at or before ``ts_ns``."""
+        entries = list(self)
+        end = bisect_right(entries, ts_ns, key=lambda d: d.ts_ns)
+        decoder = DeltaDecoder()
+        latest = {}
+        for delta in entries[:end]:
+            latest[(delta.device, delta.slave)] = decoder.apply(delta)
+        return list(latest.values())
+
+
+def new_history(maxlen=HISTORY_MAX):
+    if STORAGE_MODE == 'delta':
+        return DeltaHistory(maxlen=maxlen)
+    return deque(maxlen=maxlen)
+
+
+def iter_records(store):
+    """Full ``SlaveRecord`` s of a history, whatever its storage mode."""
+    if isinstance(store, DeltaHistory):
+        return store.iter_records()
+    return iter(list(store))
+
+
+def records_at(store, ts_ns):
+    """Latest full record of every slave at or before epoch-ns ``ts_ns``."""
+    if isinstance(store, DeltaHistory):
+        return store.at(ts_ns)
+    records = list(store)
+    latest = {}
+    for rec in records[:bisect_right(records, ts_ns, key=lambda r: r.ts_ns)]:
+        latest[(rec.device, rec.slave)] = rec
+    return list(latest.values())
+
+
+# ─────────────────────────────────────────────────────────────────────
+#  Day files
+# ─────────────────────────────────────────────────────────────────────
+# A delta line:  {"timestamp": ..., "d": device, "s": slave, "k": 1, "f": {...}}
+# ("k" only on keyframes).  Anything else is a full entry {"timestamp", "data"}.
+
+class DayLogEncoder:
+    """Turns one logged payload into the lines to append to a day file."""
+
+    def __init__(self, keyframe_every=KEYFRAME_EVERY):
+        self.keyframe_every = keyframe_every
+        self.file_key = None
+        self.encoder = DeltaEncoder(keyframe_every)
+        self.lock = threading.Lock()
+
+    def lines(self, file_key, timestamp, device, data, records):
+        """Lines for one payload; ``records`` are its normalized slaves (may be empty)."""
+        if not any(getattr(r, m) is not None for r in records for m in METRICS):
+            # Not a BMS packet – nothing to delta against
+            return [json.dumps({"timestamp": timestamp, "data": data})]
+        out = []
+        with self.lock:
+            if file_key != self.file_key:
+                # Each day file starts with keyframes so it decodes on its own
+                self.file_key = file_key
+                self.encoder = DeltaEncoder(self.keyframe_every)
+            for rec in records:
+                delta = self.encoder.encode(rec)
+                line = {"timestamp": timestamp, "d": device, "s": rec.slave, "f": delta.fields}
+                if delta.keyframe:
+                    line["k"] = 1
+                out.append(json.dumps(line))
+        return out
+
+
+def expand_lines(lines, decoder=None):
+    """Yield full ``{"timestamp", "data"}`` entries from raw day-file lines."""
+    decoder = decoder or DeltaDecoder()
+    for line in lines:
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        if "f" not in entry:
+            yield entry
+            continue
+        rec = decoder.apply(DeltaRecord(parse_time(entry["timestamp"]), entry["d"], entry["s"],
+                                        bool(entry.get("k")), entry["f"]))
+        yield {"timestamp": entry["timestamp"], "data": rec.to_dict()}
+
+
+def read_log(path):
+    with open(path, 'r') as f:
+        yield from expand_lines(f)
+
+
+def stream_key(entry):
+    """Stream an entry belongs to: "device/slave" for records, "device" for raw packets."""
+    data = entry.get("data")
+    if isinstance(data, dict):
+        if data.get("v") and "slave" in data:
+            return f"{data.get('device')}/{data['slave']}"
+        return str(data.get("device"))
+    return "raw"
+
+
+def latest_per_stream(entries, timestamp):
+    """Latest entry of every stream at or before ``timestamp`` (entries in time order)."""
+    latest = {}
+    for entry in entries:
+        if entry["timestamp"] > timestamp:
+            break
+        latest[stream_key(entry)] = entry
+    return list(latest.values())
+
+
+def state_at(path, timestamp):
+    """Latest full entry of every stream in a day file at or before ``timestamp``."""
+    return latest_per_stream(read_log(path), timestamp)
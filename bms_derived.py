@@ -0,0 +1,208 @@
+"""
+Streaming derived metrics per slave: energy throughput (∫V·I dt), Ah in/out
+(coulomb counting), C-rate and SOC drift.
+
+``DerivedMetrics.update()`` is called from ``update()`` with the normalized
+records of each packet and touches only the running state of those slaves –
+O(1) per slave, no history rescans.  Samples are integrated with the
+trapezoid rule over the actual interval between them, taken on the device's
+own sample times (``sample_ns``) when the packets carry them, else on
+arrival time, so irregular or batched reporting is fine.  As for alarm
+slopes, an interval shorter than ``min_gap_s`` is not integrated on its own
+(the earlier sample stays the baseline) and one longer than ``max_gap_s`` is
+not integrated across (it is counted as gap time instead).  Totals are kept
+overall and per calendar day, and the whole state is snapshotted to
+``derived_state_<server>.json`` (``BMS_DERIVED_STATE``, with ``{name}`` for
+the server) so it survives restarts.
+
+Sign convention: positive current charges the pack (``CURRENT_SIGN`` flips it).
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from datetime import date, datetime
+
+DERIVED_STATE_FILE = os.environ.get('BMS_DERIVED_STATE', 'derived_state_{name}.json')
+LEGACY_STATE_FILE = 'derived_state.json'    # shared by every server before; read once if ours is missing
+NOMINAL_CAPACITY_AH = 100.0     # used until a pack reports capacity + SOC
+CURRENT_SIGN = 1
+MIN_GAP_S = 0.5
+MAX_GAP_S = 30.0
+KEEP_DAYS = 35
+SAVE_INTERVAL_S = 30.0
+
+_COUNTERS = ('wh_in', 'wh_out', 'ah_in', 'ah_out', 'seconds', 'gap_seconds')
+
+
+def _new_state():
+    return {
+        "last_t": None, "last_v": None, "last_i": None, "last_on_sample": False,
+        "c_rate": None, "capacity_ah": None,
+        "soc_anchor": None, "ah_since_anchor": 0.0, "soc_drift": None,
+        "total": dict.fromkeys(_COUNTERS, 0.0),
+        "days": {},
+    }
+
+
+def sample_time(rec, now):
+    """(epoch seconds, on the device's clock?) of a record: its ``sample_ns``, else ``now``."""
+    return (rec.sample_ns / 1e9, True) if rec.sample_ns is not None else (now, False)
+
+
+class DerivedMetrics:
+    def __init__(self, name, path=None, min_gap_s=MIN_GAP_S, max_gap_s=MAX_GAP_S):
+        self.path = path or DERIVED_STATE_FILE.format(name=name)
+        self.min_gap_s = min_gap_s
+        self.max_gap_s = max_gap_s
+        self.lock = threading.Lock()
+        self.state = {}            # "device/slave" -> running state
+        self.version = 0           # bumped per update; saved_version is what is on disk
+        self.saved_version = 0
+        self.load()
+        threading.Thread(target=self._save_loop, daemon=True).start()
+        atexit.register(self.save)
+
+    @staticmethod
+    def key(device, slave_id):
+        return f"{device}/{slave_id}"
+
+    def update(self, device, records, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            for rec in records:
+                v, i = rec.pack_voltage, rec.current
+                if v is None or i is None:
+                    continue
+                i *= CURRENT_SIGN
+                key = self.key(device, rec.slave)
+                st = self.state.get(key)
+                if st is None:
+                    st = self.state[key] = _new_state()
+                self._step(st, *sample_time(rec, now), v, i, rec)
+            self.version += 1
+
+    def _step(self, st, t, on_sample, v, i, rec):
+        today = date.fromtimestamp(t).isoformat()
+        day = st["days"].get(today)
+        if day is None:
+            day = st["days"][today] = dict.fromkeys(_COUNTERS, 0.0)
+            for old in sorted(st["days"])[:-KEEP_DAYS]:
+                del st["days"][old]
+
+        last_t = st["last_t"]
+        advance = True
+        if last_t is not None and st["last_on_sample"] == on_sample:
+            dt = t - last_t
+            if dt < -self.max_gap_s:
+                pass                      # the device clock jumped back: start over from here
+            elif dt < self.min_gap_s:
+                # A retry, a batched or out-of-order sample: keep the baseline so
+                # the next interval spans min_gap_s instead of one tiny dt
+                advance = False
+            elif dt <= self.max_gap_s:
+                # Trapezoid over the real interval
+                ah = (st["last_i"] + i) / 2.0 * dt / 3600.0
+                wh = (st["last_v"] * st["last_i"] + v * i) / 2.0 * dt / 3600.0
+                for bucket in (st["total"], day):
+                    if ah >= 0:
+                        bucket["ah_in"] += ah
+                    else:
+                        bucket["ah_out"] -= ah
+                    if wh >= 0:
+                        bucket["wh_in"] += wh
+                    else:
+                        bucket["wh_out"] -= wh
+                    bucket["seconds"] += dt
+                st["ah_since_anchor"] += ah
+            else:
+                st["total"]["gap_seconds"] += dt
+                day["gap_seconds"] += dt
+                st["soc_anchor"] = None   # coulomb count no longer trustworthy
+
+        soc, rem = rec.soc, rec.capacity_remaining
+        if soc and rem is not None and soc > 0:
+            st["capacity_ah"] = rem / (soc / 100.0)
+        capacity = st["capacity_ah"] or NOMINAL_CAPACITY_AH
+        st["c_rate"] = abs(i) / capacity
+
+        if soc is not None:
+            if st["soc_anchor"] is None:
+                st["soc_anchor"] = soc
+                st["ah_since_anchor"] = 0.0
+            expected = st["soc_anchor"] + 100.0 * st["ah_since_anchor"] / capacity
+            st["soc_drift"] = soc - expected
+
+        if advance:
+            st["last_t"], st["last_v"], st["last_i"], st["last_on_sample"] = t, v, i, on_sample
+
+    # ─── queries ───────────────────────────────────────────────────
+    def query(self, device=None, slave=None, day=None):
+        out = {}
+        with self.lock:
+            for key, st in self.state.items():
+                dev, _, sid = key.rpartition('/')
+                if device is not None and dev != device:
+                    continue
+                if slave is not None and sid != str(slave):
+                    continue
+                row = {
+                    "device": dev, "slave": sid,
+                    "c_rate": st["c_rate"], "capacity_ah": st["capacity_ah"],
+                    "soc_drift": st["soc_drift"],
+                    "last_sample": datetime.fromtimestamp(st["last_t"]).isoformat() if st["last_t"] else None,
+                    "total": _rounded(st["total"]),
+                }
+                if day is not None:
+                    row["day"] = _rounded(st["days"].get(day, dict.fromkeys(_COUNTERS, 0.0)))
+                else:
+                    row["days"] = {d: _rounded(c) for d, c in st["days"].items()}
+                out[key] = row
+        return out
+
+    # ─── persistence ───────────────────────────────────────────────
+    def load(self):
+        path = self.path if os.path.exists(self.path) else LEGACY_STATE_FILE
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Could not load {path}: {e}")
+            return
+        for key, st in saved.get("state", {}).items():
+            fresh = _new_state()
+            fresh.update(st)
+            self.state[key] = fresh
+        print(f"📈 Restored derived metrics for {len(self.state)} slaves from {path}")
+
+    def save(self):
+        with self.lock:
+            version = self.version
+            if version == self.saved_version:
+                return
+            blob = json.dumps({"saved_at": datetime.now().isoformat(), "state": self.state})
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(blob)
+        os.replace(tmp, self.path)
+        # Only now is the snapshot safe; a failed write leaves it due for the next round
+        with self.lock:
+            self.saved_version = max(self.saved_version, version)
+
+    def _save_loop(self):
+        while True:
+            time.sleep(SAVE_INTERVAL_S)
+            try:
+                self.save()
+            except Exception as e:
+                print(f"⚠️ Could not save {self.path}: {e}")
+
+
+def _rounded(counters):
+    out = {k: round(v, 6) for k, v in counters.items()}
+    out["kwh_in"] = round(counters["wh_in"] / 1000.0, 6)
+    out["kwh_out"] = round(counters["wh_out"] / 1000.0, 6)
+    return out
@@ -0,0 +1,186 @@
+"""
+Shape-preserving downsampling of one metric for trend charts
+(``GET /api/series``).
+
+A day of 500 ms samples is ~170k points per slave; a chart is ~1000 pixels
+wide.  Two reducers keep what fixed-bucket averages would hide:
+
+* ``lttb`` – Largest-Triangle-Three-Buckets: ``width`` points, each picked
+  from its bucket as the one forming the largest triangle with the
+  previous pick and the next bucket's average, so spikes survive;
+* ``minmax`` – the minimum and maximum of every pixel column, in time
+  order (up to ``2 × width`` points), which draws exactly the envelope.
+
+    /api/series?metric=V&device=esp-1&slave=3&last=24h&width=1200&algo=lttb
+
+Results are cached per (series, range, width, algo).  An open-ended range
+(``last=`` or no ``end``) ends at the last *completed* pixel column – so a
+dashboard polling every few seconds keeps hitting the cache until a new
+column is due, and a cached range never gains samples later.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import bms_metrics as metrics
+import bms_query
+from bms_query import QueryError
+from bms_records import format_ns
+
+DEFAULT_WIDTH = 1000
+MAX_WIDTH = 10_000
+CACHE_SIZE = 128
+_NS = 1_000_000_000
+
+CACHE = metrics.Counter('bms_series_cache_total', 'Downsampled series requests by cache result', ('result',))
+
+
+def lttb(xs, ys, threshold):
+    """Indices of the ``threshold`` points LTTB keeps."""
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    every = (n - 2) / (threshold - 2)
+    keep = [0]
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third triangle corner
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        span = avg_end - avg_start
+        avg_x = math.fsum(xs[avg_start:avg_end]) / span
+        avg_y = math.fsum(ys[avg_start:avg_end]) / span
+
+        ax, ay = xs[a], ys[a]
+        best, best_area = -1, -1.0
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        keep.append(best)
+        a = best
+    keep.append(n - 1)
+    return keep
+
+
+def minmax(xs, ys, width):
+    """Indices of the min and max of every one of ``width`` time columns."""
+    n = len(xs)
+    if n <= 2 * width:
+        return list(range(n))
+    x0 = xs[0]
+    pixel = (xs[-1] - x0) / width or 1.0
+    keep = []
+    col, lo, hi = None, 0, 0
+    for i in range(n):
+        c = min(int((xs[i] - x0) / pixel), width - 1)
+        if c != col:
+            if col is not None:
+                keep.extend(sorted({lo, hi}))
+            col, lo, hi = c, i, i
+        elif ys[i] < ys[lo]:
+            lo = i
+        elif ys[i] > ys[hi]:
+            hi = i
+    keep.extend(sorted({lo, hi}))
+    return keep
+
+
+ALGORITHMS = {'lttb': lttb, 'minmax': minmax}
+
+
+class SeriesCache:
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+_cache = SeriesCache()
+
+
+def _fmt(seconds):
+    return format_ns(round(seconds * 1000) * 1_000_000)
+
+
+def _closed_range(start, end, last, width):
+    """(start, end) in epoch ns, an open end snapped back to a completed pixel column."""
+    now = time.time_ns()
+    if last:
+        span = int(bms_query.parse_duration(last) * _NS)    # QueryError unless finite, 1 ms .. 10 years
+        pixel = max(span // width, _NS)
+        end = now // pixel * pixel
+        return end - span, end
+    start, end = bms_query.resolve_range(start, end)
+    if end is None or end > now:
+        pixel = _NS
+        if start is not None:
+            # Power-of-two seconds so the snap points stay put while "now" moves
+            pixel = _NS << max(math.ceil(math.log2(max((now - start) / _NS / width, 1.0))), 0)
+        end = now // pixel * pixel
+    return start, end
+
+
+def downsample(store, metric, device=None, slave=None, start=None, end=None, last=None,
+               width=DEFAULT_WIDTH, algo='lttb'):
+    name = bms_query.ALIASES.get(metric)
+    if name is None:
+        raise QueryError(f"unknown metric {metric!r}")
+    reducer = ALGORITHMS.get(algo)
+    if reducer is None:
+        raise QueryError(f"unknown algo {algo!r} (lttb or minmax)")
+    if not 3 <= width <= MAX_WIDTH:
+        raise QueryError(f"width must be between 3 and {MAX_WIDTH}")
+    start, end = _closed_range(start, end, last, width)
+
+    key = (id(store), name, device, slave, start, end, width, algo)
+    cached = _cache.get(key)
+    if cached is not None:
+        CACHE.inc('hit')
+        return dict(cached, cached=True)
+    CACHE.inc('miss')
+
+    series = []
+    cols = bms_query.columns(bms_query.select(store, start, end), name, device, slave)
+    for (dev, sl), (xs, ys) in sorted(cols.items(), key=lambda kv: str(kv[0])):
+        keep = reducer(xs, ys, width)
+        series.append({"device": dev, "slave": sl, "n": len(xs),
+                       "points": [[_fmt(xs[i]), ys[i]] for i in keep]})
+    result = {"metric": name, "algo": algo, "width": width, "start": format_ns(start), "end": format_ns(end),
+              "series": series}
+    _cache.put(key, result)
+    return dict(result, cached=False)
+
+
+def series_view(store, req):
+    """Body and status for ``GET /api/series``."""
+    a = req.args
+    if not a.get('metric'):
+        return {"error": "metric is required"}, 400
+    try:
+        width = int(a.get('width', DEFAULT_WIDTH))
+    except ValueError:
+        return {"error": f"bad width {a['width']!r}"}, 400
+    try:
+        return downsample(store, a['metric'], a.get('device'), a.get('slave'), a.get('start'),
+                          a.get('end'), a.get('last'), width, a.get('algo', 'lttb')), 200
+    except QueryError as e:
+        return {"error": str(e)}, 400
+    except (ValueError, OverflowError) as e:
+        # Range arithmetic on a value that got past the checks: still the client's input
+        return {"error": f"bad range: {e}"}, 400
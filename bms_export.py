@@ -0,0 +1,138 @@
+"""
+Streaming CSV export of logged BMS data over a time range spanning days.
+
+One row per slave per packet, with the record fields flattened into
+columns (``COLUMNS``).  Day files are read in order – hot ``.jsonl`` files
+through the mmap offset index (``bms_logindex``), delta files through
+``bms_delta.read_log()`` and compacted days through
+``bms_coldstore.read_range()`` – and rows are written to a small buffer
+that is flushed every ``CHUNK_BYTES``, so memory stays flat however long
+the range is.
+
+Every row starts with a ``cursor``.  To resume an interrupted export, send
+the cursor of the last complete row back with the *same* start/end/device:
+
+    <date>:b<byte offset>.<row>    plain day file, line at that offset
+    <date>:r<entry number>.<row>   delta or compacted day, n-th entry in range
+"""
+import csv
+import io
+import json
+import mmap
+import os
+import re
+from datetime import date, timedelta
+
+import bms_coldstore
+import bms_delta
+import bms_logindex
+import bms_records
+from bms_records import METRICS, SlaveRecord
+
+CHUNK_BYTES = 64 * 1024
+COLUMNS = ('cursor', 'timestamp', 'device', 'slave', 'connected') + METRICS
+
+_CURSOR = re.compile(r'^(\d{4}-\d{2}-\d{2}):([br])(\d+)\.(\d+)$')
+
+
+def parse_cursor(cursor):
+    """(day, kind, position, row) of a cursor; raises ValueError if malformed."""
+    m = _CURSOR.match(cursor or '')
+    if not m:
+        raise ValueError(f"bad cursor {cursor!r}")
+    return m.group(1), m.group(2), int(m.group(3)), int(m.group(4))
+
+
+def _days(start, end):
+    first = date.fromisoformat(start[:10])
+    last = date.fromisoformat(end[:10])
+    while first <= last:
+        yield first.isoformat()
+        first += timedelta(days=1)
+
+
+def entry_records(entry):
+    """Slave records of one logged entry (empty for non-BMS payloads)."""
+    data = entry.get("data")
+    if isinstance(data, dict) and data.get("v"):
+        records = [SlaveRecord.from_dict(data)]      # expanded delta line
+    else:
+        records = bms_records.normalize(data, bms_records.device_id(data, None),
+                                        bms_records.parse_time(entry["timestamp"]))
+    return [r for r in records if any(getattr(r, m) is not None for m in METRICS)]
+
+
+def _plain_entries(path, start, end, offset):
+    index = bms_logindex.refresh(path)
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos, stop = bms_logindex.byte_range(mm, index, start, end)
+        pos = max(pos, offset)
+        while pos < stop:
+            nl = mm.find(b'\n', pos, stop)
+            nl = stop if nl < 0 else nl
+            if nl > pos:
+                yield 'b', pos, json.loads(mm[pos:nl])
+            pos = nl + 1
+
+
+def _counted_entries(entries, skip):
+    for n, entry in enumerate(entries):
+        if n >= skip:
+            yield 'r', n, entry
+
+
+def _in_range(entries, start, end):
+    return (e for e in entries if start <= e["timestamp"] <= end)
+
+
+def day_entries(data_dir, data_type, day, start, end, kind=None, position=0):
+    """Yield ``(kind, position, entry)`` for one day, resuming at ``position``."""
+    path = os.path.join(data_dir, f"{data_type}_{day}.jsonl")
+    blk = bms_coldstore.block_path(data_dir, data_type, day)
+    if os.path.exists(path) and os.path.exists(blk):
+        # Late lines for a compacted day, not yet folded into its blocks
+        return _counted_entries(bms_coldstore.read_day(blk, path, start, end), position if kind == 'r' else 0)
+    if os.path.exists(path):
+        if not bms_logindex.refresh(path)["delta"]:
+            return _plain_entries(path, start, end, position if kind == 'b' else 0)
+        return _counted_entries(_in_range(bms_delta.read_log(path), start, end),
+                                position if kind == 'r' else 0)
+    if os.path.exists(blk):
+        return _counted_entries(bms_coldstore.read_range(blk, start, end), position if kind == 'r' else 0)
+    return iter(())
+
+
+def export_csv(data_dir, data_type, start, end, device=None, cursor=None, chunk_bytes=CHUNK_BYTES):
+    """Yield CSV text in chunks for every slave record with ``start <= timestamp <= end``.
+
+    A bare date as ``end`` covers that whole day.
+    """
+    if len(end) == 10:
+        end += "T23:59:59.999999"
+    resume = parse_cursor(cursor) if cursor else None
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if not resume:
+        writer.writerow(COLUMNS)
+    for day in _days(start, end):
+        if resume and day < resume[0]:
+            continue
+        kind, position, skip_rows = None, 0, -1
+        if resume and day == resume[0]:
+            kind, position, skip_rows = resume[1], resume[2], resume[3]
+        for kind_, pos, entry in day_entries(data_dir, data_type, day, start, end, kind, position):
+            records = entry_records(entry)
+            for row, rec in enumerate(records):
+                if pos == position and kind_ == kind and row <= skip_rows:
+                    continue
+                if device and rec.device != device:
+                    continue
+                # The day file's own text timestamp, exactly as logged
+                writer.writerow([f"{day}:{kind_}{pos}.{row}", entry["timestamp"], rec.device, rec.slave,
+                                 int(bool(rec.connected))] + [getattr(rec, m) for m in METRICS])
+            if buf.tell() >= chunk_bytes:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
@@ -0,0 +1,156 @@
+"""
+HTTP/1.1 keep-alive serving for the device ingest routes.
+
+Werkzeug's development server ends every response with ``Connection:
+close``, so an ESP32 reporting every 500 ms pays a TCP handshake per
+sample.  ``serve()`` runs the Flask app on a threaded Werkzeug server with
+:class:`KeepAliveHandler`, which keeps a connection open after requests to
+routes listed in ``routes`` – each with its own idle timeout and maximum
+number of requests per connection – and closes it after anything else
+(dashboard, config, firmware upload).
+
+    if bms_keepalive.ENABLED:                        # BMS_KEEPALIVE=1
+        bms_keepalive.serve(app, '0.0.0.0', 5000)
+
+A route can still force a close by returning a ``Connection: close``
+header; servers only do that when keep-alive is off.
+"""
+import os
+import socket
+
+from werkzeug.exceptions import InternalServerError
+from werkzeug.serving import WSGIRequestHandler, make_server
+from werkzeug.wsgi import LimitedStream
+
+ENABLED = os.environ.get('BMS_KEEPALIVE') == '1'
+FIRST_REQUEST_TIMEOUT_S = 15.0
+
+
+class Policy:
+    __slots__ = ('idle_s', 'max_requests')
+
+    def __init__(self, idle_s=15.0, max_requests=1000):
+        self.idle_s = idle_s
+        self.max_requests = max_requests
+
+
+# Path -> Policy; anything not listed is closed after one request
+DEFAULT_ROUTES = {
+    '/update':     Policy(),
+    '/api/update': Policy(),
+}
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = FIRST_REQUEST_TIMEOUT_S
+    routes = DEFAULT_ROUTES
+
+    def setup(self):
+        super().setup()
+        self.served = 0
+
+    # Werkzeug's own run_wsgi always sends "Connection: close" and then drains
+    # the socket, which would swallow the next request; hence this copy of it
+    def run_wsgi(self):
+        if self.headers.get("Expect", "").lower().strip(" \t") == "100-continue":
+            self.wfile.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+        self.environ = environ = self.make_environ()
+        self.served += 1
+        policy = self.routes.get(environ["PATH_INFO"])
+        body = None
+        length = environ.get("CONTENT_LENGTH", "")
+        if length.isdigit():
+            # Bound the body so unread bytes can be skipped before the next request
+            body = environ["wsgi.input"] = LimitedStream(self.rfile, int(length))
+        elif environ.get("wsgi.input_terminated"):
+            policy = None        # chunked upload: simplest to not reuse the connection
+        keep = (policy is not None and not self.close_connection
+                and self.served < policy.max_requests)
+
+        state = {"status": None, "headers": None, "sent": False, "chunked": False}
+
+        def write(data):
+            if not state["sent"]:
+                state["sent"] = True
+                code, _, msg = state["status"].partition(' ')
+                self.send_response(int(code), msg)
+                keys = set()
+                for key, value in state["headers"]:
+                    if key.lower() == 'connection':
+                        if value.lower() == 'close':
+                            state["keep"] = False
+                        continue
+                    self.send_header(key, value)
+                    keys.add(key.lower())
+                if "content-length" not in keys and environ["REQUEST_METHOD"] != "HEAD" \
+                        and int(code) not in (204, 304):
+                    if self.request_version >= "HTTP/1.1":
+                        state["chunked"] = True
+                        self.send_header("Transfer-Encoding", "chunked")
+                    else:
+                        state["keep"] = False    # HTTP/1.0 has no chunking: the close ends the body
+                self.send_header("Connection", "keep-alive" if state["keep"] else "close")
+                self.end_headers()
+            if data:
+                if state["chunked"]:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                else:
+                    self.wfile.write(data)
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and state["sent"]:
+                raise exc_info[1].with_traceback(exc_info[2])
+            state["status"], state["headers"] = status, headers
+            return write
+
+        def execute(app):
+            app_iter = app(environ, start_response)
+            try:
+                for data in app_iter:
+                    write(data)
+                if not state["sent"]:
+                    write(b"")
+                if state["chunked"]:
+                    self.wfile.write(b"0\r\n\r\n")
+            finally:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+
+        state["keep"] = keep
+        try:
+            execute(self.server.app)
+        except (ConnectionError, socket.timeout) as e:
+            self.connection_dropped(e, environ)
+            state["keep"] = False
+        except Exception as e:
+            self.server.log("error", f"Error on request {environ['PATH_INFO']}: {e!r}")
+            state["keep"] = False
+            if not state["sent"]:
+                try:
+                    execute(InternalServerError())
+                except Exception:
+                    pass
+        self.wfile.flush()
+
+        if state["keep"] and body is not None:
+            body.exhaust()
+        if state["keep"]:
+            self.connection.settimeout(policy.idle_s)
+        else:
+            self.close_connection = True
+
+
+def handler_for(routes):
+    """A handler class with its own route policies."""
+    return type('KeepAliveHandler', (KeepAliveHandler,), {'routes': routes})
+
+
+def serve(app, host, port, routes=None):
+    """Serve ``app`` with keep-alive on ``routes`` (default: the ingest routes)."""
+    handler = handler_for(routes) if routes is not None else KeepAliveHandler
+    server = make_server(host, port, app, threaded=True, request_handler=handler)
+    print(f"🔁 Keep-alive serving on http://{host}:{port} "
+          f"({', '.join(f'{p} idle {r.idle_s:g}s/max {r.max_requests}' for p, r in handler.routes.items())})")
+    server.serve_forever()
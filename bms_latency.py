@@ -0,0 +1,285 @@
+"""
+End-to-end latency tracing, from the device's sample to the dashboard poll
+that shows it (``GET /api/latency``).
+
+An accepted packet is stamped four times, all in epoch ns:
+
+* ``sample``  – the device's own ``"ts"`` (the records' ``sample_ns``), if it sent one;
+* ``recv``    – when the server took the packet (the records' ``ts_ns``);
+* ``commit``  – once the store append and journal write are done;
+* ``deliver`` – when a ``/data`` poll first hands it to a subscriber.
+
+The hops between the stamps go into HDR-style histograms per
+(hop, ingest path) and per (hop, ingest path, device):
+
+    network   sample -> recv      device clock vs server clock, so skew shows here
+    store     recv   -> commit
+    deliver   commit -> deliver   how long data waits for the next poll
+    total     sample -> deliver   (recv -> deliver when the device sends no ts)
+
+A subscriber is one polling client (remote address plus an optional
+``?client=`` tag).  Its first poll only places its cursor; every later poll
+records each packet committed since the one before, so a dashboard that
+polls every 2 s shows ~1 s of ``deliver`` on average.  Recent commits are
+kept in a ring of ``RING_SIZE`` packets; a subscriber that falls further
+behind than that is counted in ``bms_latency_missed_total``.
+
+Histograms keep ``SUB_BITS`` significant bits per power of two of
+microseconds (128 sub-buckets, < 0.8 % relative error from 1 µs to
+hours) in a sparse dict, so a percentile is exact to the bucket, not to
+a fixed bucket list.
+``BMS_TRACE=0`` turns tracing off.
+
+    /api/latency                      per hop and ingest path
+    /api/latency?by=device&hop=total  ...and per device
+    /data?trace=1                     each item with its sample/recv/commit/deliver stamps
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import bms_metrics as metrics
+from bms_records import format_ns
+
+ENABLED = os.environ.get('BMS_TRACE', '1') != '0'
+SUB_BITS = 8                 # 128 linear sub-buckets per power of two (2**(SUB_BITS-1))
+RING_SIZE = 8192             # recent commits a lagging subscriber can still be matched against
+MAX_SUBSCRIBERS = 1024
+HOPS = ('network', 'store', 'deliver', 'total')
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+_SUB = 1 << SUB_BITS
+
+SKEW = metrics.Counter('bms_latency_clock_skew_total',
+                       'Packets whose device sample time is ahead of the server clock', ('path', 'device'))
+MISSED = metrics.Counter('bms_latency_missed_total',
+                         'Commits a subscriber fell too far behind to be traced', ())
+
+
+def _index(us):
+    if us < _SUB:
+        return us
+    shift = us.bit_length() - SUB_BITS
+    return (shift << (SUB_BITS - 1)) + (us >> shift)
+
+
+def _lowest(i):
+    if i < _SUB:
+        return i
+    shift = (i >> (SUB_BITS - 1)) - 1
+    return (i - (shift << (SUB_BITS - 1))) << shift
+
+
+def _highest(i):
+    return _lowest(i + 1) - 1
+
+
+class HdrHistogram:
+    """Log-linear histogram of integer microseconds."""
+
+    __slots__ = ('counts', 'n', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = {}
+        self.n = self.total = self.max = 0
+        self.min = None
+
+    def record(self, us):
+        i = _index(us)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.n += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+        if self.min is None or us < self.min:
+            self.min = us
+
+    def merge(self, other):
+        for i, c in other.counts.items():
+            self.counts[i] = self.counts.get(i, 0) + c
+        self.n += other.n
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+
+    def quantiles(self, qs=QUANTILES):
+        """Highest equivalent value (µs) at each quantile in ``qs`` (ascending)."""
+        out, seen = [], 0
+        ranks = [max(1, round(q * self.n)) for q in qs]
+        k = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            while k < len(ranks) and seen >= ranks[k]:
+                out.append(min(_highest(i), self.max))
+                k += 1
+            if k == len(ranks):
+                break
+        return out
+
+    def summary(self):
+        if not self.n:
+            return {"count": 0}
+        out = {"count": self.n, "min_ms": self.min / 1e3, "mean_ms": round(self.total / self.n / 1e3, 3)}
+        for q, us in zip(QUANTILES, self.quantiles()):
+            out[f"p{q * 100:g}_ms"] = us / 1e3
+        out["max_ms"] = self.max / 1e3
+        return out
+
+
+class LatencyTracker:
+    def __init__(self, ring_size=RING_SIZE, max_subscribers=MAX_SUBSCRIBERS):
+        self.lock = threading.Lock()
+        self.hists = {}                      # (hop, path, device) -> HdrHistogram
+        self.ring = deque(maxlen=ring_size)  # (seq, commit_ns, recv_ns, sample_ns, device, path)
+        self.seq = 0
+        self.cursors = OrderedDict()         # subscriber -> last seq it was given
+        self.max_subscribers = max_subscribers
+        self.since_ns = time.time_ns()
+
+    def _observe(self, hop, path, device, ns):
+        hist = self.hists.get((hop, path, device))
+        if hist is None:
+            hist = self.hists[(hop, path, device)] = HdrHistogram()
+        hist.record(max(ns, 0) // 1000)
+
+    def committed(self, path, device, recv_ns, sample_ns=None, commit_ns=None):
+        """One packet from ``device`` via ``path`` is in the store (and journal)."""
+        if commit_ns is None:
+            commit_ns = time.time_ns()
+        with self.lock:
+            if sample_ns is not None:
+                if sample_ns > recv_ns:
+                    SKEW.inc(path, device)
+                else:
+                    self._observe('network', path, device, recv_ns - sample_ns)
+            self._observe('store', path, device, commit_ns - recv_ns)
+            self.seq += 1
+            self.ring.append((self.seq, commit_ns, recv_ns, sample_ns, device, path))
+
+    def delivered(self, subscriber, devices=None, now_ns=None, newest_only=False):
+        """``subscriber`` was just sent everything committed so far (of ``devices``, if given).
+
+        ``newest_only``: the view shows only the latest packet, so packets it
+        replaced before this poll were never delivered and are not traced.
+        """
+        if now_ns is None:
+            now_ns = time.time_ns()
+        with self.lock:
+            cursor = self.cursors.pop(subscriber, None)
+            self.cursors[subscriber] = self.seq
+            if len(self.cursors) > self.max_subscribers:
+                self.cursors.popitem(last=False)
+            if cursor is None or not self.ring:
+                return
+            if self.ring[0][0] > cursor + 1:
+                MISSED.inc(n=self.ring[0][0] - cursor - 1)
+            for seq, commit_ns, recv_ns, sample_ns, device, path in reversed(self.ring):
+                if seq <= cursor:
+                    break
+                if devices is not None and device not in devices:
+                    continue
+                self._observe('deliver', path, device, now_ns - commit_ns)
+                start = recv_ns if sample_ns is None or sample_ns > recv_ns else sample_ns
+                self._observe('total', path, device, now_ns - start)
+                if newest_only:
+                    break
+
+    def commit_times(self):
+        """``{(device, recv_ns): commit_ns}`` for the packets still in the ring."""
+        with self.lock:
+            return {(device, recv_ns): commit_ns for _, commit_ns, recv_ns, _, device, _ in self.ring}
+
+    def rows(self, by_device=False, hop=None, path=None, device=None):
+        """Histogram summaries, one row per (hop, path[, device])."""
+        with self.lock:
+            merged = {}
+            for (h, p, d), hist in self.hists.items():
+                if hop and h != hop or path and p != path or device and d != device:
+                    continue
+                key = (h, p, d) if by_device or device else (h, p, '*')
+                if key not in merged:
+                    merged[key] = HdrHistogram()
+                merged[key].merge(hist)
+            rows = []
+            for (h, p, d), hist in merged.items():
+                row = {"hop": h, "path": p}
+                if d != '*':
+                    row["device"] = d
+                row.update(hist.summary())
+                rows.append(row)
+        order = {h: i for i, h in enumerate(HOPS)}
+        rows.sort(key=lambda r: (order.get(r["hop"], len(HOPS)), r["path"], str(r.get("device", ""))))
+        return rows
+
+    def collect(self):
+        # Prometheus summary of every hop per ingest path (per-device rows stay on /api/latency)
+        name = 'bms_latency_seconds'
+        yield f'# HELP {name} Trace latency by hop and ingest path'
+        yield f'# TYPE {name} summary'
+        with self.lock:
+            merged = {}
+            for (h, p, _), hist in self.hists.items():
+                merged.setdefault((h, p), HdrHistogram()).merge(hist)
+        for (h, p), hist in merged.items():
+            labels = f'hop="{h}",path="{metrics._escape(p)}"'
+            for q, us in zip(QUANTILES, hist.quantiles()):
+                yield f'{name}{{{labels},quantile="{q:g}"}} {us / 1e6!r}'
+            yield f'{name}_sum{{{labels}}} {hist.total / 1e6!r}'
+            yield f'{name}_count{{{labels}}} {hist.n}'
+
+
+tracker = LatencyTracker()
+metrics.REGISTRY.append(tracker)
+
+
+def committed(path, device, records):
+    """Trace a stored packet from its records (all share one ``ts_ns`` / ``sample_ns``)."""
+    if ENABLED and records:
+        rec = records[0]
+        tracker.committed(path, device, rec.ts_ns, rec.sample_ns)
+
+
+def committed_entry(path, device, entry):
+    """Trace a stored raw entry (``{"ts_ns", "sample_ns"?, ...}``, as ``server2`` keeps them)."""
+    if ENABLED:
+        tracker.committed(path, device, entry["ts_ns"], entry.get("sample_ns"))
+
+
+def subscriber(req):
+    client = req.args.get('client')
+    return f"{req.remote_addr}/{client}" if client else req.remote_addr
+
+
+def delivered(req, devices=None, newest_only=False):
+    """Trace one ``/data`` poll (or push) to the client behind ``req``."""
+    if ENABLED:
+        tracker.delivered(subscriber(req), devices, newest_only=newest_only)
+
+
+def add_trace(items, device=lambda item: item.get("device")):
+    """Give each served item (a dict with ``ts_ns`` / ``sample_ns``) a ``"trace"``, for ``?trace=1``."""
+    commits = tracker.commit_times()
+    now_ns = time.time_ns()
+    for item in items:
+        recv_ns = item.get("ts_ns")
+        if recv_ns is None:
+            continue
+        trace = {"recv_ns": recv_ns, "deliver_ns": now_ns}
+        if item.get("sample_ns") is not None:
+            trace["sample_ns"] = item["sample_ns"]
+        commit_ns = commits.get((device(item), recv_ns))
+        if commit_ns is not None:
+            trace["commit_ns"] = commit_ns
+        item["trace"] = trace
+    return items
+
+
+def latency_view(req):
+    """Body and status for ``GET /api/latency``."""
+    a = req.args
+    if a.get('hop') and a['hop'] not in HOPS:
+        return {"error": f"unknown hop {a['hop']!r} ({', '.join(HOPS)})"}, 400
+    return {"enabled": ENABLED, "since": format_ns(tracker.since_ns), "subscribers": len(tracker.cursors),
+            "hops": tracker.rows(a.get('by') == 'device', a.get('hop'), a.get('path'), a.get('device'))}, 200
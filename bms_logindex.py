@@ -0,0 +1,162 @@
+"""
+Memory-mapped, offset-indexed reads of day log files.
+
+Every ``data/<type>_<date>.jsonl`` gets a sidecar ``.jsonl.idx`` holding the
+byte offset and timestamp of every ``INDEX_EVERY``-th line.  The index is
+extended incrementally on each read (only the bytes appended since the last
+read are scanned), so it works for files written before it existed and for
+today's still-growing file.
+
+A time-range read bisects the index, scans at most ``INDEX_EVERY`` lines at
+either end to find the exact boundaries, and then hands out slices of the
+mapped file as they are – lines are never JSON-decoded and re-encoded.
+Timestamps are read from the line prefix that ``json.dumps`` always writes
+first (``{"timestamp": "..."``).
+
+Files holding delta lines (``bms_delta``) must be expanded, and payload
+filters (e.g. ``device``) need the decoded entry, so callers check
+``index["delta"]`` and fall back to ``bms_delta.read_log()`` for those.
+"""
+import json
+import mmap
+import os
+import re
+import threading
+from bisect import bisect_left, bisect_right
+
+INDEX_EVERY = 256
+CHUNK_BYTES = 1024 * 1024
+INDEX_VERSION = 1
+
+_TS_PREFIX = re.compile(rb'\{"timestamp": "([^"]*)"')
+_DELTA_MARK = b', "d": '
+
+_lock = threading.Lock()
+_cache = {}             # jsonl path -> index dict
+
+
+def index_path(jsonl_path):
+    return jsonl_path + '.idx'
+
+
+def _line_ts(line):
+    m = _TS_PREFIX.match(line)
+    if m:
+        return m.group(1).decode('utf-8'), line.startswith(_DELTA_MARK, m.end())
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return None, False
+    return entry.get("timestamp"), "f" in entry
+
+
+def _empty_index():
+    return {"version": INDEX_VERSION, "every": INDEX_EVERY, "indexed_bytes": 0,
+            "lines": 0, "delta": False, "points": []}
+
+
+def _load(jsonl_path):
+    index = _cache.get(jsonl_path)
+    if index is not None:
+        return index
+    try:
+        with open(index_path(jsonl_path)) as f:
+            index = json.load(f)
+        if index.get("version") != INDEX_VERSION or index.get("every") != INDEX_EVERY:
+            index = _empty_index()
+    except (OSError, ValueError):
+        index = _empty_index()
+    return index
+
+
+def _save(jsonl_path, index):
+    tmp = index_path(jsonl_path) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, index_path(jsonl_path))
+
+
+def refresh(jsonl_path):
+    """Offset index of a day file, extended over anything appended since the last call."""
+    with _lock:
+        index = _load(jsonl_path)
+        size = os.path.getsize(jsonl_path)
+        if size < index["indexed_bytes"]:
+            index = _empty_index()          # file was replaced
+        if size > index["indexed_bytes"]:
+            with open(jsonl_path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos, lines = index["indexed_bytes"], index["lines"]
+                while pos < size:
+                    nl = mm.find(b'\n', pos, size)
+                    if nl < 0:
+                        break               # partial line still being written
+                    if nl > pos:
+                        ts, delta = _line_ts(mm[pos:nl])
+                        index["delta"] = index["delta"] or delta
+                        if lines % INDEX_EVERY == 0:
+                            index["points"].append([pos, ts or ""])
+                        lines += 1
+                    pos = nl + 1
+                grown = pos > index["indexed_bytes"]
+                index["indexed_bytes"], index["lines"] = pos, lines
+            if grown:
+                _save(jsonl_path, index)
+        _cache[jsonl_path] = index
+        return index
+
+
+def _scan(mm, pos, limit, stop):
+    """Offset of the first line in [pos, limit) whose timestamp satisfies ``stop``."""
+    while pos < limit:
+        nl = mm.find(b'\n', pos, limit)
+        nl = limit if nl < 0 else nl
+        ts, _ = _line_ts(mm[pos:nl])
+        if ts is not None and stop(ts):
+            return pos
+        pos = nl + 1
+    return limit
+
+
+def byte_range(mm, index, start=None, end=None):
+    """Byte span [a, b) of the lines with ``start <= timestamp <= end``."""
+    points = index["points"]
+    stamps = [p[1] for p in points]
+    limit = index["indexed_bytes"]
+    a, b = 0, limit
+    if start:
+        i = max(bisect_left(stamps, start) - 1, 0)
+        lo = points[i][0] if points else 0
+        hi = points[i + 1][0] if i + 1 < len(points) else limit
+        a = _scan(mm, lo, hi, lambda ts: ts >= start)
+    if end:
+        i = max(bisect_right(stamps, end) - 1, 0)
+        lo = max(points[i][0] if points else 0, a)
+        hi = points[i + 1][0] if i + 1 < len(points) else limit
+        b = _scan(mm, lo, hi, lambda ts: ts > end)
+    return a, max(a, b)
+
+
+def iter_range(jsonl_path, start=None, end=None, chunk_bytes=CHUNK_BYTES):
+    """Yield the raw JSON lines of a time range in chunks of whole lines (NDJSON)."""
+    index = refresh(jsonl_path)
+    if not index["indexed_bytes"]:
+        return
+    with open(jsonl_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos, stop = byte_range(mm, index, start, end)
+        while pos < stop:
+            cut = min(stop, pos + chunk_bytes)
+            if cut < stop:
+                cut = mm.find(b'\n', cut, stop) + 1 or stop
+            yield mm[pos:cut]
+            pos = cut
+
+
+def as_json_array(chunks):
+    """Turn NDJSON chunks into one JSON array without parsing the lines."""
+    yield b'['
+    sep = b''
+    for chunk in chunks:
+        yield sep + chunk.rstrip(b'\n').replace(b'\n', b',')
+        sep = b','
+    yield b']'
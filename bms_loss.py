@@ -0,0 +1,78 @@
+"""
+Per-device packet loss from sequence numbers.
+
+Lossy transports (UDP) give no delivery feedback, so every packet should
+carry a per-device ``"seq"`` that increases by one per sample.  A jump
+counts the missing numbers as lost; a number below the last one seen is
+a late (reordered) arrival and takes one back off the lost count.  A big
+step backwards (``RESTART_GAP``) means the device rebooted and its
+counter started over.  Run it after dedup, so retries are not counted
+as late arrivals.
+"""
+import threading
+
+import bms_metrics as metrics
+
+RESTART_GAP = 1000
+
+LOST = metrics.Counter('bms_seq_gaps_total', 'Sequence numbers skipped (late arrivals not subtracted)',
+                       ('route', 'device'))
+
+_trackers = []
+
+
+def _loss_ratios():
+    out = {}
+    for tracker in _trackers:
+        out.update(tracker.loss_ratios())
+    return out
+
+
+LOSS_RATIO = metrics.Gauge('bms_seq_loss_ratio', 'Share of sequence numbers never received',
+                           ('route', 'device'), fn=_loss_ratios)
+
+
+class LossTracker:
+    def __init__(self, route, restart_gap=RESTART_GAP):
+        self.route = route
+        self.restart_gap = restart_gap
+        self.lock = threading.Lock()
+        self.devices = {}          # device -> [last seq, received, lost, late, restarts]
+        _trackers.append(self)
+
+    def observe(self, device, payload):
+        """Account for one packet; returns how many packets were found missing before it."""
+        seq = payload.get('seq') if isinstance(payload, dict) else None
+        if not isinstance(seq, int):
+            return 0
+        with self.lock:
+            st = self.devices.get(device)
+            if st is None:
+                self.devices[device] = [seq, 1, 0, 0, 0]
+                return 0
+            st[1] += 1
+            gap = seq - st[0] - 1
+            if gap >= 0:
+                st[0] = seq
+                st[2] += gap
+            elif -gap > self.restart_gap:
+                st[0] = seq
+                st[4] += 1
+                gap = 0
+            else:
+                st[2] = max(st[2] - 1, 0)
+                st[3] += 1
+                gap = -1
+        if gap > 0:
+            LOST.inc(self.route, device, n=gap)
+        return max(gap, 0)
+
+    def loss_ratios(self):
+        with self.lock:
+            return {(self.route, d): st[2] / (st[1] + st[2]) for d, st in self.devices.items()}
+
+    def stats(self):
+        with self.lock:
+            return {d: {"last_seq": st[0], "received": st[1], "lost": st[2], "late": st[3],
+                        "restarts": st[4], "loss_ratio": round(st[2] / (st[1] + st[2]), 6)}
+                    for d, st in self.devices.items()}
@@ -0,0 +1,329 @@
+"""
+Cheap always-on metrics for the BMS servers, exported at ``/metrics`` in
+the Prometheus text format.
+
+Counters and histograms are plain Python ints in pre-allocated slots and
+are bumped without taking a lock: under the GIL a concurrent increment can
+very occasionally be lost, which is an acceptable trade for keeping the
+ingest hot path free of contention.  Histogram buckets are fixed at import
+time, so ``observe()`` is one ``bisect`` plus two additions.  Gauges that
+go up *and* down (``inc``/``dec``) do take a lock: a lost update there is
+not a rounding error but a permanent drift.
+
+A ``device`` label comes from the packet, so any client could mint new
+series with made-up ids.  The first ``MAX_DEVICE_LABELS`` distinct
+devices (``BMS_METRICS_MAX_DEVICES``, default 256) keep their own series;
+later ones are counted under ``device="_other"`` (and left out of
+callback gauges, whose values cannot be added up).
+
+    import bms_metrics as metrics
+    metrics.instrument_app(app)                  # /metrics + handler latency
+    metrics.register_store(lambda: received_data)
+"""
+import os
+import resource
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, g, request
+
+# Latency buckets in seconds: 50 µs … 10 s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+MAX_DEVICE_LABELS = int(os.environ.get('BMS_METRICS_MAX_DEVICES', 256))
+OTHER_DEVICE = '_other'
+
+_device_labels = set()
+_device_lock = threading.Lock()
+
+
+def device_label(device):
+    """``device`` as a label value, or ``OTHER_DEVICE`` once ``MAX_DEVICE_LABELS`` are taken."""
+    if device in _device_labels:
+        return device
+    with _device_lock:
+        if len(_device_labels) < MAX_DEVICE_LABELS:
+            _device_labels.add(device)
+            return device
+    return OTHER_DEVICE
+
+
+def _capper(labelnames):
+    # Rewrites the device label of a label tuple, or None if there is no device label
+    if 'device' not in labelnames:
+        return None
+    i = labelnames.index('device')
+    return lambda labels: labels[:i] + (device_label(labels[i]),) + labels[i + 1:]
+
+
+def _fmt_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _fmt_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self.values = {}
+        self.cap = _capper(self.labelnames)
+        REGISTRY.append(self)
+
+    def inc(self, *labels, n=1):
+        if self.cap:
+            labels = self.cap(labels)
+        values = self.values
+        values[labels] = values.get(labels, 0) + n
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for labels, value in list(self.values.items()):
+            yield f'{self.name}{_fmt_labels(self.labelnames, labels)} {_fmt_value(value)}'
+
+
+class Gauge:
+    """A gauge that is either ``set()`` directly or read from a callback at scrape time."""
+
+    def __init__(self, name, help_text, labelnames=(), fn=None):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self.values = {}
+        self.fn = fn
+        self.cap = _capper(self.labelnames)
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def set(self, value, *labels):
+        if self.cap:
+            labels = self.cap(labels)
+            if OTHER_DEVICE in labels:
+                return          # a level cannot be shared between devices
+        self.values[labels] = value
+
+    def remove(self, *labels):
+        """Drop a series, e.g. for a device that is gone."""
+        self.values.pop(labels, None)
+
+    def inc(self, *labels, n=1):
+        if self.cap:
+            labels = self.cap(labels)
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + n
+
+    def dec(self, *labels, n=1):
+        if self.cap:
+            labels = self.cap(labels)
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) - n
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} gauge'
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except Exception:
+                return
+            if isinstance(value, dict):
+                for labels, v in value.items():
+                    if self.cap and OTHER_DEVICE in self.cap(labels):
+                        continue
+                    yield f'{self.name}{_fmt_labels(self.labelnames, labels)} {_fmt_value(v)}'
+            else:
+                yield f'{self.name} {_fmt_value(value)}'
+            return
+        for labels, value in list(self.values.items()):
+            yield f'{self.name}{_fmt_labels(self.labelnames, labels)} {_fmt_value(value)}'
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}   # labels -> [bucket counts..., +Inf count, sum]
+        self.cap = _capper(self.labelnames)
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        if self.cap:
+            labels = self.cap(labels)
+        slots = self.series.get(labels)
+        if slots is None:
+            slots = self.series.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0])
+        slots[bisect_left(self.buckets, value)] += 1
+        slots[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, slots in list(self.series.items()):
+            slots = list(slots)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), slots):
+                cumulative += count
+                le = 'le="' + _fmt_value(bound) + '"'
+                yield f'{self.name}_bucket{_fmt_labels(self.labelnames, labels, le)} {cumulative}'
+            yield f'{self.name}_sum{_fmt_labels(self.labelnames, labels)} {_fmt_value(slots[-1])}'
+            yield f'{self.name}_count{_fmt_labels(self.labelnames, labels)} {cumulative}'
+
+
+class _Timer:
+    __slots__ = ('hist', 'labels', 't0')
+
+    def __init__(self, hist, labels):
+        self.hist, self.labels = hist, labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.t0, *self.labels)
+
+
+# ─────────────────────────────────────────────────────────────────────
+#  Process / store gauges
+# ─────────────────────────────────────────────────────────────────────
+def process_rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # ru_maxrss is KiB on Linux (peak, not current) – better than nothing
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def approx_size(obj, _depth=0):
+    """Rough deep ``sys.getsizeof`` of a JSON-like object or ``__slots__`` record."""
+    size = sys.getsizeof(obj)
+    if _depth > 6:
+        return size
+    if isinstance(obj, dict):
+        size += sum(approx_size(k, _depth + 1) + approx_size(v, _depth + 1) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(approx_size(v, _depth + 1) for v in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(approx_size(getattr(obj, a, None), _depth + 1) for a in obj.__slots__)
+    return size
+
+
+_stores = []
+
+
+def register_store(get_items, name='received_data'):
+    """Expose length and estimated memory of an in-memory store.
+
+    ``get_items`` is called at scrape time and must return a sized sequence
+    (or a single dict for stores that only hold the latest packet).  Memory
+    is estimated from up to 64 evenly spaced entries, so scraping stays cheap
+    however large the store grows; a store that is not indexable (e.g.
+    ``bms_shards.ShardedStore``) provides them through ``sample(k)``.
+    """
+    _stores.append((name, get_items))
+
+
+def _store_entries():
+    out = {}
+    for name, get_items in _stores:
+        items = get_items()
+        out[(name,)] = 1 if isinstance(items, dict) else len(items)
+    return out
+
+
+def _store_bytes():
+    out = {}
+    for name, get_items in _stores:
+        items = get_items()
+        if isinstance(items, dict):
+            out[(name,)] = approx_size(items)
+            continue
+        n = len(items)
+        if not n:
+            out[(name,)] = sys.getsizeof(items)
+            continue
+        if hasattr(items, 'sample'):
+            sample = items.sample(64) or [None]
+        else:
+            sample = [items[i] for i in range(0, n, max(1, n // 64))]
+        out[(name,)] = sys.getsizeof(items) + int(sum(approx_size(e) for e in sample) * n / len(sample))
+    return out
+
+
+# ─────────────────────────────────────────────────────────────────────
+#  Standard metrics shared by all server modules
+# ─────────────────────────────────────────────────────────────────────
+PACKETS = Counter('bms_packets_total', 'Ingested packets by route, device and result',
+                  ('route', 'device', 'result'))
+DECODE_SECONDS = Histogram('bms_decode_seconds', 'Time spent decoding a packet body', ('route',))
+STORE_SECONDS = Histogram('bms_store_seconds', 'Time spent committing a packet to the store', ('route',))
+HANDLER_SECONDS = Histogram('bms_http_handler_seconds', 'Flask handler latency by endpoint', ('endpoint',))
+HTTP_REQUESTS = Counter('bms_http_requests_total', 'HTTP requests by endpoint and status', ('endpoint', 'status'))
+TCP_CONNECTIONS = Gauge('bms_tcp_active_connections', 'Open raw TCP device connections')
+DASHBOARD_POLLS = Counter('bms_dashboard_polls_total', 'Dashboard /data polls')
+PROXY_SECONDS = Histogram('bms_esp32_proxy_seconds', 'Outbound request latency to the ESP32',
+                          ('op', 'outcome'))
+Gauge('bms_store_entries', 'Entries held in the in-memory store', ('store',), fn=_store_entries)
+Gauge('bms_store_bytes', 'Estimated memory held by the in-memory store', ('store',), fn=_store_bytes)
+Gauge('bms_process_resident_bytes', 'Resident set size of the server process', fn=process_rss_bytes)
+
+
+def proxy_call(op, func, *args, **kwargs):
+    """Call ``requests.get/post`` towards the ESP32 and record its latency."""
+    t0 = time.perf_counter()
+    try:
+        resp = func(*args, **kwargs)
+    except Exception:
+        PROXY_SECONDS.observe(time.perf_counter() - t0, op, 'error')
+        raise
+    PROXY_SECONDS.observe(time.perf_counter() - t0, op, 'ok' if resp.ok else 'http_error')
+    return resp
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view():
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+def instrument_app(app):
+    """Add ``/metrics`` and per-endpoint handler latency to a Flask app."""
+
+    @app.before_request
+    def _metrics_start():
+        g._metrics_t0 = time.perf_counter()
+
+    @app.after_request
+    def _metrics_stop(response):
+        t0 = getattr(g, '_metrics_t0', None)
+        endpoint = request.endpoint or 'unmatched'
+        if t0 is not None:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, endpoint)
+        HTTP_REQUESTS.inc(endpoint, response.status_code)
+        return response
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
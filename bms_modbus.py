@@ -0,0 +1,281 @@
+"""
+Native Modbus-TCP polling: the server reads BMS units directly instead of
+waiting for an ESP32 to forward them.
+
+One asyncio task per slave polls on its own schedule (``interval_ms``, the
+same meaning as the firmware's ``modbusInterval``); missed ticks are
+skipped rather than bunched up.  Slaves behind the same host:port share one
+TCP connection and their requests are pipelined by transaction id.  The
+register map is read with as few requests as possible: ranges closer than
+``MAX_GAP`` registers are coalesced into one read (up to the protocol's 125
+registers).  A timeout, Modbus exception, dropped connection or
+undecodable reply produces a record with ``modbus_error=1`` and
+``connected=False``, just like the firmware's ``modbusError`` flag.  Any
+other error is counted and the slave's task carries on with its next
+tick; should the event loop itself die, its thread starts it again.
+
+Each poll hands ``[SlaveRecord]`` to ``sink(device, records)`` – in
+``bms_server.py`` that is the same store path as ``/update``.
+
+Targets come from a JSON file (``BMS_MODBUS_TARGETS``):
+
+    {"timeout_s": 1.0,
+     "map": {"pack_voltage": [0, 0.01], ...},            # optional
+     "targets": [{"host": "10.0.0.5", "port": 502, "unit": 1,
+                  "interval_ms": 500, "device": "rack-1", "slave": 1}]}
+
+``modbus_sim.py`` serves the default map for hundreds of simulated units.
+"""
+import asyncio
+import json
+import os
+import random
+import struct
+import threading
+import time
+
+import bms_metrics as metrics
+from bms_records import SlaveRecord
+
+TARGETS_FILE = os.environ.get('BMS_MODBUS_TARGETS')
+DEFAULT_INTERVAL_MS = 500
+DEFAULT_TIMEOUT_S = 1.0
+MAX_GAP = 8                 # coalesce ranges separated by at most this many registers
+MAX_REGISTERS = 125         # per read, protocol limit
+MAX_TIMEOUTS = 3            # consecutive timeouts before reconnecting
+READ_HOLDING = 0x03
+
+# Record field -> [address, scale, signed, words] (holding registers, big-endian)
+DEFAULT_MAP = {
+    'pack_voltage':       [0x00, 0.01, False, 1],
+    'current':            [0x01, 0.01, True, 1],
+    'capacity_remaining': [0x02, 0.01, False, 1],
+    'soc':                [0x03, 0.1, False, 1],
+    'soh':                [0x04, 0.1, False, 1],
+    'avg_cell_temp':      [0x05, 0.1, True, 1],
+    'env_temp':           [0x06, 0.1, True, 1],
+    'cycles':             [0x07, 1, False, 1],
+    'max_cell_voltage':   [0x08, 0.001, False, 1],
+    'min_cell_voltage':   [0x09, 0.001, False, 1],
+    'warn':               [0x10, 1, False, 1],
+    'prot':               [0x11, 1, False, 1],
+}
+
+REQUESTS = metrics.Counter('bms_modbus_requests_total', 'Modbus read requests by outcome', ('outcome',))
+REQUEST_SECONDS = metrics.Histogram('bms_modbus_request_seconds', 'Modbus read round-trip time', ())
+SKIPPED_TICKS = metrics.Counter('bms_modbus_skipped_polls_total', 'Poll ticks skipped because a poll overran')
+
+
+class ModbusError(Exception):
+    """A Modbus exception response (``code`` is the exception code)."""
+
+    def __init__(self, code):
+        super().__init__(f"modbus exception {code}")
+        self.code = code
+
+
+def parse_field(spec):
+    # Map entries may leave out signed (False) and words (1)
+    address, scale = spec[0], spec[1]
+    signed = spec[2] if len(spec) > 2 else False
+    words = spec[3] if len(spec) > 3 else 1
+    return int(address), scale, bool(signed), int(words)
+
+
+def plan_reads(register_map, max_gap=MAX_GAP, max_count=MAX_REGISTERS):
+    """Coalesce the map's registers into as few ``(start, count)`` reads as possible."""
+    spans = sorted((a, a + w) for a, _, _, w in map(parse_field, register_map.values()))
+    reads = []
+    for start, end in spans:
+        if reads:
+            r_start, r_end = reads[-1]
+            if start - r_end <= max_gap and max(end, r_end) - r_start <= max_count:
+                reads[-1] = (r_start, max(end, r_end))
+                continue
+        reads.append((start, end))
+    return [(s, e - s) for s, e in reads]
+
+
+def decode(register_map, regs):
+    """Field values from an ``{address: uint16}`` dict."""
+    values = {}
+    for name, spec in register_map.items():
+        address, scale, signed, words = parse_field(spec)
+        raw = 0
+        for i in range(words):
+            raw = (raw << 16) | regs[address + i]
+        if signed and raw >= 1 << (16 * words - 1):
+            raw -= 1 << (16 * words)
+        values[name] = round(raw * scale, 6) if scale != 1 else raw
+    return values
+
+
+class ModbusTCPClient:
+    """One pipelined Modbus-TCP connection shared by every unit behind a host:port."""
+
+    def __init__(self, host, port, timeout_s=DEFAULT_TIMEOUT_S):
+        self.host, self.port, self.timeout = host, port, timeout_s
+        self.reader = self.writer = None
+        self.pending = {}           # transaction id -> future
+        self.tid = 0
+        self.timeouts = 0           # consecutive; a silent connection gets dropped
+        self.connecting = asyncio.Lock()
+
+    async def _ensure(self):
+        if self.writer is not None:
+            return
+        async with self.connecting:
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), self.timeout)
+                asyncio.get_running_loop().create_task(self._read_loop(self.reader))
+
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                tid, _, length, _ = struct.unpack('>HHHB', header)
+                pdu = await reader.readexactly(length - 1)
+                self.timeouts = 0
+                fut = self.pending.pop(tid, None)
+                if fut is None or fut.done():
+                    continue            # answer to a request that already timed out
+                if pdu[0] & 0x80:
+                    fut.set_exception(ModbusError(pdu[1]))
+                else:
+                    fut.set_result(pdu)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            if reader is self.reader:   # not already replaced by a reconnect
+                self._reset(e)
+
+    def _reset(self, error):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+        pending, self.pending = self.pending, {}
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError(f"modbus connection lost: {error}"))
+
+    async def read_registers(self, unit, start, count, function=READ_HOLDING):
+        await self._ensure()
+        self.tid = (self.tid + 1) & 0xFFFF
+        tid = self.tid
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[tid] = fut
+        self.writer.write(struct.pack('>HHHBBHH', tid, 0, 6, unit, function, start, count))
+        try:
+            pdu = await asyncio.wait_for(fut, self.timeout)
+        except asyncio.TimeoutError:
+            self.pending.pop(tid, None)
+            self.timeouts += 1
+            if self.timeouts >= MAX_TIMEOUTS:
+                self._reset("no response")
+            raise
+        if len(pdu) < 2 + 2 * count or pdu[1] != 2 * count:
+            raise ModbusError(-1)       # short or mis-sized PDU
+        return struct.unpack(f'>{count}H', pdu[2:2 + 2 * count])
+
+
+class Target:
+    __slots__ = ('host', 'port', 'unit', 'device', 'slave', 'interval_s')
+
+    def __init__(self, host, port=502, unit=1, device=None, slave=None, interval_ms=DEFAULT_INTERVAL_MS):
+        self.host, self.port, self.unit = host, int(port), int(unit)
+        self.device = device or f"modbus:{host}:{port}"
+        self.slave = unit if slave is None else slave
+        self.interval_s = interval_ms / 1000.0
+
+
+class ModbusPoller:
+    def __init__(self, targets, sink, register_map=None, timeout_s=DEFAULT_TIMEOUT_S, max_gap=MAX_GAP):
+        self.targets = targets
+        self.sink = sink
+        self.map = register_map or DEFAULT_MAP
+        self.plan = plan_reads(self.map, max_gap)
+        self.timeout = timeout_s
+        self.clients = {}
+
+    async def run(self):
+        tasks = []
+        self.clients = {}          # connections belong to this event loop
+        for t in self.targets:
+            client = self.clients.get((t.host, t.port))
+            if client is None:
+                client = self.clients[(t.host, t.port)] = ModbusTCPClient(t.host, t.port, self.timeout)
+            tasks.append(asyncio.create_task(self._poll_slave(t, client)))
+        print(f"🔌 Modbus poller: {len(self.targets)} slaves on {len(self.clients)} connections, "
+              f"{len(self.plan)} read(s) per poll {self.plan}")
+        await asyncio.gather(*tasks)
+
+    async def _poll_slave(self, target, client):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time() + random.uniform(0, target.interval_s)   # spread the fleet
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            next_tick += target.interval_s
+            if next_tick < loop.time():
+                SKIPPED_TICKS.inc()
+                next_tick = loop.time() + target.interval_s
+            try:
+                rec = await self.poll_once(target, client)
+            except Exception as e:
+                # Never let one bad poll end this slave's task (and with it the gather)
+                REQUESTS.inc('error')
+                print(f"⚠️ Modbus poll error for {target.device}/{target.slave}: {e}")
+                continue
+            try:
+                self.sink(target.device, [rec])
+            except Exception as e:
+                print(f"⚠️ Modbus sink error for {target.device}/{target.slave}: {e}")
+
+    async def poll_once(self, target, client):
+        ts_ns = time.time_ns()
+        regs = {}
+        try:
+            for start, count in self.plan:
+                t0 = asyncio.get_running_loop().time()
+                values = await client.read_registers(target.unit, start, count)
+                REQUEST_SECONDS.observe(asyncio.get_running_loop().time() - t0)
+                REQUESTS.inc('ok')
+                regs.update(zip(range(start, start + count), values))
+        except asyncio.TimeoutError:
+            REQUESTS.inc('timeout')
+        except ModbusError:
+            REQUESTS.inc('exception')
+        except OSError:
+            REQUESTS.inc('connection')
+        else:
+            try:
+                return SlaveRecord(ts_ns, target.device, target.slave, True, modbus_error=0,
+                                   **decode(self.map, regs))
+            except Exception as e:
+                REQUESTS.inc('error')
+                print(f"⚠️ Modbus decode error for {target.device}/{target.slave}: {e}")
+        return SlaveRecord(ts_ns, target.device, target.slave, False, modbus_error=1)
+
+
+def load_targets(path):
+    with open(path) as f:
+        cfg = json.load(f)
+    targets = [Target(**t) for t in cfg.get("targets", [])]
+    return targets, cfg.get("map"), cfg.get("timeout_s", DEFAULT_TIMEOUT_S)
+
+
+def start_poller(path, sink):
+    """Poll the targets in ``path`` from a background thread with its own event loop."""
+    targets, register_map, timeout_s = load_targets(path)
+    poller = ModbusPoller(targets, sink, register_map, timeout_s)
+    thread = threading.Thread(target=_run_forever, args=(poller,), daemon=True)
+    thread.start()
+    return poller
+
+
+def _run_forever(poller, restart_s=5.0):
+    # Nothing else would notice the polling thread dying: restart the loop instead
+    while True:
+        try:
+            asyncio.run(poller.run())
+        except Exception as e:
+            print(f"⚠️ Modbus poller stopped: {e}; restarting in {restart_s:g} s")
+        time.sleep(restart_s)
@@ -0,0 +1,219 @@
+"""
+Slow-request profiling for the Flask servers.
+
+Every request is timed per endpoint.  Two capture modes feed a rotating
+profile directory:
+
+  * 1-in-N sampling: the sampled request runs under ``cProfile`` and its
+    stats are dumped as ``.prof`` (open with ``python -m pstats``).
+  * threshold: a watchdog thread takes stack samples of any request that has
+    been running longer than ``threshold_ms``; when it finishes the collapsed
+    stacks are written as ``.stacks`` (flamegraph.pl compatible).  A request
+    that went over the threshold before it was sampled is still listed as
+    slow, just without a profile.  The watchdog sleeps while no request is
+    in flight.
+
+``GET /admin/slow`` lists the slowest recent requests with their top frames
+and the per-endpoint duration summary.
+
+    import bms_profiling
+    bms_profiling.install_profiler(app, threshold_ms=250, sample_every=1000)
+"""
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from datetime import datetime
+
+from flask import g, jsonify, request
+
+PROFILE_DIR = os.environ.get('BMS_PROFILE_DIR', 'profiles')
+SLOW_REQUEST_MS = float(os.environ.get('BMS_SLOW_MS', 250))
+PROFILE_EVERY = int(os.environ.get('BMS_PROFILE_EVERY', 0))     # 0 = never sample
+
+
+class RequestProfiler:
+    def __init__(self, threshold_ms=SLOW_REQUEST_MS, sample_every=PROFILE_EVERY, profile_dir=PROFILE_DIR,
+                 keep_files=200, keep_slow=100, sample_interval_ms=10, top_frames=10):
+        self.threshold = threshold_ms / 1000.0
+        self.sample_every = sample_every
+        self.profile_dir = profile_dir
+        self.keep_files = keep_files
+        self.sample_interval = sample_interval_ms / 1000.0
+        self.top_frames = top_frames
+        self.lock = threading.Lock()
+        self.endpoints = {}                      # endpoint -> [count, total_s, max_s]
+        self.slow = deque(maxlen=keep_slow)      # recent slow/sampled request records
+        self.inflight = {}                       # thread id -> [start, endpoint, Counter of stacks]
+        self.busy = threading.Event()            # set while any request is in flight
+        self.request_count = 0
+        self.watchdog = threading.Thread(target=self._watch, daemon=True)
+        self.watchdog.start()
+
+    # ─── request hooks ─────────────────────────────────────────────
+    def start(self):
+        g._prof_t0 = time.perf_counter()
+        self.request_count += 1
+        g._prof_cprofile = None
+        if self.sample_every and self.request_count % self.sample_every == 0:
+            prof = cProfile.Profile()
+            try:
+                prof.enable()
+                g._prof_cprofile = prof
+            except ValueError:
+                pass   # another profiler already active on this interpreter
+        self.inflight[threading.get_ident()] = [g._prof_t0, request.endpoint or 'unmatched', None]
+        self.busy.set()
+
+    def stop(self, response):
+        t0 = getattr(g, '_prof_t0', None)
+        if t0 is None:
+            return response
+        elapsed = time.perf_counter() - t0
+        state = self.inflight.pop(threading.get_ident(), None)
+        prof = g._prof_cprofile
+        if prof is not None:
+            prof.disable()
+        endpoint = request.endpoint or 'unmatched'
+
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+        stacks = state[2] if state else None
+        if prof is not None or elapsed >= self.threshold:
+            self._record(endpoint, elapsed, response.status_code, prof, stacks)
+        return response
+
+    def finish(self, exc):
+        # after_request is skipped when the view raises; don't leak state
+        if self.inflight.pop(threading.get_ident(), None) is not None:
+            prof = getattr(g, '_prof_cprofile', None)
+            if prof is not None:
+                prof.disable()
+
+    # ─── stack sampling of long-running requests ───────────────────
+    def _watch(self):
+        while True:
+            self.busy.wait()
+            time.sleep(self.sample_interval)
+            if not self.inflight:
+                self.busy.clear()
+                if self.inflight:       # a request started between the check and the clear
+                    self.busy.set()
+                continue
+            now = time.perf_counter()
+            frames = None
+            for ident, state in list(self.inflight.items()):
+                if now - state[0] < self.threshold:
+                    continue
+                if frames is None:
+                    frames = sys._current_frames()
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = ';'.join(f"{f.name} ({os.path.basename(f.filename)}:{f.lineno})"
+                                 for f in traceback.extract_stack(frame))
+                if state[2] is None:
+                    state[2] = Counter()
+                state[2][stack] += 1
+
+    # ─── persistence ───────────────────────────────────────────────
+    def _record(self, endpoint, elapsed, status, prof, stacks):
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        base = os.path.join(self.profile_dir, f"{stamp}_{endpoint}_{int(elapsed * 1000)}ms")
+        if prof is not None or stacks:
+            os.makedirs(self.profile_dir, exist_ok=True)
+        if prof is not None:
+            path = base + '.prof'
+            prof.dump_stats(path)
+            top = self._top_cprofile(prof)
+            kind = 'cprofile'
+        elif not stacks:
+            # Over the threshold but finished before the watchdog got a sample
+            path, top, kind = None, [], 'duration_only'
+        else:
+            path = base + '.stacks'
+            with open(path, 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            top = self._top_stacks(stacks)
+            kind = 'stack_samples'
+        with self.lock:
+            self.slow.append({
+                "timestamp": datetime.now().isoformat(),
+                "endpoint": endpoint,
+                "path": request.full_path.rstrip('?'),
+                "status": status,
+                "duration_ms": round(elapsed * 1000, 2),
+                "kind": kind,
+                "profile": path,
+                "top_frames": top,
+            })
+        if path is not None:
+            self._rotate()
+
+    def _top_cprofile(self, prof):
+        stats = pstats.Stats(prof, stream=io.StringIO())
+        rows = []
+        for (filename, line, func), (cc, nc, tt, ct, callers) in stats.stats.items():
+            rows.append((ct, tt, nc, f"{func} ({os.path.basename(filename)}:{line})"))
+        rows.sort(reverse=True)
+        return [{"frame": frame, "cumulative_ms": round(ct * 1000, 2),
+                 "own_ms": round(tt * 1000, 2), "calls": nc}
+                for ct, tt, nc, frame in rows[:self.top_frames]]
+
+    def _top_stacks(self, stacks):
+        total = sum(stacks.values())
+        leaves = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return [{"frame": frame, "samples": count, "share": round(count / total, 3)}
+                for frame, count in leaves.most_common(self.top_frames)]
+
+    def _rotate(self):
+        try:
+            files = sorted(os.listdir(self.profile_dir))
+        except OSError:
+            return
+        for name in files[:max(0, len(files) - self.keep_files)]:
+            try:
+                os.remove(os.path.join(self.profile_dir, name))
+            except OSError:
+                pass
+
+    # ─── admin view ────────────────────────────────────────────────
+    def report(self, limit=20):
+        with self.lock:
+            slow = sorted(self.slow, key=lambda r: r["duration_ms"], reverse=True)[:limit]
+            endpoints = {
+                ep: {"count": c, "avg_ms": round(total / c * 1000, 2), "max_ms": round(mx * 1000, 2)}
+                for ep, (c, total, mx) in self.endpoints.items()
+            }
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "sample_every": self.sample_every,
+            "endpoints": endpoints,
+            "slowest": slow,
+        }
+
+
+def install_profiler(app, **kwargs):
+    """Attach a :class:`RequestProfiler` to ``app`` and add ``/admin/slow``."""
+    profiler = RequestProfiler(**kwargs)
+    app.before_request(profiler.start)
+    app.after_request(profiler.stop)
+    app.teardown_request(profiler.finish)
+
+    def slow_requests():
+        return jsonify(profiler.report(limit=request.args.get('limit', 20, type=int)))
+
+    app.add_url_rule('/admin/slow', 'admin_slow', slow_requests)
+    return profiler
@@ -0,0 +1,211 @@
+"""
+Server-side aggregation over the in-memory record history
+(``GET /api/query``), so a chart asks for a few hundred numbers instead of
+pulling all of ``/data``:
+
+    /api/query?metric=I&agg=avg&bucket=1m&last=6h          avg current per slave per minute
+    /api/query?metric=Temp&agg=max&group=all&latest=1      hottest slave right now
+    /api/query?metric=soc&agg=p95&device=esp-1&slave=1,2&start=2025-06-01T08:00&end=2025-06-01T12:00
+
+``metric`` takes record names or their payload aliases (``I``, ``V``,
+``Temp``...).  ``agg`` is min/max/avg/sum/count/last or ``pNN`` /
+``percentile&q=NN``.  ``group`` is ``slave`` (default), ``device`` or
+``all``.  Without ``bucket`` each series gets one value over the range.
+
+``start``/``end`` are ISO dates or times (to the microsecond) and are
+turned into epoch nanoseconds once; the time range is then cut out of the
+(time-ordered) history with two bisects on the records' integer ``ts_ns``,
+and each series is reduced column-wise: one pass pulls
+``(seconds, value)`` columns per series (:func:`columns`), and every
+bucket is aggregated with a single builtin call
+(``min``/``max``/``math.fsum``...) over its slice.  Times are formatted
+back to text only in the response.
+"""
+import math
+import time
+from bisect import bisect_left
+from itertools import groupby
+
+import bms_delta
+from bms_records import FIELD_ALIASES, METRICS, format_ns, parse_time
+
+MAX_POINTS = 10_000          # buckets per series
+ALIASES = {alias: name for name, keys in FIELD_ALIASES.items() for alias in keys}
+ALIASES.update({name: name for name in METRICS})
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+MIN_DURATION_S = 0.001       # 1 ms: finer buckets than the stored timestamps make no sense
+MAX_DURATION_S = 10 * 365 * 86400
+
+
+class QueryError(ValueError):
+    pass
+
+
+def parse_duration(text):
+    """'90', '90s', '5m', '6h', '1d' -> seconds (1 ms to 10 years)."""
+    text = str(text).strip()
+    try:
+        if text[-1:] in UNITS:
+            seconds = float(text[:-1]) * UNITS[text[-1]]
+        else:
+            seconds = float(text)
+    except ValueError:
+        raise QueryError(f"bad duration {text!r}") from None
+    # float() takes 'nan', 'inf' and '1e-300' too; none of them is a usable span
+    if not MIN_DURATION_S <= seconds <= MAX_DURATION_S:
+        raise QueryError(f"duration {text!r} must be between 1ms and 10 years")
+    return seconds
+
+
+def _ns(text, what):
+    if text in (None, ''):
+        return None
+    try:
+        return parse_time(text)
+    except ValueError:
+        raise QueryError(f"bad {what} {text!r}") from None
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * q / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def aggregator(agg, q=None):
+    if agg == 'min':
+        return min
+    if agg == 'max':
+        return max
+    if agg == 'sum':
+        return math.fsum
+    if agg == 'count':
+        return len
+    if agg == 'avg':
+        return lambda col: math.fsum(col) / len(col)
+    if agg == 'last':
+        return lambda col: col[-1]
+    if agg.startswith('p') and agg[1:].replace('.', '', 1).isdigit():
+        q = float(agg[1:])
+        agg = 'percentile'
+    if agg == 'percentile':
+        try:
+            q = float(q)
+        except (TypeError, ValueError):
+            q = None
+        if q is None or not 0 <= q <= 100:
+            raise QueryError("percentile needs q between 0 and 100")
+        return lambda col: percentile(sorted(col), q)
+    raise QueryError(f"unknown agg {agg!r}")
+
+
+def _ts(rec):
+    return rec.ts_ns
+
+
+def select(store, start=None, end=None):
+    """Records with ``start <= ts_ns < end`` (epoch ns, either may be None)."""
+    entries = list(store)
+    hi = len(entries) if end is None else bisect_left(entries, end, key=_ts)
+    if isinstance(store, bms_delta.DeltaHistory):
+        # Deltas must be decoded from the front; only the end can be cut first
+        decoder = bms_delta.DeltaDecoder()
+        for delta in entries[:hi]:
+            rec = decoder.apply(delta)
+            if start is None or rec.ts_ns >= start:
+                yield rec
+        return
+    lo = 0 if start is None else bisect_left(entries, start, lo=0, hi=hi, key=_ts)
+    yield from entries[lo:hi]
+
+
+def _series_key(rec, group):
+    if group == 'all':
+        return ('*', '*')
+    if group == 'device':
+        return (rec.device, '*')
+    return (rec.device, rec.slave)
+
+
+def _id_set(text):
+    return {s.strip() for s in str(text).split(',')} if text not in (None, '') else None
+
+
+def columns(records, name, device=None, slave=None, group='slave'):
+    """One pass over ``records``: ``{(device, slave): (seconds, values)}`` for metric ``name``."""
+    devices, slaves = _id_set(device), _id_set(slave)
+    out = {}
+    for rec in records:
+        if devices is not None and rec.device not in devices:
+            continue
+        if slaves is not None and str(rec.slave) not in slaves:
+            continue
+        value = getattr(rec, name)
+        if value is None or isinstance(value, bool):
+            continue
+        col = out.get(_series_key(rec, group))
+        if col is None:
+            col = out[_series_key(rec, group)] = ([], [])
+        col[0].append(rec.ts_ns / 1e9)
+        col[1].append(value)
+    return out
+
+
+def resolve_range(start=None, end=None, last=None):
+    """(start, end) in epoch ns; ``last`` is a duration back from now."""
+    if last:
+        return time.time_ns() - int(parse_duration(last) * 1e9), None
+    return _ns(start, 'start'), _ns(end, 'end')
+
+
+def run_query(store, metric, agg='avg', device=None, slave=None, start=None, end=None,
+              last=None, bucket=None, group='slave', q=None, latest=False):
+    name = ALIASES.get(metric)
+    if name is None:
+        raise QueryError(f"unknown metric {metric!r}")
+    if group not in ('slave', 'device', 'all'):
+        raise QueryError(f"unknown group {group!r}")
+    reduce = aggregator(agg, q)
+    width = parse_duration(bucket) if bucket else None
+    start, end = resolve_range(start, end, last)
+
+    if latest:
+        records = bms_delta.records_at(store, end or time.time_ns())
+        width = None
+    else:
+        records = select(store, start, end)
+
+    series = []
+    for (dev, sl), (seconds, values) in sorted(columns(records, name, device, slave, group).items(),
+                                               key=lambda kv: str(kv[0])):
+        if not width:
+            series.append({"device": dev, "slave": sl, "value": reduce(values), "n": len(values)})
+            continue
+        points, i = [], 0
+        for b, run in groupby(int(x // width) for x in seconds):
+            n = sum(1 for _ in run)
+            chunk = values[i:i + n]
+            i += n
+            points.append([format_ns(int(b * width * 1e9)), reduce(chunk), n])
+            if len(points) > MAX_POINTS:
+                raise QueryError(f"more than {MAX_POINTS} buckets per series; use a wider bucket")
+        series.append({"device": dev, "slave": sl, "points": points})
+    return {"metric": name, "agg": agg, "bucket_s": width, "group": group,
+            "start": format_ns(start), "end": format_ns(end), "series": series}
+
+
+def query_view(store, req):
+    """Body and status for ``GET /api/query``."""
+    a = req.args
+    if not a.get('metric'):
+        return {"error": "metric is required"}, 400
+    try:
+        return run_query(store, a['metric'], a.get('agg', 'avg'), a.get('device'), a.get('slave'),
+                         a.get('start'), a.get('end'), a.get('last'), a.get('bucket'),
+                         a.get('group', 'slave'), a.get('q'),
+                         a.get('latest') in ('1', 'true')), 200
+    except QueryError as e:
+        return {"error": str(e)}, 400
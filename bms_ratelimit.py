@@ -0,0 +1,145 @@
+"""
+Token-bucket rate limiting on ingest, before anything is decoded.
+
+A device with ``networkInterval`` 0 can post as fast as its stack allows
+and starve everyone else.  :class:`RateLimiter` keeps four buckets – per
+device packets/s and bytes/s, and the same two for the whole server – and
+``check(device, nbytes)`` answers how long the sender has to wait (0 when
+the packet may go through), checking and taking all four under one lock.
+The device key is the sender's address, since the device id inside the
+payload is not known before decoding – so a fleet behind one NAT or
+gateway counts as one device, which is why limiting is off by default.
+The per-address buckets are kept for the ``MAX_DEVICES`` most recent
+senders.
+
+* HTTP: :func:`http_guard` returns a ``429`` with ``Retry-After`` for the
+  route to send back before it touches the body.
+* TCP: the connection handler sleeps for the wait before reading more, so
+  TCP flow control pushes back on that device only.
+* UDP: over-limit datagrams are dropped (there is nobody to tell).
+
+Limits come from the environment; ``BMS_RATE_LIMIT=1`` turns them on:
+
+    BMS_RATE_PPS=20  BMS_RATE_BPS=65536                 per device (burst: BMS_RATE_BURST_S)
+    BMS_RATE_GLOBAL_PPS=2000  BMS_RATE_GLOBAL_BPS=8388608
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import bms_metrics as metrics
+
+ENABLED = os.environ.get('BMS_RATE_LIMIT') == '1'
+DEVICE_PPS = float(os.environ.get('BMS_RATE_PPS', 20))
+DEVICE_BPS = float(os.environ.get('BMS_RATE_BPS', 64 * 1024))
+GLOBAL_PPS = float(os.environ.get('BMS_RATE_GLOBAL_PPS', 2000))
+GLOBAL_BPS = float(os.environ.get('BMS_RATE_GLOBAL_BPS', 8 * 1024 * 1024))
+BURST_S = float(os.environ.get('BMS_RATE_BURST_S', 2.0))
+MAX_DEVICES = 4096          # sender addresses with buckets; the least recently seen is dropped
+
+LIMITED = metrics.Counter('bms_rate_limited_total', 'Packets held back by the ingest rate limiter',
+                          ('route', 'device', 'limit'))
+
+
+class TokenBucket:
+    """Not locked itself: :class:`RateLimiter` holds its lock around every use."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst_s=BURST_S):
+        self.rate = rate
+        self.capacity = max(rate * burst_s, 1.0)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+
+    def wait(self, n=1.0, now=None):
+        """Seconds until ``n`` tokens are available (0 if they are now)."""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        # A request bigger than the bucket only has to wait for a full one
+        deficit = min(n, self.capacity) - self.tokens
+        return deficit / self.rate if deficit > 0 else 0.0
+
+    def take(self, n=1.0):
+        """Take ``n`` tokens; call right after :meth:`wait` returned 0."""
+        self.tokens -= min(n, self.capacity)
+
+
+class RateLimiter:
+    def __init__(self, device_pps=DEVICE_PPS, device_bps=DEVICE_BPS,
+                 global_pps=GLOBAL_PPS, global_bps=GLOBAL_BPS, burst_s=BURST_S, max_devices=MAX_DEVICES):
+        self.device_pps, self.device_bps, self.burst_s = device_pps, device_bps, burst_s
+        self.global_buckets = (TokenBucket(global_pps, burst_s), TokenBucket(global_bps, burst_s))
+        self.devices = OrderedDict()        # sender -> (packets, bytes), least recently seen first
+        self.max_devices = max_devices
+        self.lock = threading.Lock()
+
+    def _device_buckets(self, device):
+        # Caller holds self.lock
+        buckets = self.devices.get(device)
+        if buckets is None:
+            buckets = self.devices[device] = (TokenBucket(self.device_pps, self.burst_s),
+                                              TokenBucket(self.device_bps, self.burst_s))
+            if len(self.devices) > self.max_devices:
+                self.devices.popitem(last=False)
+        else:
+            self.devices.move_to_end(device)
+        return buckets
+
+    def check(self, device, nbytes, route='ingest'):
+        """Seconds ``device`` must wait before this packet; takes the tokens when it is 0."""
+        with self.lock:
+            now = time.monotonic()
+            dev_packets, dev_bytes = self._device_buckets(device)
+            glob_packets, glob_bytes = self.global_buckets
+            wait = max(dev_packets.wait(1, now), dev_bytes.wait(nbytes, now))
+            limit = 'device'
+            if wait <= 0:
+                wait = max(glob_packets.wait(1, now), glob_bytes.wait(nbytes, now))
+                limit = 'global'
+            if wait <= 0:
+                for bucket, n in ((dev_packets, 1), (dev_bytes, nbytes), (glob_packets, 1), (glob_bytes, nbytes)):
+                    bucket.take(n)
+                return 0.0
+        LIMITED.inc(route, device, limit)
+        return wait
+
+
+limiter = RateLimiter()
+
+
+def http_guard(req, route):
+    """``None`` if ``req`` may proceed, else a 429 response tuple (body not read)."""
+    if not ENABLED:
+        return None
+    wait = limiter.check(req.remote_addr, req.content_length or 0, route)
+    if wait <= 0:
+        return None
+    metrics.PACKETS.inc(route, req.remote_addr, 'rate_limited')
+    return "Too Many Requests", 429, {"Retry-After": str(max(1, math.ceil(wait))), "Connection": "close"}
+
+
+def throttle(device, nbytes, route):
+    """Block the calling connection thread until ``device`` is under its limits."""
+    if not ENABLED:
+        return 0.0
+    waited = 0.0
+    while True:
+        wait = limiter.check(device, nbytes, route)
+        if wait <= 0:
+            return waited
+        if not waited:
+            metrics.PACKETS.inc(route, device, 'rate_limited')
+        time.sleep(wait)
+        waited += wait
+
+
+def admit(device, nbytes, route):
+    """Non-blocking check for fire-and-forget transports: False means drop."""
+    if not ENABLED or limiter.check(device, nbytes, route) <= 0:
+        return True
+    metrics.PACKETS.inc(route, device, 'rate_limited')
+    return False
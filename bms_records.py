@@ -0,0 +1,207 @@
+"""
+One compact record type for every BMS payload shape.
+
+Three shapes reach ``/update`` today:
+
+  * legacy single-slave   {"pack_voltage", "current", "capacity_remaining", ...}
+  * short multi-slave     {"slaves": [{"id", "V", "I", "RemAh", "Temp", "Warn", "Prot"}]}
+  * long multi-slave      {"slaves": [{"id", "status", "pack_voltage", "soc", ...}]}
+
+``normalize()`` turns any of them into a list of :class:`SlaveRecord` once at
+ingest; the stores, alarm engine, derived metrics and ``/data`` only ever see
+records, so neither the server nor the browser branches on the shape again.
+A ``__slots__`` record is roughly a quarter of the size of the equivalent
+dict.  ``RECORD_VERSION`` is carried in every serialized record so clients
+can tell the format apart from the raw packets served before.
+
+Times are integer epoch nanoseconds: ``ts_ns`` when the server received the
+packet (``time.time_ns()``, no formatting on the ingest path) and
+``sample_ns`` when the device says it sampled it (a ``"ts"`` field in the
+packet), if it does.  Ordering, bisecting and device-to-server delay are
+plain integer arithmetic; the text ``timestamp`` is only produced when a
+record is shown or serialized (:func:`format_ns`).
+"""
+import json
+import math
+import time
+from datetime import datetime
+
+RECORD_VERSION = 2           # 2: ts_ns / sample_ns next to the text timestamp
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Record attribute -> payload keys it may appear under
+FIELD_ALIASES = {
+    'pack_voltage':       ('pack_voltage', 'V'),
+    'current':            ('current', 'I'),
+    'capacity_remaining': ('capacity_remaining', 'RemAh'),
+    'soc':                ('soc',),
+    'soh':                ('soh',),
+    'avg_cell_temp':      ('avg_cell_temp', 'Temp'),
+    'env_temp':           ('env_temp',),
+    'cycles':             ('cycles',),
+    'max_cell_voltage':   ('max_cell_voltage',),
+    'min_cell_voltage':   ('min_cell_voltage',),
+    'warn':               ('Warn', 'warn'),
+    'prot':               ('Prot', 'prot'),
+    'modbus_error':       ('modbusError',),
+}
+METRICS = tuple(FIELD_ALIASES)
+
+
+# ─── Time ────────────────────────────────────────────────────────────
+def to_ns(dt):
+    """Epoch nanoseconds of a (naive, local) datetime, to the microsecond."""
+    return round(dt.timestamp() * 1_000_000) * 1000
+
+
+def format_ns(ns, iso=False):
+    """Local time of an epoch-ns timestamp to the millisecond: '2025-06-01 08:00:00.250'.
+
+    ``iso=True`` gives ``datetime.isoformat()`` text to the microsecond instead
+    ('2025-06-01T08:00:00.250000'), as server2's API has always served it.
+    """
+    if ns is None:
+        return None
+    seconds, rest = divmod(ns, 1_000_000_000)
+    if iso:
+        return datetime.fromtimestamp(seconds).replace(microsecond=rest // 1000).isoformat()
+    return f"{datetime.fromtimestamp(seconds).strftime(TS_FORMAT)}.{rest // 1_000_000:03d}"
+
+
+def parse_time(text):
+    """Epoch ns of '2025-06-01', '2025-06-01T08:00', '2025-06-01 08:00:00.25'...; ValueError if bad."""
+    return to_ns(datetime.fromisoformat(str(text).strip()))
+
+
+_NS_PER = ((1e11, 1_000_000_000), (1e14, 1_000_000), (1e17, 1000), (1e20, 1))   # s, ms, us, ns
+_MIN_SAMPLE_NS = 1_000_000_000 * 1_000_000_000      # 2001: below that it is an uptime counter
+_MAX_AHEAD_NS = 86_400 * 1_000_000_000              # clocks a day ahead are wrong too
+
+
+def sample_time_ns(data):
+    """Device-side sample time of a packet in epoch ns, or None.
+
+    ``"ts"`` may be epoch seconds, milliseconds, microseconds or
+    nanoseconds (told apart by magnitude) or an ISO date/time string.
+    Values that cannot be wall-clock time (an ESP32 without NTP sends its
+    uptime) are ignored.
+    """
+    if not isinstance(data, dict):
+        return None
+    ts = data.get('ts')
+    if isinstance(ts, str):
+        try:
+            ns = parse_time(ts)
+        except ValueError:
+            return None
+    elif isinstance(ts, (int, float)) and not isinstance(ts, bool):
+        if not math.isfinite(ts) or ts <= 0:
+            return None             # -Infinity / 1e400 would overflow int()
+        ns = next((int(ts * scale) for limit, scale in _NS_PER if ts < limit), None)
+    else:
+        return None
+    if ns is None or not _MIN_SAMPLE_NS <= ns <= time.time_ns() + _MAX_AHEAD_NS:
+        return None
+    return ns
+
+
+class SlaveRecord:
+    __slots__ = ('ts_ns', 'sample_ns', 'device', 'slave', 'connected') + METRICS
+
+    def __init__(self, ts_ns, device, slave, connected=True, sample_ns=None, **values):
+        self.ts_ns = ts_ns
+        self.sample_ns = sample_ns
+        self.device = device
+        self.slave = slave
+        self.connected = connected
+        for name in METRICS:
+            setattr(self, name, values.get(name))
+
+    @property
+    def timestamp(self):
+        return format_ns(self.ts_ns)
+
+    def to_dict(self, text_time=True):
+        """Serializable dict; journals pass ``text_time=False`` to skip formatting the time."""
+        out = {"v": RECORD_VERSION, "ts_ns": self.ts_ns, "device": self.device,
+               "slave": self.slave, "connected": self.connected}
+        if text_time:
+            out["timestamp"] = format_ns(self.ts_ns)
+        if self.sample_ns is not None:
+            out["sample_ns"] = self.sample_ns
+        for name in METRICS:
+            value = getattr(self, name)
+            if value is not None:
+                out[name] = value
+        return out
+
+    @classmethod
+    def from_dict(cls, d):
+        # Version 1 dicts (old journals) only have the text timestamp
+        ts_ns = d.get("ts_ns")
+        if ts_ns is None:
+            ts_ns = parse_time(d["timestamp"])
+        return cls(ts_ns, d.get("device"), d.get("slave", 0), d.get("connected", True),
+                   d.get("sample_ns"), **{k: d.get(k) for k in METRICS})
+
+    def __repr__(self):
+        return f"SlaveRecord({self.device!r}, slave={self.slave!r}, {self.timestamp!r})"
+
+
+def _value(raw):
+    # bools (modbusError) become 0/1 so every metric is numeric
+    if isinstance(raw, bool):
+        return int(raw)
+    if isinstance(raw, (int, float)):
+        return raw
+    return None
+
+
+def _from_slave(slave, ts_ns, device, slave_id, sample_ns=None):
+    values = {}
+    for name, keys in FIELD_ALIASES.items():
+        for k in keys:
+            if k in slave:
+                values[name] = _value(slave[k])
+                break
+    connected = slave.get('status', 'connected') == 'connected'
+    return SlaveRecord(ts_ns, device, slave_id, connected, sample_ns, **values)
+
+
+def packet_slaves(data):
+    """Raw slave dicts of a packet; a legacy single-slave packet counts as slave 0."""
+    if isinstance(data, dict):
+        slaves = data.get('slaves')
+        if isinstance(slaves, list):
+            return [s for s in slaves if isinstance(s, dict)]
+        return [data]
+    return []
+
+
+def normalize(data, device, ts_ns):
+    """All slaves of one decoded packet as :class:`SlaveRecord` s, received at ``ts_ns``."""
+    sample_ns = sample_time_ns(data)
+    return [_from_slave(s, ts_ns, device, _slave_id(s.get('id', 0)), sample_ns) for s in packet_slaves(data)]
+
+
+def _slave_id(value):
+    # Slave ids stay numbers when they are; anything structured becomes text
+    return value if isinstance(value, (str, int, float)) else id_text(value)
+
+
+def id_text(value):
+    """A packet-supplied id as a string: it keys dicts, metrics and files, so a
+    JSON list or object must not get through as an (unhashable) value."""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)):
+        return str(value)
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def device_id(data, remote_addr):
+    """Device-supplied id when the packet carries one, else the sender's address."""
+    if isinstance(data, dict):
+        device = data.get('device')
+        return id_text(device) if device else remote_addr
+    return remote_addr
@@ -1,22 +1,90 @@
 from flask import Flask, request, render_template_string, jsonify, redirect, flash, url_for
 from datetime import datetime
-import json, os, requests
+import json, os, requests, time
+import bms_metrics as metrics
+import bms_profiling
+import bms_alarms
+import bms_derived
+import bms_records
+import bms_dedup
+import bms_delta
+import bms_warmstart
+import bms_keepalive
+import bms_modbus
+import bms_config
+import bms_adaptive
+import bms_query
+import bms_downsample
+import bms_ratelimit
+import bms_capture
+import bms_latency
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
+metrics.instrument_app(app)
+bms_profiling.install_profiler(app)
+bms_capture.install(app)      # BMS_CAPTURE=<file>: raw ingest bodies for replay_traffic.py
+alarm_engine = bms_alarms.AlarmEngine()
+derived = bms_derived.DerivedMetrics('bms_server')
+dedup = bms_dedup.DedupCache()
 
-# ─── In‐memory store of all received Modbus packets ─────────────────
-received_data = []
+# ─── In‐memory store of all received slave records (bms_records) ────
+received_data = bms_delta.new_history()
+metrics.register_store(lambda: received_data)
+
+# ─── Journal of accepted records; its tail refills the store on restart ─
+journal = bms_warmstart.Journal('bms_server')
+_restored, _ = bms_warmstart.restore_records(journal, bms_delta.HISTORY_MAX)
+received_data.extend(_restored)
+bms_warmstart.replay_rollups(_restored, alarm_engine, derived)
+del _restored
+
+# ─── Ingest ACK: close per sample unless keep-alive serving is on ──
+ACK_HEADERS = {} if bms_keepalive.ENABLED else {"Connection": "close"}
 
 # ─── Where your ESP32 lives on the LAN (for sending config & firmware) ─
-ESP32_IP   = "192.168.100.85"
-ESP32_PORT = 80   # ESP32's EthernetServer is on port 80
+ESP32_IP   = os.environ.get("ESP32_IP", "192.168.100.85")
+ESP32_PORT = int(os.environ.get("ESP32_PORT", 80))       # ESP32's EthernetServer is on port 80
+OTA_PORT   = int(os.environ.get("ESP32_OTA_PORT", 8080))  # firmware update server
+ESP32_KEY  = f"{ESP32_IP}:{ESP32_PORT}"
+config_store = bms_config.ConfigStore('esp32_config.json')
+
+# ─── Adaptive reporting intervals (BMS_ADAPTIVE=1), pushed to each sender's /config ─
+interval_controller = bms_adaptive.IntervalController(config_store,
+    send=lambda addr, cfg: metrics.proxy_call('config_post', requests.post,
+                                              f"http://{addr}:{ESP32_PORT}/config", data=cfg, timeout=5),
+    fetch=lambda addr: metrics.proxy_call('config_get', requests.get,
+                                          f"http://{addr}:{ESP32_PORT}/config", timeout=3),
+    key=lambda addr: f"{addr}:{ESP32_PORT}")
+
+# ─────────────────────────────────────────────────────────────────────
+#  0) Store path shared by /update and the Modbus poller
+# ─────────────────────────────────────────────────────────────────────
+def store_records(device, records, route, key=None):
+    t1 = time.perf_counter()
+    try:
+        journal.write([r.to_dict(text_time=False) for r in records])
+    except Exception:
+        dedup.forget(key)       # not stored: the device's retry must not count as a duplicate
+        raise
+    # Into memory only once journaled, so a failed write leaves nothing for the retry to double
+    received_data.extend(records)
+    metrics.STORE_SECONDS.observe(time.perf_counter() - t1, route)
+    metrics.PACKETS.inc(route, device, 'accepted')
+    bms_latency.committed(route, device, records)
+    alarm_engine.evaluate(device, records)
+    derived.update(device, records)
 
 # ─────────────────────────────────────────────────────────────────────
 #  1) Endpoint for ESP32 to push BMS data (including modbusError)
 # ─────────────────────────────────────────────────────────────────────
 @app.route('/update', methods=['POST'])
 def update():
+    device = request.remote_addr
+    limited = bms_ratelimit.http_guard(request, '/update')   # before the body is read
+    if limited:
+        return limited
+    t0 = time.perf_counter()
     data = request.get_json(silent=True)
     if data is None:
         raw = request.form.get('data', '')
@@ -24,17 +92,34 @@ def update():
             try:
                 data = json.loads(raw)
             except:
+                metrics.PACKETS.inc('/update', device, 'bad_json')
                 return "Bad JSON", 400
         else:
+            metrics.PACKETS.inc('/update', device, 'empty')
             return "No data provided", 400
-    entry = {
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "data":      data
-    }
-    received_data.append(entry)
-    print(f"\n[ BMS DATA RECEIVED at {entry['timestamp']} ]")
+    if not isinstance(data, dict):
+        # Records are built from an object; a list or bare value would be ACKed and then dropped
+        metrics.PACKETS.inc('/update', device, 'invalid')
+        return "Expected a JSON object", 400
+    device = bms_records.device_id(data, device)
+    key = bms_dedup.message_key(data, device)
+    if dedup.is_duplicate(key):
+        # A retry of something we already stored: ACK it so the ESP32 moves on
+        metrics.PACKETS.inc('/update', device, 'duplicate')
+        return "ACK", 200, ACK_HEADERS
+    ts_ns = time.time_ns()          # formatted only when shown
+    try:
+        records = bms_records.normalize(data, device, ts_ns)
+    except Exception:
+        dedup.forget(key)
+        raise
+    metrics.DECODE_SECONDS.observe(time.perf_counter() - t0, '/update')
+    store_records(device, records, '/update', key)
+    if bms_adaptive.ENABLED:
+        interval_controller.observe(device, records, request.remote_addr, request.content_length or 0)
+    print(f"\n[ BMS DATA RECEIVED at {bms_records.format_ns(ts_ns)} ]")
     print(json.dumps(data, indent=2))
-    return "ACK", 200, {"Connection": "close"}
+    return "ACK", 200, ACK_HEADERS
 
 # ─────────────────────────────────────────────────────────────────────
 #  1.5) Endpoint for ESP32 to push its network config
@@ -54,6 +139,8 @@ def receive_config():
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"\n[ CONFIG RECEIVED at {ts} ]")
     print(json.dumps(data, indent=2))
+    # What it runs now: later dashboard pushes of the same values are skipped
+    config_store.record_reported(f"{request.remote_addr}:{ESP32_PORT}", data)
     return "CONFIG-ACK", 200, {"Connection": "close"}
 
 # ─────────────────────────────────────────────────────────────────────
@@ -61,7 +148,65 @@ def receive_config():
 # ─────────────────────────────────────────────────────────────────────
 @app.route('/data', methods=['GET'])
 def get_data():
-    return jsonify(received_data)
+    metrics.DASHBOARD_POLLS.inc()
+    at = request.args.get('at')
+    if at:
+        try:
+            at_ns = bms_records.parse_time(at)
+        except ValueError:
+            return jsonify({"error": f"bad at {at!r}"}), 400
+        return jsonify([r.to_dict() for r in bms_delta.records_at(received_data, at_ns)])
+    body = [r.to_dict() for r in bms_delta.iter_records(received_data)]
+    bms_latency.delivered(request)
+    if request.args.get('trace') == '1':
+        bms_latency.add_trace(body)
+    return jsonify(body)
+
+# ─────────────────────────────────────────────────────────────────────
+#  2.1) Per-hop latency: device sample -> receive -> commit -> /data poll
+# ─────────────────────────────────────────────────────────────────────
+@app.route('/api/latency', methods=['GET'])
+def get_latency():
+    body, status = bms_latency.latency_view(request)
+    return jsonify(body), status
+
+# ─────────────────────────────────────────────────────────────────────
+#  2.5) Active alarms & recent raise/clear events
+# ─────────────────────────────────────────────────────────────────────
+@app.route('/api/alarms', methods=['GET'])
+def get_alarms():
+    return jsonify(bms_alarms.alarms_view(alarm_engine, request))
+
+# ─────────────────────────────────────────────────────────────────────
+#  2.6) Energy / Ah / C-rate / SOC drift per slave
+# ─────────────────────────────────────────────────────────────────────
+@app.route('/api/derived', methods=['GET'])
+def get_derived():
+    return jsonify(derived.query(request.args.get('device'), request.args.get('slave'),
+                                 request.args.get('day')))
+
+# ─────────────────────────────────────────────────────────────────────
+#  2.7) Adaptive intervals: per-device volatility, intervals, bandwidth saved
+# ─────────────────────────────────────────────────────────────────────
+@app.route('/api/adaptive', methods=['GET'])
+def get_adaptive():
+    return jsonify(dict(interval_controller.view(), enabled=bms_adaptive.ENABLED))
+
+# ─────────────────────────────────────────────────────────────────────
+#  2.8) Aggregation queries over the history (?metric=&agg=&bucket=&last=)
+# ─────────────────────────────────────────────────────────────────────
+@app.route('/api/query', methods=['GET'])
+def query():
+    body, status = bms_query.query_view(received_data, request)
+    return jsonify(body), status
+
+# ─────────────────────────────────────────────────────────────────────
+#  2.9) Chart series downsampled to a pixel width (?metric=&slave=&last=&width=&algo=)
+# ─────────────────────────────────────────────────────────────────────
+@app.route('/api/series', methods=['GET'])
+def series():
+    body, status = bms_downsample.series_view(received_data, request)
+    return jsonify(body), status
 
 # ─────────────────────────────────────────────────────────────────────
 #  3) Dashboard & Config Page
@@ -79,13 +224,16 @@ def index():
             'networkInterval':request.form.get('networkInterval', '').strip()
         }
         try:
-            resp = requests.post(
-                f"http://{ESP32_IP}:{ESP32_PORT}/config",
-                 data=new_config,
-                timeout=5
-            )
-            if resp.ok:
-                flash("✅ Configuration sent to ESP32 successfully!")
+            changes, resp = bms_config.push(config_store, ESP32_KEY, new_config,
+                lambda cfg: metrics.proxy_call('config_post', requests.post,
+                    f"http://{ESP32_IP}:{ESP32_PORT}/config",
+                    data=cfg,
+                    timeout=5
+                ))
+            if resp is None:
+                flash("✅ ESP32 already runs this configuration – nothing sent")
+            elif resp.ok:
+                flash(f"✅ Configuration sent to ESP32 successfully! (changed: {', '.join(changes) or '-'})")
             else:
                 flash(f"⚠️ ESP32 responded: {resp.status_code} {resp.text}")
         except Exception as e:
@@ -98,9 +246,11 @@ def index():
         'modbusInterval':'', 'networkInterval':''
     }
     try:
-        cfg_resp = requests.get(f"http://{ESP32_IP}:{ESP32_PORT}/config", timeout=3)
+        cfg_resp = metrics.proxy_call('config_get', requests.get,
+                                      f"http://{ESP32_IP}:{ESP32_PORT}/config", timeout=3)
         if cfg_resp.ok:
             parsed = cfg_resp.json()
+            config_store.record_reported(ESP32_KEY, parsed)
             for key in esp_config:
                 esp_config[key] = parsed.get(key, '')
     except Exception as e:
@@ -149,10 +299,10 @@ def fw_upload():
     print(f"[ FW_UPLOAD ] Saved to {temp_path}")
 
     # NEW - USES CORRECT OTA PORT 8080
-    url = f"http://{ESP32_IP}:8080/update"
+    url = f"http://{ESP32_IP}:{OTA_PORT}/update"
     try:
         with open(temp_path, 'rb') as f_data:
-            resp = requests.post(
+            resp = metrics.proxy_call('firmware', requests.post,
                 url,
                 data=f_data,
                 headers={"Content-Type": "application/octet-stream"},
@@ -201,17 +351,17 @@ DASHBOARD_HTML = '''
           <div class="timestamp">${entry.timestamp}</div>
           <h3>BMS Status</h3>
           <div class="grid">
-            <div>Pack Voltage:       ${entry.data.pack_voltage} V</div>
-            <div>Current:            ${entry.data.current} A</div>
-            <div>Remaining Capacity: ${entry.data.capacity_remaining} Ah</div>
-            <div>SOC:                ${entry.data.soc}%</div>
-            <div>SOH:                ${entry.data.soh}%</div>
-            <div>Avg Cell Temp:      ${entry.data.avg_cell_temp} °C</div>
-            <div>Env Temp:           ${entry.data.env_temp} °C</div>
-            <div>Cycles:             ${entry.data.cycles}</div>
-            <div>Max Cell Voltage:   ${entry.data.max_cell_voltage} V</div>
-            <div>Min Cell Voltage:   ${entry.data.min_cell_voltage} V</div>
-            <div>Modbus Error:       ${entry.data.modbusError ? "Yes" : "No"}</div>
+            <div>Pack Voltage:       ${entry.pack_voltage} V</div>
+            <div>Current:            ${entry.current} A</div>
+            <div>Remaining Capacity: ${entry.capacity_remaining} Ah</div>
+            <div>SOC:                ${entry.soc}%</div>
+            <div>SOH:                ${entry.soh}%</div>
+            <div>Avg Cell Temp:      ${entry.avg_cell_temp} °C</div>
+            <div>Env Temp:           ${entry.env_temp} °C</div>
+            <div>Cycles:             ${entry.cycles}</div>
+            <div>Max Cell Voltage:   ${entry.max_cell_voltage} V</div>
+            <div>Min Cell Voltage:   ${entry.min_cell_voltage} V</div>
+            <div>Modbus Error:       ${entry.modbus_error ? "Yes" : "No"}</div>
           </div>`;
         container.appendChild(div);
       });
@@ -248,4 +398,13 @@ DASHBOARD_HTML = '''
 '''
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Poll Modbus-TCP units directly (not in the debug reloader's watcher process)
+    if bms_modbus.TARGETS_FILE and (bms_keepalive.ENABLED or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        bms_modbus.start_poller(bms_modbus.TARGETS_FILE,
+                                lambda device, records: store_records(device, records, 'modbus'))
+    if bms_adaptive.ENABLED and (bms_keepalive.ENABLED or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        interval_controller.start()
+    if bms_keepalive.ENABLED:
+        bms_keepalive.serve(app, '0.0.0.0', 5000)
+    else:
+        app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,163 @@
+"""
+Per-device sharded in-memory store.
+
+One global deque behind one lock makes every ingest thread (TCP
+connections, UDP batches, HTTP requests) queue up behind each other.
+:class:`ShardedStore` gives every device its own ring buffer and its own
+lock, so writers for different devices never touch the same lock; the
+shard table itself is only locked when a new device shows up.
+
+Every entry is stamped with a global arrival number (``itertools.count``
+is atomic under the GIL), so cross-device reads can rebuild the exact
+arrival order with a k-way merge over per-shard snapshots
+(:meth:`ShardedStore.merged`) without ever locking more than one shard at
+a time.
+
+A store can also be capped in total (``max_total``): a single device may
+then keep up to the whole budget, while many devices share it, the oldest
+entries across all shards going first.  The check runs every
+``TRIM_EVERY`` stored entries, so the store may briefly exceed the cap by
+that much; shards that are emptied this way are dropped, so memory stays
+bounded however many distinct device ids show up.
+
+    store = ShardedStore(max_total=100_000)
+    store.extend(device, entries)
+    for entry in store.merged(): ...             # oldest first, all devices
+    store.newest(50)                             # newest first
+
+``bench_shards.py`` compares it with a single-lock deque at 1..N threads.
+"""
+import heapq
+import itertools
+import threading
+from collections import deque
+from operator import itemgetter
+
+SHARD_MAX = 20_000          # entries kept per device when there is no total cap
+TRIM_EVERY = 1024           # stored entries between checks of the total cap
+
+
+class _Shard:
+    __slots__ = ('lock', 'items', 'dead')
+
+    def __init__(self, maxlen):
+        self.lock = threading.Lock()
+        self.items = deque(maxlen=maxlen)      # (arrival number, entry)
+        self.dead = False                      # emptied by a trim and removed from the table
+
+
+class ShardedStore:
+    def __init__(self, per_device=None, max_total=None):
+        self.per_device = per_device or max_total or SHARD_MAX
+        self.max_total = max_total
+        self.shards = {}
+        self.table_lock = threading.Lock()      # only taken to add or drop a shard
+        self.trim_lock = threading.Lock()
+        self._arrival = itertools.count()
+        self._since_trim = 0
+
+    def shard(self, device):
+        shard = self.shards.get(device)
+        if shard is None:
+            with self.table_lock:
+                shard = self.shards.get(device)
+                if shard is None:
+                    shard = self.shards[device] = _Shard(self.per_device)
+        return shard
+
+    def extend(self, device, entries):
+        shard = self.shard(device)
+        arrival = self._arrival
+        stamped = [(next(arrival), e) for e in entries]
+        while True:
+            with shard.lock:
+                if not shard.dead:
+                    shard.items.extend(stamped)
+                    break
+            shard = self.shard(device)          # trimmed away meanwhile: use its successor
+        if self.max_total is not None:
+            self._since_trim += len(stamped)    # unlocked: only decides when to look
+            if self._since_trim >= TRIM_EVERY:
+                self.trim()
+
+    def append(self, device, entry):
+        self.extend(device, (entry,))
+
+    def snapshots(self, devices=None):
+        """``{device: [(arrival, entry)]}``, each copied under its own shard lock."""
+        out = {}
+        for device, shard in list(self.shards.items()):
+            if devices is not None and device not in devices:
+                continue
+            with shard.lock:
+                out[device] = list(shard.items)
+        return out
+
+    def merged(self, devices=None):
+        """Entries of all (or the given) devices in arrival order, oldest first."""
+        runs = self.snapshots(devices).values()
+        return map(itemgetter(1), heapq.merge(*runs, key=itemgetter(0)))
+
+    def newest(self, n=None, devices=None):
+        """Newest ``n`` entries (all if ``None``), newest first."""
+        runs = [reversed(run) for run in self.snapshots(devices).values()]
+        newest = heapq.merge(*runs, key=itemgetter(0), reverse=True)
+        if n is not None:
+            newest = itertools.islice(newest, n)
+        return [entry for _, entry in newest]
+
+    def trim(self):
+        """Drop the oldest entries across all shards until the store fits ``max_total``."""
+        if self.max_total is None or not self.trim_lock.acquire(blocking=False):
+            return 0
+        try:
+            self._since_trim = 0
+            shards = list(self.shards.items())
+            excess = sum(len(shard.items) for _, shard in shards) - self.max_total
+            if excess <= 0:
+                return 0
+            dropped = excess
+            heads = []
+            for device, shard in shards:
+                with shard.lock:
+                    if shard.items:
+                        heads.append((shard.items[0][0], device, shard))
+            heapq.heapify(heads)
+            while excess > 0 and heads:
+                _, device, shard = heapq.heappop(heads)
+                limit = heads[0][0] if heads else None
+                with shard.lock:
+                    items = shard.items
+                    while excess > 0 and items and (limit is None or items[0][0] < limit):
+                        items.popleft()
+                        excess -= 1
+                    if items:
+                        heapq.heappush(heads, (items[0][0], device, shard))
+                    else:
+                        with self.table_lock:
+                            if self.shards.get(device) is shard:
+                                del self.shards[device]
+                                shard.dead = True
+            return dropped - excess
+        finally:
+            self.trim_lock.release()
+
+    def sample(self, k=64):
+        """Up to about ``k`` entries spread over the shards (for size estimates)."""
+        shards = list(self.shards.values())
+        if len(shards) > k:
+            shards = shards[::len(shards) // k]
+        per = max(1, k // max(len(shards), 1))
+        out = []
+        for shard in shards:
+            with shard.lock:
+                items = shard.items
+                n = len(items)
+                out.extend(items[i][1] for i in range(0, n, max(1, n // per)))
+        return out
+
+    def devices(self):
+        return {device: len(shard.items) for device, shard in list(self.shards.items())}
+
+    def __len__(self):
+        return sum(len(shard.items) for shard in list(self.shards.values()))
@@ -0,0 +1,244 @@
+"""
+Fast warm restart: rebuild recent in-memory state from disk on startup.
+
+Every accepted packet is appended to a small per-server journal
+(``journal/<server>_<date>.jsonl``, one JSON object per line, the last
+``JOURNAL_KEEP_DAYS`` days kept).  On startup the newest journal files are
+memory-mapped and read *backwards* from the end, so only the tail that fits
+in the ring buffer is ever touched, and parsing stops when the time budget
+(``BMS_WARM_START_BUDGET_S``, default 5 s) runs out – whatever was recovered
+by then is used, newest data first.
+
+    journal = bms_warmstart.Journal('bms_server')
+    records, stats = bms_warmstart.restore_records(journal, max_records)
+    received_data.extend(records)                         # ring buffer
+    bms_warmstart.replay_rollups(records, alarm_engine, derived)
+
+The time taken and the amount recovered are printed and exported as
+``bms_warm_start_seconds`` / ``bms_warm_start_items`` at ``/metrics``.
+
+Journal writes are group-committed: ``write()`` serializes its lines in the
+calling thread and hands them to one writer thread, which appends whatever
+has queued up with a single write + flush and then releases every waiting
+caller (re-raising a write error in each).  Ingest threads therefore never
+hold a lock across file I/O, and a burst costs one flush instead of one per
+packet.  ``group_commit=False`` writes inline under a lock instead.
+"""
+import json
+import mmap
+import os
+import queue
+import re
+import threading
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+import bms_derived
+import bms_metrics as metrics
+from bms_records import SlaveRecord
+
+JOURNAL_DIR = os.environ.get('BMS_JOURNAL_DIR', 'journal')
+JOURNAL_KEEP_DAYS = 2
+WARM_START_BUDGET_S = float(os.environ.get('BMS_WARM_START_BUDGET_S', 5.0))
+
+WARM_START_SECONDS = metrics.Gauge('bms_warm_start_seconds', 'Time spent restoring state on startup',
+                                   ('server',))
+WARM_START_ITEMS = metrics.Gauge('bms_warm_start_items', 'Entries restored from the journal on startup',
+                                 ('server',))
+JOURNAL_BATCH = metrics.Histogram('bms_journal_commit_batch', 'Journal writes group-committed per flush',
+                                  buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+
+
+class Journal:
+    """Append-only JSON-lines journal of what a server accepted, one file per day."""
+
+    def __init__(self, name, journal_dir=JOURNAL_DIR, keep_days=JOURNAL_KEEP_DAYS, group_commit=True):
+        self.name = name
+        self.dir = journal_dir
+        self.keep_days = keep_days
+        self.lock = threading.Lock()
+        self.day = None
+        self.file = None
+        self._pattern = re.compile(rf'^{re.escape(name)}_(\d{{4}}-\d{{2}}-\d{{2}})\.jsonl$')
+        os.makedirs(journal_dir, exist_ok=True)
+        self.queue = None
+        if group_commit:
+            self.queue = queue.SimpleQueue()       # (blob, _Commit)
+            threading.Thread(target=self._writer, daemon=True).start()
+
+    def path_for(self, day):
+        return os.path.join(self.dir, f"{self.name}_{day}.jsonl")
+
+    def files(self):
+        """Journal files, newest first."""
+        days = sorted((m.group(1) for m in map(self._pattern.match, os.listdir(self.dir)) if m),
+                      reverse=True)
+        return [self.path_for(d) for d in days]
+
+    def write(self, items):
+        """Append JSON-serializable items (one line each) and flush."""
+        if not items:
+            return
+        blob = ''.join(json.dumps(item) + '\n' for item in items)
+        if self.queue is None:
+            self._append(blob)
+            return
+        commit = _Commit()
+        self.queue.put((blob, commit))
+        commit.done.wait()
+        if commit.error is not None:
+            raise commit.error
+
+    def _append(self, blob):
+        today = date.today().isoformat()
+        with self.lock:
+            if today != self.day:
+                self._rotate(today)
+            self.file.write(blob)
+            self.file.flush()
+
+    def _writer(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            error = None
+            try:
+                self._append(''.join(blob for blob, _ in batch))
+            except Exception as e:
+                error = e
+            JOURNAL_BATCH.observe(len(batch))
+            for _, commit in batch:
+                commit.error = error
+                commit.done.set()
+
+    def _rotate(self, today):
+        if self.file is not None:
+            self.file.close()
+        self.day = today
+        self.file = open(self.path_for(today), 'a')
+        cutoff = (date.today() - timedelta(days=self.keep_days)).isoformat()
+        for path in self.files():
+            if os.path.basename(path)[len(self.name) + 1:-len('.jsonl')] <= cutoff:
+                os.remove(path)
+
+
+class _Commit:
+    __slots__ = ('done', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+def tail_lines(path, max_lines, deadline):
+    """Up to ``max_lines`` last lines of a file (oldest first), read backwards via mmap."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            lines = []
+            end = len(mm)
+            while end > 0 and len(lines) < max_lines:
+                if len(lines) % 1024 == 0 and time.monotonic() > deadline:
+                    break
+                start = mm.rfind(b'\n', 0, end - 1) + 1
+                line = mm[start:end].strip()
+                if line:
+                    lines.append(line)
+                end = start
+    lines.reverse()
+    return lines
+
+
+def load_tail(journal, max_items, budget_s=WARM_START_BUDGET_S):
+    """Newest ``max_items`` journal entries (oldest first) and restore stats."""
+    t0 = time.monotonic()
+    deadline = t0 + budget_s
+    chunks, count, bad, files = [], 0, 0, 0
+    for path in journal.files():
+        if count >= max_items or time.monotonic() > deadline:
+            break
+        files += 1
+        parsed = []
+        # Scanning gets half the budget, parsing the rest; parse newest first
+        # so a blown budget still keeps the latest state
+        lines = tail_lines(path, max_items - count, t0 + budget_s / 2)
+        for line in reversed(lines):
+            if time.monotonic() > deadline:
+                break
+            try:
+                parsed.append(json.loads(line))
+            except ValueError:
+                bad += 1          # e.g. a line cut short by the crash
+        parsed.reverse()
+        chunks.append(parsed)
+        count += len(parsed)
+    items = [item for chunk in reversed(chunks) for item in chunk]
+    stats = {"server": journal.name, "items": len(items), "files": files, "bad_lines": bad,
+             "seconds": round(time.monotonic() - t0, 4),
+             "budget_exceeded": time.monotonic() > deadline}
+    return items, stats
+
+
+def report(stats):
+    WARM_START_SECONDS.set(stats["seconds"], stats["server"])
+    WARM_START_ITEMS.set(stats["items"], stats["server"])
+    note = " (time budget exceeded, kept newest)" if stats["budget_exceeded"] else ""
+    print(f"♻️ Warm start: restored {stats['items']} entries from {stats['files']} journal file(s) "
+          f"in {stats['seconds'] * 1000:.1f} ms{note}")
+
+
+def restore_entries(journal, max_items, budget_s=WARM_START_BUDGET_S):
+    """Raw journal entries for stores that keep packets as dicts; prints the report."""
+    items, stats = load_tail(journal, max_items, budget_s)
+    report(stats)
+    return items, stats
+
+
+def restore_records(journal, max_records, budget_s=WARM_START_BUDGET_S):
+    """Journaled ``SlaveRecord`` s (oldest first); prints the report."""
+    t0 = time.monotonic()
+    items, stats = load_tail(journal, max_records, budget_s)
+    records = []
+    for d in items:
+        try:
+            records.append(SlaveRecord.from_dict(d))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            stats["bad_lines"] += 1
+    stats["seconds"] = round(time.monotonic() - t0, 4)
+    report(stats)
+    return records, stats
+
+
+def _last_sample(derived, device, slave):
+    st = derived.state.get(derived.key(device, slave))
+    return (st and st["last_t"]) or 0
+
+
+def replay_rollups(records, alarm_engine=None, derived=None):
+    """Re-run restored records through the alarm engine and derived metrics.
+
+    Alarms get the whole window, so active alarms, debounce timers and the
+    recent event list come back.  Derived metrics already persist their own
+    snapshot; only samples newer than a slave's last snapshotted sample are
+    integrated, so nothing is counted twice.
+    """
+    packets = defaultdict(list)
+    # The alarm engine runs on the monotonic clock
+    mono_offset = time.monotonic() - time.time()
+    for rec in records:
+        packets[(rec.ts_ns, rec.device)].append(rec)
+    for (ts_ns, device), recs in packets.items():
+        now = ts_ns / 1e9
+        if alarm_engine is not None:
+            alarm_engine.evaluate(device, recs, now=now + mono_offset)
+        if derived is not None:
+            fresh = [r for r in recs
+                     if _last_sample(derived, device, r.slave) < bms_derived.sample_time(r, now)[0]]
+            if fresh:
+                derived.update(device, fresh, now=now)
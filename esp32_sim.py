@@ -0,0 +1,304 @@
+"""
+Local fleet of virtual ESP32 gateways for load-testing the config, OTA and
+telemetry paths without hardware.
+
+Each device serves what the firmware serves:
+
+    GET  :<config port>/config   current network config as JSON
+    POST :<config port>/config   new config, form-encoded or JSON
+    POST :<ota port>/update      firmware image, "flashed" at --flash-kbps,
+                                 then the device reboots for --reboot-s
+
+and pushes telemetry to the server's ``/update`` every ``networkInterval``
+ms of its *current* config (so pushing a new interval changes the load),
+one fresh connection per sample like the firmware.
+
+Devices are spread over loopback addresses (127.0.1.1, 127.0.1.2, … all on
+the same two ports, so the servers' ESP32_IP/ESP32_PORT/ESP32_OTA_PORT
+overrides can point at any of them) or, with ``--spread port``, over
+consecutive port pairs on one address.  ``--latency-ms`` and
+``--fail-rate`` apply to every config/OTA request.
+
+    ESP32_IP=127.0.1.1 ESP32_PORT=8081 ESP32_OTA_PORT=8082 python bms_server.py
+    python esp32_sim.py --devices 200 --server http://127.0.0.1:5000/update \\
+        --bench http://127.0.0.1:5000 --out results/esp32_sim.json
+
+``--bench`` times the three operator paths once the fleet is up: the
+dashboard's config proxy (``GET``/``POST /`` on the server, which calls the
+first device), a bulk config push straight to every device, and firmware
+upload through ``/fw`` (``--fw-kb`` image).
+"""
+import argparse
+import asyncio
+import ipaddress
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+
+from bench_fleet import _ms, make_packet, percentile
+
+DEFAULT_CONFIG = {
+    "localIP": "", "gateway": "192.168.100.1", "subnet": "255.255.255.0",
+    "serverIP": "127.0.0.1", "serverPort": 5000,
+    "modbusInterval": 500, "networkInterval": 2000,
+}
+
+STATS = {"config_get": 0, "config_post": 0, "ota": 0, "ota_bytes": 0, "failed": 0,
+         "telemetry_sent": 0, "telemetry_acked": 0}
+
+
+async def read_request(reader):
+    """(method, path, headers, body) of one HTTP request, or None on EOF."""
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, _ = line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        h = await reader.readline()
+        if h in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = h.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        return method, target, headers, b''.join(chunks)
+    body = await reader.readexactly(int(headers.get('content-length', 0) or 0))
+    return method, target, headers, body
+
+
+def response(status, body, content_type='text/plain'):
+    if isinstance(body, str):
+        body = body.encode()
+    return (f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode() + body
+
+
+class VirtualESP32:
+    def __init__(self, name, ip, config_port, ota_port, args):
+        self.name, self.ip = name, ip
+        self.config_port, self.ota_port = config_port, ota_port
+        self.args = args
+        self.config = dict(DEFAULT_CONFIG, localIP=ip)
+        self.firmware = {"version": 1, "size": 0}
+        self.rebooting_until = 0.0
+        self.flashing = None        # one OTA at a time, like the firmware's single-task server
+        self.seq = 0
+
+    async def start(self):
+        self.flashing = asyncio.Lock()
+        await asyncio.start_server(self.handle_config, self.ip, self.config_port)
+        await asyncio.start_server(self.handle_ota, self.ip, self.ota_port)
+        if self.args.server:
+            asyncio.get_running_loop().create_task(self.telemetry())
+
+    async def _misbehave(self, writer):
+        """Apply latency / failure injection; True if the request was failed."""
+        if self.args.latency_ms:
+            await asyncio.sleep(random.expovariate(1000.0 / self.args.latency_ms))
+        if time.monotonic() < self.rebooting_until or random.random() < self.args.fail_rate:
+            STATS["failed"] += 1
+            writer.close()          # like a device that just drops the connection
+            return True
+        return False
+
+    async def handle_config(self, reader, writer):
+        try:
+            req = await read_request(reader)
+            if req is None or await self._misbehave(writer):
+                return
+            method, target, headers, body = req
+            if urlsplit(target).path != '/config':
+                writer.write(response("404 Not Found", "Not found"))
+            elif method == 'GET':
+                STATS["config_get"] += 1
+                writer.write(response("200 OK", json.dumps(self.config), 'application/json'))
+            elif method == 'POST':
+                STATS["config_post"] += 1
+                if 'json' in headers.get('content-type', ''):
+                    update = json.loads(body or b'{}')
+                else:
+                    update = dict(parse_qsl(body.decode()))
+                for key, value in update.items():
+                    if key in self.config and value != '':
+                        self.config[key] = int(value) if key.endswith(('Interval', 'Port')) else value
+                writer.write(response("200 OK", "Config saved"))
+            else:
+                writer.write(response("405 Method Not Allowed", "Method not allowed"))
+            await writer.drain()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_ota(self, reader, writer):
+        try:
+            req = await read_request(reader)
+            if req is None or await self._misbehave(writer):
+                return
+            method, target, _, body = req
+            if method != 'POST' or urlsplit(target).path != '/update':
+                writer.write(response("404 Not Found", "Not found"))
+                return
+            # Flash at the configured throughput, then reboot
+            async with self.flashing:
+                await asyncio.sleep(len(body) / (self.args.flash_kbps * 1024.0))
+            STATS["ota"] += 1
+            STATS["ota_bytes"] += len(body)
+            self.firmware = {"version": self.firmware["version"] + 1, "size": len(body)}
+            self.rebooting_until = time.monotonic() + self.args.reboot_s
+            writer.write(response("200 OK", "Update Success! Rebooting..."))
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def telemetry(self):
+        url = urlsplit(self.args.server)
+        await asyncio.sleep(random.uniform(0, self.config["networkInterval"] / 1000.0))
+        while True:
+            interval = max(int(self.config.get("networkInterval") or 2000), 50) / 1000.0
+            await asyncio.sleep(interval)
+            if time.monotonic() < self.rebooting_until:
+                continue
+            self.seq += 1
+            body = urlencode({"data": json.dumps(
+                make_packet(self.args.shape, self.name, self.seq, self.args.slaves))}).encode()
+            STATS["telemetry_sent"] += 1
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(url.hostname, url.port or 80, local_addr=(self.ip, 0)), 5)
+                writer.write((f"POST {url.path or '/update'} HTTP/1.1\r\nHost: {url.netloc}\r\n"
+                              f"Content-Type: application/x-www-form-urlencoded\r\n"
+                              f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode() + body)
+                status = await asyncio.wait_for(reader.readline(), 5)
+                if b' 200 ' in status:
+                    STATS["telemetry_acked"] += 1
+                writer.close()
+            except (OSError, asyncio.TimeoutError):
+                pass
+
+
+def device_addresses(n, spread, ip, config_port, ota_port):
+    base = ipaddress.ip_address(ip)
+    for i in range(n):
+        if spread == 'ip':
+            yield str(base + i), config_port, ota_port
+        else:
+            yield ip, config_port + 2 * i, config_port + 2 * i + 1
+
+
+# ─────────────────────────────────────────────────────────────────────
+#  Benchmark of the proxy, bulk-config and firmware paths
+# ─────────────────────────────────────────────────────────────────────
+def timed(fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    try:
+        ok = fn(*args, **kwargs).status_code < 400
+    except requests.RequestException:
+        ok = False
+    return time.perf_counter() - t0, ok
+
+
+def summarize(timings, elapsed):
+    lat = sorted(t for t, ok in timings if ok)
+    return {"requests": len(timings), "failed": sum(1 for _, ok in timings if not ok),
+            "per_second": round(len(timings) / elapsed, 1) if elapsed else None,
+            "p50_ms": _ms(percentile(lat, 50)), "p95_ms": _ms(percentile(lat, 95)),
+            "max_ms": _ms(lat[-1] if lat else None)}
+
+
+def run_bench(args, devices):
+    server = args.bench.rstrip('/')
+    config = {k: str(v) for k, v in DEFAULT_CONFIG.items() if k != 'localIP'}
+    firmware = os.urandom(args.fw_kb * 1024)
+    # Redirects are not followed: the response to time is the proxied call.
+    # Firmware goes last and one at a time: each upload reboots the first device.
+    plan = [
+        ("proxy_get", args.rounds, args.concurrency, lambda i: timed(requests.get, f"{server}/", timeout=30)),
+        ("proxy_post", args.rounds, args.concurrency, lambda i: timed(
+            requests.post, f"{server}/", data=config, allow_redirects=False, timeout=30)),
+        ("bulk_config", len(devices), args.concurrency, lambda i: timed(
+            requests.post, f"http://{devices[i].ip}:{devices[i].config_port}/config",
+            data=config, timeout=30)),
+        ("firmware", max(1, args.rounds // 10), 1, lambda i: time.sleep(args.reboot_s if i else 0) or timed(
+            requests.post, f"{server}/fw", files={"fw": ("sim.bin", firmware)},
+            allow_redirects=False, timeout=120)),
+    ]
+    report = {"devices": len(devices), "concurrency": args.concurrency, "fw_kb": args.fw_kb,
+              "latency_ms": args.latency_ms, "fail_rate": args.fail_rate,
+              "flash_kbps": args.flash_kbps, "paths": {}}
+    for name, n, concurrency, call in plan:
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            timings = list(pool.map(call, range(n)))
+        report["paths"][name] = summarize(timings, time.perf_counter() - t0)
+        print(f"⏱️ {name}: {report['paths'][name]}")
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"📝 Results written to {args.out}")
+    return report
+
+
+async def main(args):
+    devices = []
+    for i, (ip, cport, oport) in enumerate(device_addresses(
+            args.devices, args.spread, args.ip, args.config_port, args.ota_port)):
+        dev = VirtualESP32(f"esp32-sim-{i:04d}", ip, cport, oport, args)
+        await dev.start()
+        devices.append(dev)
+    print(f"🧪 {len(devices)} virtual ESP32s up ({devices[0].ip}:{devices[0].config_port} … "
+          f"{devices[-1].ip}:{devices[-1].config_port}), telemetry → {args.server or 'off'}")
+    if args.write_devices:
+        with open(args.write_devices, 'w') as f:
+            json.dump([{"name": d.name, "ip": d.ip, "config_port": d.config_port,
+                        "ota_port": d.ota_port} for d in devices], f, indent=2)
+        print(f"📝 Wrote device list to {args.write_devices}")
+    if args.bench:
+        await asyncio.get_running_loop().run_in_executor(None, run_bench, args, devices)
+        return
+    while True:
+        await asyncio.sleep(10)
+        print("📈 " + ", ".join(f"{k}={v}" for k, v in STATS.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulate a fleet of ESP32 gateways")
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--spread', choices=('ip', 'port'), default='ip',
+                        help="one loopback address per device, or consecutive ports on --ip")
+    parser.add_argument('--ip', default='127.0.1.1', help="first (or only) device address")
+    parser.add_argument('--config-port', type=int, default=8081)
+    parser.add_argument('--ota-port', type=int, default=8082)
+    parser.add_argument('--server', help="telemetry target, e.g. http://127.0.0.1:5000/update")
+    parser.add_argument('--shape', choices=('legacy', 'short', 'long'), default='long')
+    parser.add_argument('--slaves', type=int, default=4)
+    parser.add_argument('--latency-ms', type=float, default=20.0, help="mean config/OTA response delay")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="share of config/OTA requests dropped")
+    parser.add_argument('--flash-kbps', type=float, default=100.0, help="OTA flash throughput (KiB/s)")
+    parser.add_argument('--reboot-s', type=float, default=3.0)
+    parser.add_argument('--write-devices', help="write the device address list as JSON")
+    parser.add_argument('--bench', metavar='SERVER_URL', help="benchmark config/firmware paths, then exit")
+    parser.add_argument('--rounds', type=int, default=200, help="proxy requests per benchmark path")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--fw-kb', type=int, default=256, help="firmware image size for the benchmark")
+    parser.add_argument('--out', help="write benchmark results as JSON")
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,162 @@
+"""
+Local Modbus-TCP simulator for testing the native poller at fleet scale.
+
+Serves ``--units`` BMS slaves (unit ids 1..N) on each of ``--servers``
+consecutive ports, all using ``bms_modbus.DEFAULT_MAP``.  Values drift
+slowly like a real pack (current swings, SOC follows it, temperatures
+wander).  ``--latency-ms`` delays every answer, ``--drop-rate`` silently
+ignores a share of requests (the poller sees a timeout) and
+``--exception-rate`` answers with Modbus exception 4 (slave device
+failure).  Unknown unit ids get exception 0x0B like a real gateway.
+
+    python modbus_sim.py --servers 4 --units 100 --write-targets modbus_targets.json
+    BMS_MODBUS_TARGETS=modbus_targets.json python bms_server.py
+"""
+import argparse
+import asyncio
+import json
+import random
+import struct
+
+import bms_modbus
+
+ILLEGAL_ADDRESS = 0x02
+DEVICE_FAILURE = 0x04
+GATEWAY_NO_RESPONSE = 0x0B
+REGISTER_SPACE = 0x100       # unmapped registers below this read as 0
+
+
+class SimulatedPack:
+    """Registers of one BMS unit, refreshed from a slow random walk."""
+
+    def __init__(self, register_map):
+        self.map = register_map
+        self.soc = random.uniform(30, 95)
+        self.current = random.uniform(-20, 20)
+        self.temp = random.uniform(22, 30)
+        self.cycles = random.randint(50, 400)
+        self.registers = {}
+        self.step()
+
+    def step(self):
+        self.current = max(-50.0, min(50.0, self.current + random.gauss(0, 1.5)))
+        self.soc = max(0.0, min(100.0, self.soc + self.current * 0.0005))
+        self.temp += random.gauss(0, 0.05)
+        cell = 3.0 + 0.004 * self.soc
+        values = {
+            'pack_voltage': cell * 16, 'current': self.current,
+            'capacity_remaining': self.soc, 'soc': self.soc, 'soh': 98.5,
+            'avg_cell_temp': self.temp, 'env_temp': 25.0, 'cycles': self.cycles,
+            'max_cell_voltage': cell + 0.01, 'min_cell_voltage': cell - 0.01,
+            'warn': 1 if self.temp > 45 else 0, 'prot': 0,
+        }
+        for name, spec in self.map.items():
+            address, scale, signed, words = bms_modbus.parse_field(spec)
+            raw = int(round(values.get(name, 0) / scale))
+            if raw < 0:
+                raw += 1 << (16 * words)
+            for i in range(words):
+                self.registers[address + i] = (raw >> (16 * (words - 1 - i))) & 0xFFFF
+
+    def read(self, start, count):
+        if start + count > REGISTER_SPACE:
+            return None
+        return [self.registers.get(a, 0) for a in range(start, start + count)]
+
+
+class Simulator:
+    def __init__(self, units, latency_s=0.0, drop_rate=0.0, exception_rate=0.0,
+                 register_map=bms_modbus.DEFAULT_MAP):
+        self.packs = {u: SimulatedPack(register_map) for u in range(1, units + 1)}
+        self.latency = latency_s
+        self.drop_rate = drop_rate
+        self.exception_rate = exception_rate
+        self.requests = 0
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                tid, _, length, unit = struct.unpack('>HHHB', header)
+                pdu = await reader.readexactly(length - 1)
+                self.requests += 1
+                asyncio.get_running_loop().create_task(self.answer(writer, tid, unit, pdu))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def answer(self, writer, tid, unit, pdu):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if random.random() < self.drop_rate:
+            return
+        function = pdu[0]
+        pack = self.packs.get(unit)
+        if pack is None:
+            reply = bytes([function | 0x80, GATEWAY_NO_RESPONSE])
+        elif function not in (3, 4) or len(pdu) < 5:
+            reply = bytes([function | 0x80, 0x01])
+        elif random.random() < self.exception_rate:
+            reply = bytes([function | 0x80, DEVICE_FAILURE])
+        else:
+            start, count = struct.unpack('>HH', pdu[1:5])
+            values = pack.read(start, count)
+            if values is None or not 1 <= count <= 125:
+                reply = bytes([function | 0x80, ILLEGAL_ADDRESS])
+            else:
+                reply = struct.pack(f'>BB{count}H', function, 2 * count, *values)
+        if not writer.is_closing():
+            writer.write(struct.pack('>HHHB', tid, 0, len(reply) + 1, unit) + reply)
+
+    async def drift(self, every_s=0.5):
+        while True:
+            await asyncio.sleep(every_s)
+            for pack in self.packs.values():
+                pack.step()
+
+
+def write_targets(path, host, ports, units, interval_ms):
+    targets = [{"host": host, "port": port, "unit": u, "interval_ms": interval_ms,
+                "device": f"modbus-sim-{port}", "slave": u}
+               for port in ports for u in range(1, units + 1)]
+    with open(path, 'w') as f:
+        json.dump({"timeout_s": 1.0, "targets": targets}, f, indent=2)
+    print(f"📝 Wrote {len(targets)} targets to {path}")
+
+
+async def main(args):
+    sims = []
+    ports = range(args.port, args.port + args.servers)
+    for port in ports:
+        sim = Simulator(args.units, args.latency_ms / 1000.0, args.drop_rate, args.exception_rate)
+        await asyncio.start_server(sim.handle, args.host, port)
+        asyncio.get_running_loop().create_task(sim.drift())
+        sims.append(sim)
+    print(f"🧪 Simulating {args.servers} × {args.units} Modbus units on {args.host}:{ports.start}-{ports.stop - 1}")
+    if args.write_targets:
+        write_targets(args.write_targets, args.host, ports, args.units, args.interval_ms)
+    last = 0
+    while True:
+        await asyncio.sleep(10)
+        total = sum(s.requests for s in sims)
+        print(f"📈 {(total - last) / 10:.0f} requests/s")
+        last = total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulate Modbus-TCP BMS units")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=15020, help="first port")
+    parser.add_argument('--servers', type=int, default=1, help="number of ports (gateways)")
+    parser.add_argument('--units', type=int, default=100, help="units per gateway (max 247)")
+    parser.add_argument('--latency-ms', type=float, default=2.0)
+    parser.add_argument('--drop-rate', type=float, default=0.0)
+    parser.add_argument('--exception-rate', type=float, default=0.0)
+    parser.add_argument('--interval-ms', type=int, default=bms_modbus.DEFAULT_INTERVAL_MS,
+                        help="poll interval written to the targets file")
+    parser.add_argument('--write-targets', help="also write a BMS_MODBUS_TARGETS file for these units")
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -1,20 +1,87 @@
+import select
 import socket
 import threading
 from flask import Flask, request, jsonify, render_template_string
-from datetime import datetime
 import json
+import time
+import bms_metrics as metrics
+import bms_profiling
+import bms_dedup
+import bms_records
+import bms_warmstart
+import bms_loss
+import bms_shards
+import bms_ratelimit
+import bms_capture
+import bms_latency
 
 app = Flask(__name__)
+metrics.instrument_app(app)
+bms_profiling.install_profiler(app)
+bms_capture.install(app)      # BMS_CAPTURE=<file>: raw ingest bodies for replay_traffic.py
 
-# Thread-safe data storage
-received_data = []
-data_lock = threading.Lock()
+# Thread-safe data storage: one ring buffer + lock per device, merged on read.
+# HISTORY_MAX bounds the whole store: one device may use all of it, many share it.
+HISTORY_MAX = 100_000
+received_data = bms_shards.ShardedStore(max_total=HISTORY_MAX)
+dedup = bms_dedup.DedupCache()
+metrics.register_store(lambda: received_data)     # len() and sample(): no copy of the store
+
+def entry_device(entry):
+    # "tcp:10.0.0.7:51234" -> 10.0.0.7 when the payload names no device
+    source = entry.get("source", "").split(':')
+    return bms_records.device_id(entry.get("data"), source[1] if len(source) > 1 else None)
+
+# Journal of accepted entries; its tail refills the ring buffers on restart
+journal = bms_warmstart.Journal('server2')
+for _entry in bms_warmstart.restore_entries(journal, HISTORY_MAX)[0]:
+    received_data.append(entry_device(_entry), _entry)
+
+def new_entry(ts_ns, source, data_type, payload):
+    # Epoch-ns receive time (and the device's own sample time, if it sent one);
+    # the text timestamp is only made when the entry is served
+    entry = {"ts_ns": ts_ns, "source": source, "type": data_type, "data": payload}
+    sample_ns = bms_records.sample_time_ns(payload)
+    if sample_ns is not None:
+        entry["sample_ns"] = sample_ns
+    return entry
+
+def entry_view(entry):
+    if "ts_ns" not in entry:
+        return entry        # restored from a journal written before ts_ns
+    # ISO text to the microsecond, as /api/data served it before ts_ns
+    return dict(entry, timestamp=bms_records.format_ns(entry["ts_ns"], iso=True))
+
+def store_entries(device, entries, path, key=None):
+    try:
+        journal.write(entries)
+    except Exception:
+        dedup.forget(key)       # not stored: the device's retry must not count as a duplicate
+        raise
+    # Into memory only once journaled, so a failed write leaves nothing for the retry to double
+    received_data.extend(device, entries)
+    for entry in entries:
+        bms_latency.committed_entry(path, device, entry)
 
 # Configuration
 TCP_HOST = "0.0.0.0"
 TCP_PORT = 5000
+UDP_PORT = 5000       # same number as TCP; UDP is a separate port space
+UDP_BATCH = 64        # datagrams drained per wakeup
+UDP_RCVBUF = 4 * 1024 * 1024
 HTTP_PORT = 8000
 
+udp_loss = bms_loss.LossTracker('udp')
+
+def decode_payload(data):
+    """JSON if the bytes parse as JSON, else the raw text (latin-1 fallback for binary)"""
+    try:
+        text = data.decode('utf-8').strip()
+        return text, json.loads(text), "json"
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        text = data.decode('latin-1').strip()
+        return text, text, "raw"
+
 def tcp_server():
     """Persistent TCP server to handle raw socket connections"""
     server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -38,32 +105,40 @@ def tcp_server():
 
 def handle_client_connection(conn, addr):
     """Handle individual client connections"""
+    metrics.TCP_CONNECTIONS.inc()
+    try:
+        _serve_connection(conn, addr)
+    finally:
+        metrics.TCP_CONNECTIONS.dec()
+
+def _serve_connection(conn, addr):
     with conn:
         while True:
             try:
                 data = conn.recv(4096)  # Increased buffer size
                 if not data:
                     break
+                bms_capture.record_frame('tcp', addr[0], data)
+                # Over its limit: stop reading this socket for a while (TCP pushes back)
+                bms_ratelimit.throttle(addr[0], len(data), 'tcp')
 
+                ts_ns = time.time_ns()
+                t0 = time.perf_counter()
                 # Try to parse as JSON if possible
-                try:
-                    text = data.decode('utf-8').strip()
-                    payload = json.loads(text)
-                    data_type = "json"
-                except (json.JSONDecodeError, UnicodeDecodeError):
-                    text = data.decode('latin-1').strip()  # Fallback for non-UTF-8
-                    payload = text
-                    data_type = "raw"
-
-                timestamp = datetime.now().isoformat()
-                
-                with data_lock:
-                    received_data.append({
-                        "timestamp": timestamp,
-                        "source": f"tcp:{addr[0]}:{addr[1]}",
-                        "type": data_type,
-                        "data": payload
-                    })
+                text, payload, data_type = decode_payload(data)
+                t1 = time.perf_counter()
+                metrics.DECODE_SECONDS.observe(t1 - t0, 'tcp')
+
+                device = bms_records.device_id(payload, addr[0])
+                key = bms_dedup.message_key(payload, device)
+                if dedup.is_duplicate(key):
+                    metrics.PACKETS.inc('tcp', device, 'duplicate')
+                    conn.sendall(b"ACK\n")
+                    continue
+
+                store_entries(device, [new_entry(ts_ns, f"tcp:{addr[0]}:{addr[1]}", data_type, payload)], 'tcp', key)
+                metrics.STORE_SECONDS.observe(time.perf_counter() - t1, 'tcp')
+                metrics.PACKETS.inc('tcp', device, 'accepted')
                 
                 print(f"📥 Received from {addr}: {text[:100]}...")  # Truncate long messages
                 
@@ -75,8 +150,73 @@ def handle_client_connection(conn, addr):
                 break
             except Exception as e:
                 print(f"Error handling client {addr}: {e}")
+                metrics.PACKETS.inc('tcp', addr[0], 'error')
                 break
 
+def udp_server():
+    """Fire-and-forget UDP telemetry, one packet per datagram, no ACK"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+    sock.bind((TCP_HOST, UDP_PORT))
+    sock.setblocking(False)
+    print(f"📡 UDP listener on {TCP_HOST}:{UDP_PORT}")
+
+    while True:
+        select.select([sock], [], [])
+        # No recvmmsg in Python: drain whatever is queued in one go instead,
+        # so a burst costs one wakeup, one lock and one journal write
+        batch = []
+        try:
+            while len(batch) < UDP_BATCH:
+                batch.append(sock.recvfrom(65535))
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            print(f"UDP receive error: {e}")
+        if batch:
+            try:
+                handle_udp_batch(batch)
+            except Exception as e:
+                print(f"UDP batch error: {e}")
+
+def handle_udp_batch(batch):
+    t0 = time.perf_counter()
+    ts_ns = time.time_ns()
+    entries = []
+    keys = []
+    by_device = {}
+    for data, addr in batch:
+        bms_capture.record_frame('udp', addr[0], data)
+        if not bms_ratelimit.admit(addr[0], len(data), 'udp'):
+            continue
+        text, payload, data_type = decode_payload(data)
+        device = bms_records.device_id(payload, addr[0])
+        key = bms_dedup.message_key(payload, device)
+        if dedup.is_duplicate(key):
+            metrics.PACKETS.inc('udp', device, 'duplicate')
+            continue
+        keys.append(key)
+        udp_loss.observe(device, payload)
+        entry = new_entry(ts_ns, f"udp:{addr[0]}:{addr[1]}", data_type, payload)
+        entries.append(entry)
+        by_device.setdefault(device, []).append(entry)
+        metrics.PACKETS.inc('udp', device, 'accepted')
+    t1 = time.perf_counter()
+    metrics.DECODE_SECONDS.observe((t1 - t0) / len(batch), 'udp')
+    try:
+        journal.write(entries)
+    except Exception:
+        for key in keys:        # nothing of this batch is safely stored
+            dedup.forget(key)
+        raise
+    for device, device_entries in by_device.items():
+        received_data.extend(device, device_entries)
+    metrics.STORE_SECONDS.observe(time.perf_counter() - t1, 'udp')
+    for device, device_entries in by_device.items():
+        for entry in device_entries:
+            bms_latency.committed_entry('udp', device, entry)
+    print(f"📥 Received {len(entries)} UDP packet(s)")
+
 @app.route('/')
 def dashboard():
     """Web dashboard showing all received data"""
@@ -117,57 +257,81 @@ def dashboard():
     </html>
     """
     
-    with data_lock:
-        return render_template_string(
-            html,
-            data=reversed(received_data),  # Show newest first
-            count=len(received_data),
-            tcp_host=TCP_HOST,
-            tcp_port=TCP_PORT,
-            http_host=request.host.split(':')[0],
-            http_port=HTTP_PORT
-        )
+    newest = [entry_view(e) for e in received_data.newest()]
+    return render_template_string(
+        html,
+        data=newest,  # Show newest first
+        count=len(newest),
+        tcp_host=TCP_HOST,
+        tcp_port=TCP_PORT,
+        http_host=request.host.split(':')[0],
+        http_port=HTTP_PORT
+    )
 
 @app.route('/api/data', methods=['GET'])
 def get_data():
     """JSON API endpoint for received data"""
-    with data_lock:
-        return jsonify({
-            "count": len(received_data),
-            "data": received_data
-        })
+    metrics.DASHBOARD_POLLS.inc()
+    devices = set(request.args['device'].split(',')) if request.args.get('device') else None
+    data = [entry_view(e) for e in received_data.merged(devices)]
+    bms_latency.delivered(request, devices)
+    if request.args.get('trace') == '1':
+        bms_latency.add_trace(data, device=entry_device)
+    return jsonify({
+        "count": len(data),
+        "data": data
+    })
+
+@app.route('/api/loss', methods=['GET'])
+def get_loss():
+    """Per-device UDP loss from sequence numbers"""
+    return jsonify(udp_loss.stats())
+
+@app.route('/api/latency', methods=['GET'])
+def get_latency():
+    """Per-hop latency (device sample -> receive -> commit -> /api/data poll) by ingest path"""
+    body, status = bms_latency.latency_view(request)
+    return jsonify(body), status
 
 @app.route('/api/update', methods=['POST'])
 def update():
     """HTTP endpoint that works alongside the TCP server"""
+    limited = bms_ratelimit.http_guard(request, '/api/update')   # before the body is read
+    if limited:
+        return limited
     try:
         # Get client info
         client_ip = request.remote_addr
         client_port = request.environ.get('REMOTE_PORT')
         
         # Store the data
-        timestamp = datetime.now().isoformat()
+        ts_ns = time.time_ns()
         
+        t0 = time.perf_counter()
         if request.content_type == 'application/json':
             payload = request.get_json()
             data_type = "json"
         else:
             payload = request.get_data(as_text=True)
             data_type = "raw"
+        t1 = time.perf_counter()
+        metrics.DECODE_SECONDS.observe(t1 - t0, '/api/update')
+        device = bms_records.device_id(payload, client_ip)
+        key = bms_dedup.message_key(payload, device)
+        if dedup.is_duplicate(key):
+            metrics.PACKETS.inc('/api/update', device, 'duplicate')
+            return jsonify({"status": "success", "received": True, "duplicate": True})
         
-        with data_lock:
-            received_data.append({
-                "timestamp": timestamp,
-                "source": f"http:{client_ip}:{client_port}",
-                "type": data_type,
-                "data": payload
-            })
+        store_entries(device, [new_entry(ts_ns, f"http:{client_ip}:{client_port}", data_type, payload)], '/api/update', key)
+        metrics.STORE_SECONDS.observe(time.perf_counter() - t1, '/api/update')
+        metrics.PACKETS.inc('/api/update', device, 'accepted')
         
         print(f"📥 Received HTTP from {client_ip}: {str(payload)[:100]}...")
         return jsonify({"status": "success", "received": True})
     
     except Exception as e:
         print(f"HTTP error: {e}")
+        metrics.PACKETS.inc('/api/update', request.remote_addr, 'error')
         return jsonify({"status": "error", "message": str(e)}), 400
 
 def start_servers():
@@ -176,6 +340,8 @@ def start_servers():
     tcp_thread = threading.Thread(target=tcp_server, daemon=True)
     tcp_thread.start()
     print(f"🚀 TCP server thread started on port {TCP_PORT}")
+    udp_thread = threading.Thread(target=udp_server, daemon=True)
+    udp_thread.start()
     
     # Start HTTP server
     print(f"🌐 HTTP server starting on port {HTTP_PORT}")
@@ -1,12 +1,28 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response
 from datetime import datetime
 import json
 import os
 import threading
+import time
 from werkzeug.serving import make_server
+import bms_metrics as metrics
+import bms_profiling
+import bms_dedup
+import bms_records
+import bms_delta
+import bms_coldstore
+import bms_logindex
+import bms_export
+import bms_config
+import bms_ratelimit
+import bms_capture
 
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
+metrics.instrument_app(app)
+bms_profiling.install_profiler(app)
+bms_capture.install(app)      # BMS_CAPTURE=<file>: raw ingest bodies for replay_traffic.py
+dedup = bms_dedup.DedupCache()
 
 # Configuration
 CONFIG_FILE = 'device_config.json'
@@ -14,8 +30,8 @@ DATA_DIR = 'data'
 os.makedirs(DATA_DIR, exist_ok=True)
 class DeviceConfig:
     def __init__(self):
-        self.lock = threading.Lock()
-        self.config = {
+        # Versioned, atomically written; a flat device_config.json is imported
+        self.store = bms_config.ConfigStore(CONFIG_FILE, defaults={
             "localIP": "192.168.100.57",  # ESP32's new IP
             "gateway": "192.168.100.1",
             "subnet": "255.255.255.0",
@@ -23,35 +39,38 @@ class DeviceConfig:
             "serverPort": 5000,
             "modbusInterval": 500,
             "networkInterval": 2000
-        }
-        self.load_config()
+        })
 
-    def load_config(self):
-        if os.path.exists(CONFIG_FILE):
-            with self.lock:
-                with open(CONFIG_FILE, 'r') as f:
-                    self.config = json.load(f)
+    @property
+    def config(self):
+        return self.store.desired()
 
-    def save_config(self, new_config):
-        with self.lock:
-            self.config.update(new_config)
-            with open(CONFIG_FILE, 'w') as f:
-                json.dump(self.config, f, indent=4)
+    def get_config(self, device=bms_config.DEFAULT_DEVICE):
+        return self.store.desired(device)
+
+    def save_config(self, new_config, device=bms_config.DEFAULT_DEVICE):
+        """Returns the diff; an unchanged config is not rewritten."""
+        return self.store.set_desired(device, new_config)
 
 device_config = DeviceConfig()
 
-def log_data(data_type, data):
-    date_str = datetime.now().strftime('%Y-%m-%d')
+day_log_encoder = bms_delta.DayLogEncoder()
+
+def log_data(data_type, data, device=None):
+    now = datetime.now()
+    date_str = now.strftime('%Y-%m-%d')
     filename = f"{data_type}_{date_str}.jsonl"
     filepath = os.path.join(DATA_DIR, filename)
+    timestamp = now.isoformat()
     
-    entry = {
-        "timestamp": datetime.now().isoformat(),
-        "data": data
-    }
+    if bms_delta.STORAGE_MODE == 'delta':
+        records = bms_records.normalize(data, device, bms_records.to_ns(now))
+        lines = day_log_encoder.lines(filename, timestamp, device, data, records)
+    else:
+        lines = [json.dumps({"timestamp": timestamp, "data": data})]
     
     with open(filepath, 'a') as f:
-        f.write(json.dumps(entry) + '\n')
+        f.write('\n'.join(lines) + '\n')
 
 @app.route('/')
 def dashboard():
@@ -59,41 +78,134 @@ def dashboard():
 
 @app.route('/api/update', methods=['POST'])
 def handle_update():
+    limited = bms_ratelimit.http_guard(request, '/api/update')   # before the body is read
+    if limited:
+        return limited
+    key = None
     try:
+        t0 = time.perf_counter()
         data = request.get_json() if request.is_json else request.get_data(as_text=True)
-        log_data('sensor', data)
+        t1 = time.perf_counter()
+        metrics.DECODE_SECONDS.observe(t1 - t0, '/api/update')
+        device = bms_records.device_id(data, request.remote_addr)
+        key = bms_dedup.message_key(data, device)
+        if dedup.is_duplicate(key):
+            metrics.PACKETS.inc('/api/update', device, 'duplicate')
+            return jsonify({"status": "success", "duplicate": True})
+        log_data('sensor', data, device)
+        metrics.STORE_SECONDS.observe(time.perf_counter() - t1, '/api/update')
+        metrics.PACKETS.inc('/api/update', device, 'accepted')
         return jsonify({"status": "success"})
     except Exception as e:
+        dedup.forget(key)       # not logged: the device's retry must not count as a duplicate
+        metrics.PACKETS.inc('/api/update', request.remote_addr, 'error')
         return jsonify({"status": "error", "message": str(e)}), 400
 
 @app.route('/api/config', methods=['GET', 'POST'])
 def handle_device_config():
+    # ?device= selects a per-device config (default: the shared one)
+    device = request.args.get('device', bms_config.DEFAULT_DEVICE)
     if request.method == 'GET':
-        return jsonify(device_config.config)
+        config = device_config.get_config(device)
+        etag = bms_config.config_hash(config)
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={"ETag": f'"{etag}"'})
+        resp = jsonify(config)
+        resp.set_etag(etag)
+        return resp
     else:
         try:
             new_config = request.get_json()
-            device_config.save_config(new_config)
-            return jsonify({"status": "success"})
+            if request.args.get('source') == 'device':
+                # A device reporting what it runs: answer with only what it still needs
+                device_config.store.record_reported(device, new_config)
+                pending = device_config.store.pending(device)
+                return jsonify({"status": "success", "pending": {k: v for k, (_, v) in pending.items()},
+                                **device_config.store.info(device)})
+            changes = device_config.save_config(new_config, device)
+            return jsonify({"status": "success", "changed": bool(changes), "diff": changes,
+                            **device_config.store.info(device)})
         except Exception as e:
             return jsonify({"status": "error", "message": str(e)}), 400
 
+@app.route('/api/config/history')
+def config_history():
+    since = request.args.get('since', '0')
+    try:
+        since = int(since)
+    except ValueError:
+        return jsonify({"error": f"bad since {since!r}"}), 400
+    return jsonify(device_config.store.changes(request.args.get('device'), since))
+
+def _range_bound(date_str, value):
+    # Accept full ISO timestamps or a bare time of day ("14:30") for the requested day
+    if value and 'T' not in value and len(value) <= 12:
+        return f"{date_str}T{value}"
+    return value
+
 @app.route('/api/logs')
 def get_logs():
     date_str = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
     data_type = request.args.get('type', 'sensor')
     filename = f"{data_type}_{date_str}.jsonl"
     filepath = os.path.join(DATA_DIR, filename)
+    blk_path = bms_coldstore.block_path(DATA_DIR, data_type, date_str)
+    start = _range_bound(date_str, request.args.get('start'))
+    end = _range_bound(date_str, request.args.get('end'))
+    at = _range_bound(date_str, request.args.get('at'))
+    device = request.args.get('device')
+    
+    if os.path.exists(filepath) and os.path.exists(blk_path):
+        # Lines written after the day was compacted: served with its blocks until the next compaction
+        if at:
+            return jsonify(bms_coldstore.day_state_at(blk_path, filepath, at))
+        return jsonify(list(bms_coldstore.read_day(blk_path, filepath, start, end, device)))
     
-    if not os.path.exists(filepath):
-        return jsonify({"error": "Log not found"}), 404
+    if os.path.exists(filepath):
+        # Delta-encoded files are expanded back to full entries transparently
+        if at:
+            return jsonify(bms_delta.state_at(filepath, at))
+        if not device and not bms_logindex.refresh(filepath)["delta"]:
+            # Raw lines sliced straight out of the mapped file, no JSON round-trip
+            chunks = bms_logindex.iter_range(filepath, start, end)
+            if request.args.get('format') == 'ndjson':
+                return Response(chunks, mimetype='application/x-ndjson')
+            return Response(bms_logindex.as_json_array(chunks), mimetype='application/json')
+        entries = bms_delta.read_log(filepath)
+        if start or end or device:
+            entries = (e for e in entries
+                       if (not start or e["timestamp"] >= start) and (not end or e["timestamp"] <= end)
+                       and (not device or not isinstance(e["data"], dict)
+                            or e["data"].get("device") is None or str(e["data"]["device"]) == device))
+        return jsonify(list(entries))
     
-    entries = []
-    with open(filepath, 'r') as f:
-        for line in f:
-            entries.append(json.loads(line))
+    if os.path.exists(blk_path):
+        # Compacted day: only blocks overlapping the range are decompressed
+        if at:
+            return jsonify(bms_coldstore.state_at(blk_path, at))
+        return jsonify(list(bms_coldstore.read_range(blk_path, start, end, device)))
     
-    return jsonify(entries)
+    return jsonify({"error": "Log not found"}), 404
+
+@app.route('/api/export')
+def export_logs():
+    # Streams CSV across days; resume with ?cursor=<cursor column of the last row>
+    today = datetime.now().strftime('%Y-%m-%d')
+    start = request.args.get('start', today)
+    end = request.args.get('end', start[:10])
+    data_type = request.args.get('type', 'sensor')
+    cursor = request.args.get('cursor')
+    try:
+        datetime.fromisoformat(start)
+        datetime.fromisoformat(end)
+        if cursor:
+            bms_export.parse_cursor(cursor)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    chunks = bms_export.export_csv(DATA_DIR, data_type, start, end, request.args.get('device'), cursor)
+    filename = f"{data_type}_{start[:10]}_{end[:10]}.csv"
+    return Response(chunks, mimetype='text/csv',
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
 
 class FlaskServer(threading.Thread):
     def __init__(self):
@@ -109,6 +221,7 @@ class FlaskServer(threading.Thread):
         self.server.shutdown()
 
 if __name__ == '__main__':
+    bms_coldstore.start_compactor(DATA_DIR)
     server = FlaskServer()
     server.start()
     print("Server started on http://0.0.0.0:5000")
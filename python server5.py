@@ -1,16 +1,25 @@
 from flask import Flask, request, render_template_string, jsonify, redirect, flash, url_for
-from datetime import datetime
-import json, os, requests
+import json, os, requests, time
+import bms_keepalive
+import bms_shards
+import bms_records
+import bms_capture
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
+bms_capture.install(app)      # BMS_CAPTURE=<file>: raw ingest bodies for replay_traffic.py
 
-# In‐memory store of all received packets
-received_data = []
+# In‐memory store of received packets: one locked ring buffer per device,
+# HISTORY_MAX entries in total (it used to be an unbounded list)
+HISTORY_MAX = 100_000
+received_data = bms_shards.ShardedStore(max_total=HISTORY_MAX)
 
 # Where your ESP32 lives on the LAN (for sending config back)
 ESP32_IP = "192.168.100.65"
 
+# Close after every ACK unless keep-alive serving is on (BMS_KEEPALIVE=1)
+ACK_HEADERS = {} if bms_keepalive.ENABLED else {"Connection": "close"}
+
 
 # ─── 1) Endpoint for ESP32 to push data ───────────────────────────────────────
 @app.route('/update', methods=['POST'])
@@ -32,19 +41,19 @@ def update():
         else:
             return "No data provided", 400
 
-    # Stamp it and store in our global list
+    # Stamp it (epoch ns, formatted when served) and store in our global list
     entry = {
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "data":      data
+        "ts_ns": time.time_ns(),
+        "data":  data
     }
-    received_data.append(entry)
+    received_data.append(bms_records.device_id(data, request.remote_addr), entry)
 
     # Print to console for debugging
-    print(f"Received data at {entry['timestamp']}:")
+    print(f"Received data at {bms_records.format_ns(entry['ts_ns'])}:")
     print(json.dumps(data, indent=2))
 
-    # Return ACK and close the connection immediately
-    return "ACK", 200, {"Connection": "close"}
+    # Return ACK (and close the connection, unless keep-alive serving is on)
+    return "ACK", 200, ACK_HEADERS
 
 
 # ─── 2) Browser polls this for the full array ─────────────────────────────────
@@ -53,7 +62,7 @@ def get_data():
     """
     Returns the entire list of received_data as JSON.
     """
-    return jsonify(received_data)
+    return jsonify([dict(e, timestamp=bms_records.format_ns(e["ts_ns"])) for e in received_data.merged()])
 
 
 # ─── 3) Dashboard & Config Page ──────────────────────────────────────────────
@@ -159,4 +168,7 @@ def index():
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    if bms_keepalive.ENABLED:
+        bms_keepalive.serve(app, '0.0.0.0', 5000)
+    else:
+        app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,532 @@
+"""
+Replay recorded device traffic against any server module.
+
+Sources (any mix; the kind of each file is detected from its first line):
+
+  * raw captures written with ``BMS_CAPTURE=<file>`` (``bms_capture``):
+    ``/update`` bodies, TCP reads and UDP datagrams, sent back byte for byte;
+  * ``data/<type>_<date>.jsonl`` day files written by ``log_data``
+    (``python server4.py``), full or delta-encoded;
+  * ``journal/<server>_<date>.jsonl`` journals (records of ``bms_server.py``
+    and ``BMS_SERVER2.py``, entries of ``python server2.py``).
+
+Per-slave records are regrouped into one long-shape packet per
+(timestamp, device).  Events are dispatched in recorded order at their
+recorded offsets divided by ``--speed`` (``1``, ``10``, ... or ``max``); each
+device has its own sender thread, so one slow device does not hold up the
+others and the per-device order is kept.  Devices that were told apart by
+their address are sent from their own loopback address (127.0.0.2, ...).
+
+After the replay the server's store is read back (``/data``, ``/api/data``,
+``/api/logs``) and compared, device by device and in order, with what the
+ACKed packets should have produced; dedup is applied the same way the
+servers do.  The exit status is 1 when the store does not match:
+
+    python replay_traffic.py capture.jsonl --server bms_server.py --speed 1
+    python replay_traffic.py data/sensor_2024-06-10.jsonl --server "python server2.py" --speed max
+    python replay_traffic.py journal/*.jsonl --url http://127.0.0.1:5000 --target BMS_SERVER2.py --speed 10
+
+A launched server runs in a scratch directory (so it starts with an empty
+journal) with the ingest rate limiter off unless ``--rate-limit``.
+"""
+import argparse
+import base64
+import http.client
+import json
+import os
+import queue
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import bms_dedup
+import bms_delta
+import bms_records
+from bench_fleet import TARGETS, _ms, git_revision, percentile, wait_for_port
+from bms_records import FIELD_ALIASES, METRICS
+
+# ─── Where each server keeps what it accepted ───────────────────────
+# (read-back path, whether stored items still carry the sender address)
+STORES = {
+    "bms_server.py":     ("/data", True),
+    "BMS_SERVER2.py":    ("/data", True),
+    "python server2.py": ("/api/data", True),
+    "python server4.py": ("/api/logs?date={today}", False),
+    "python server5.py": ("/data", False),
+}
+
+FORM = 'application/x-www-form-urlencoded'
+
+
+class Event:
+    __slots__ = ('t', 'stream', 'peer', 'payload', 'body', 'content_type', 'transport')
+
+    def __init__(self, t, stream, peer, payload, body=None, content_type=None, transport='http'):
+        self.t = t                          # recorded arrival, epoch seconds
+        self.stream = stream                # device (or sender) it belongs to
+        self.peer = peer                    # recorded sender address, if known
+        self.payload = payload              # decoded packet (dict/list), raw text, or None
+        self.body = body                    # recorded bytes (captures only)
+        self.content_type = content_type
+        self.transport = transport
+
+
+# ─────────────────────────────────────────────────────────────────────
+#  Reading recorded traffic
+# ─────────────────────────────────────────────────────────────────────
+def _epoch(item):
+    # Epoch seconds of a logged item: numeric ts_ns, or the text timestamp of older files
+    ts_ns = item.get("ts_ns")
+    return ts_ns / 1e9 if ts_ns is not None else datetime.fromisoformat(item["timestamp"]).timestamp()
+
+
+def decode_body(body, content_type):
+    """What the server would decode from a recorded body (None if nothing)."""
+    if content_type and content_type.startswith(FORM):
+        raw = parse_qs(body.decode('utf-8', 'replace')).get('data', [''])[0]
+        try:
+            return json.loads(raw) if raw else None
+        except ValueError:
+            return None
+    # JSON body or raw TCP/UDP bytes: same rules as server2's decode_payload
+    try:
+        return json.loads(body.decode('utf-8').strip())
+    except (ValueError, UnicodeDecodeError):
+        return body.decode('latin-1').strip()
+
+
+def _event(t, payload, peer, **kw):
+    return Event(t, bms_records.device_id(payload, peer), peer, payload, **kw)
+
+
+def capture_events(lines):
+    for line in lines:
+        c = json.loads(line)
+        body = base64.b64decode(c["body_b64"]) if "body_b64" in c else c["body"].encode('utf-8')
+        yield _event(c["t"], decode_body(body, c.get("content_type")), c.get("peer"), body=body,
+                     content_type=c.get("content_type"), transport=c.get("transport", "http"))
+
+
+def _slave(rec):
+    slave = {"id": rec.get("slave", 0), "status": "connected" if rec.get("connected", True) else "disconnected"}
+    slave.update((FIELD_ALIASES[m][0], rec[m]) for m in METRICS if rec.get(m) is not None)
+    return slave
+
+
+def entry_events(entries):
+    """Events from day-file / journal items; consecutive records of one packet are regrouped."""
+    key = packet = None
+    for item in entries:
+        rec = item.get("data") if "data" in item else item
+        if isinstance(rec, dict) and rec.get("v") and "slave" in rec:
+            k = (_epoch(rec), rec.get("device"))
+            if packet is None or k != key or any(s["id"] == rec["slave"] for s in packet["slaves"]):
+                if packet is not None:
+                    yield _event(key[0], packet, key[1])
+                key, packet = k, {"slaves": []}
+                if key[1] is not None:
+                    packet["device"] = key[1]
+                if rec.get("sample_ns") is not None:
+                    packet["ts"] = rec["sample_ns"]       # the device's own sample time
+            packet["slaves"].append(_slave(rec))
+            continue
+        if packet is not None:
+            yield _event(key[0], packet, key[1])
+            key = packet = None
+        source = item.get("source", "").split(':')          # server2: "tcp:10.0.0.7:51234"
+        yield _event(_epoch(item), item.get("data"), source[1] if len(source) > 1 else None,
+                     transport=source[0] if source[0] in ('tcp', 'udp') else 'http')
+    if packet is not None:
+        yield _event(key[0], packet, key[1])
+
+
+def read_source(path):
+    with open(path) as f:
+        first = next((line for line in f if line.strip()), None)
+    if first is None:
+        return []
+    with open(path) as f:
+        lines = (line for line in f if line.strip())
+        if "transport" in json.loads(first):
+            return list(capture_events(lines))
+        return list(entry_events(bms_delta.expand_lines(lines)))
+
+
+def load_events(paths):
+    events = [e for path in paths for e in read_source(path)]
+    events.sort(key=lambda e: e.t)          # stable: same-instant events keep file order
+    return events
+
+
+# ─────────────────────────────────────────────────────────────────────
+#  Sending
+# ─────────────────────────────────────────────────────────────────────
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.sent = {}
+        self.late = []                      # seconds behind schedule when sent
+        self.acked = []                     # (sequence number, event) of every ACKed send
+
+    def done(self, transport, n, event, late, seconds=None, error=None):
+        with self.lock:
+            self.sent[transport] = self.sent.get(transport, 0) + 1
+            self.late.append(late)
+            if error is not None:
+                errors = self.errors.setdefault(transport, {})
+                errors[error] = errors.get(error, 0) + 1
+                return
+            self.latencies.setdefault(transport, []).append(seconds or 0.0)
+            self.acked.append((n, event))
+
+    def summary(self, elapsed):
+        out = {}
+        for transport, sent in self.sent.items():
+            lat = sorted(self.latencies.get(transport, []))
+            failed = sum(self.errors.get(transport, {}).values())
+            out[transport] = {
+                "sent": sent, "acked": len(lat), "errors": self.errors.get(transport, {}),
+                "error_rate": failed / sent,
+                "throughput_pps": len(lat) / elapsed if elapsed else 0.0,
+                "latency_ms": {"p50": _ms(percentile(lat, 50)), "p95": _ms(percentile(lat, 95)),
+                               "p99": _ms(percentile(lat, 99)), "max": _ms(lat[-1] if lat else None)},
+            }
+        return out
+
+
+def http_request(args, event, source):
+    if event.body is not None and event.content_type and \
+            event.content_type.startswith(FORM if args.encoding == 'form' else 'application/json'):
+        body, content_type = event.body, event.content_type     # byte for byte
+    elif args.encoding == 'form':
+        raw = event.payload if isinstance(event.payload, str) else json.dumps(event.payload)
+        body, content_type = urlencode({"data": raw}), FORM
+    elif isinstance(event.payload, str):
+        body, content_type = event.payload, 'text/plain'
+    else:
+        body, content_type = json.dumps(event.payload), 'application/json'
+    # Same as the firmware: a fresh connection per sample
+    conn = http.client.HTTPConnection(args.host, args.http_port, timeout=args.timeout,
+                                      source_address=(source, 0))
+    try:
+        conn.request("POST", args.path, body=body, headers={"Content-Type": content_type})
+        resp = conn.getresponse()
+        resp.read()
+        return None if 200 <= resp.status < 300 else f"http_{resp.status}"
+    finally:
+        conn.close()
+
+
+def frame(event):
+    if event.body is not None and event.transport in ('tcp', 'udp'):
+        return event.body
+    raw = event.payload if isinstance(event.payload, str) else json.dumps(event.payload)
+    return raw.encode('utf-8')
+
+
+def stream_sender(args, source, inbox, results):
+    """Sends one device's events in order, from its own loopback address."""
+    sock = None
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        n, event, due = item
+        late = max(0.0, time.perf_counter() - due)
+        transport = args.transport if args.transport != 'auto' else event.transport
+        if transport != 'http' and not args.tcp_port:
+            transport = 'http'
+        t0 = time.perf_counter()
+        try:
+            if transport == 'http':
+                error = http_request(args, event, source)
+            elif transport == 'udp':
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+                    udp.bind((source, 0))
+                    udp.sendto(frame(event), (args.host, args.tcp_port))
+                error = None                # fire and forget, like the devices
+            else:
+                if sock is None:
+                    sock = socket.create_connection((args.host, args.tcp_port), timeout=args.timeout,
+                                                    source_address=(source, 0))
+                sock.sendall(frame(event))
+                error = None if sock.recv(64).startswith(b"ACK") else "bad_ack"
+        except socket.timeout:
+            error = "timeout"
+        except (OSError, http.client.HTTPException) as e:
+            error = type(e).__name__
+        if error and sock is not None:
+            sock.close()
+            sock = None
+        results.done(transport, n, event, late, time.perf_counter() - t0, error)
+    if sock is not None:
+        sock.close()
+
+
+def replay(args, events, results):
+    """Dispatch events at their recorded offsets / speed; returns the elapsed seconds."""
+    sources = {}
+    if args.spread:
+        # One loopback address per recorded sender, so address-keyed devices stay apart
+        for e in events:
+            if e.peer is not None and e.peer not in sources and len(sources) < 250:
+                sources[e.peer] = f"127.0.0.{len(sources) + 2}"
+    inboxes, senders = {}, []
+    start = time.perf_counter()
+    t0 = events[0].t if events else 0.0
+    for n, event in enumerate(events):
+        due = start + (event.t - t0) / args.speed if args.speed else time.perf_counter()
+        pause = due - time.perf_counter()
+        if pause > 0:
+            time.sleep(pause)
+        inbox = inboxes.get(event.stream)
+        if inbox is None:
+            inbox = inboxes[event.stream] = queue.Queue()
+            senders.append(threading.Thread(target=stream_sender, daemon=True, args=(
+                args, sources.get(event.peer, '127.0.0.1'), inbox, results)))
+            senders[-1].start()
+        inbox.put((n, event, due))
+    for inbox in inboxes.values():
+        inbox.put(None)
+    for t in senders:
+        t.join()
+    return time.perf_counter() - start, sources
+
+
+# ─────────────────────────────────────────────────────────────────────
+#  Verifying the store
+# ─────────────────────────────────────────────────────────────────────
+def _record_key(rec):
+    get = rec.get if isinstance(rec, dict) else lambda k: getattr(rec, k)
+    return (get("slave"), get("connected")) + tuple(get(m) for m in METRICS)
+
+
+def stored_items(payload, peer):
+    """(device, comparable items) for one packet: one item per slave, or the raw packet."""
+    device = bms_records.device_id(payload, peer)
+    if isinstance(payload, dict):
+        return device, [_record_key(r) for r in bms_records.normalize(payload, device, None)]
+    return device, [("raw", payload if isinstance(payload, str) else json.dumps(payload, sort_keys=True))]
+
+
+def expected_store(results, sources, keep_peer):
+    """Per-device items the ACKed packets should have left in the store, in send order."""
+    dedup = bms_dedup.DedupCache()
+    expected = {}
+    for _, event in sorted(results.acked, key=lambda a: a[0]):
+        source = sources.get(event.peer, '127.0.0.1')
+        key = bms_dedup.message_key(event.payload, bms_records.device_id(event.payload, source))
+        if event.payload is None or dedup.is_duplicate(key, now=event.t):
+            continue
+        device, items = stored_items(event.payload, source if keep_peer else None)
+        expected.setdefault(device, []).extend(items)
+    return expected
+
+
+def fetch_store(args):
+    url = urlparse(args.store_url)
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+    try:
+        conn.request("GET", url.path + (f"?{url.query}" if url.query else ""))
+        resp = conn.getresponse()
+        body = resp.read()
+        if resp.status == 404:
+            return {}
+        if resp.status != 200:
+            raise RuntimeError(f"GET {args.store_url}: HTTP {resp.status}")
+    finally:
+        conn.close()
+    items = json.loads(body)
+    if isinstance(items, dict):
+        items = items.get("data", [])                   # server2: {"count", "data"}
+    store = {}
+    for item in items:
+        ts_ns = _stamp(item)
+        if "v" in item and "slave" in item:             # a record
+            store.setdefault(item.get("device"), []).append((ts_ns, _record_key(item)))
+        elif isinstance(item.get("data"), dict) and item["data"].get("v") and "slave" in item["data"]:
+            rec = item["data"]                          # a delta-expanded day-file record
+            store.setdefault(rec.get("device"), []).append((_stamp(rec) or ts_ns, _record_key(rec)))
+        else:
+            source = item.get("source", "").split(':')
+            device, entry_items = stored_items(item.get("data"), source[1] if len(source) > 1 else None)
+            store.setdefault(device, []).extend((ts_ns, key) for key in entry_items)
+    return store
+
+
+def _stamp(item):
+    # Arrival time (epoch ns) of a stored item, or None if it carries none
+    if item.get("ts_ns") is not None:
+        return item["ts_ns"]
+    try:
+        return round(_epoch(item) * 1e9)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def verify(expected, before, after, limit=10):
+    """Compare each device's new store items with what was expected, in order.
+
+    "New" is anything that arrived after the device's newest item in ``before``:
+    a ring buffer that wrapped during the replay has dropped old items from
+    the front, so counting from the old length would misalign the two.
+    """
+    report = {"devices": len(expected), "expected": 0, "stored": 0, "matched": 0, "mismatched_devices": []}
+    for device in sorted(set(expected) | set(after), key=str):
+        want = expected.get(device, [])
+        mark = max((ts for ts, _ in before.get(device, []) if ts is not None), default=None)
+        got = [key for ts, key in after.get(device, []) if mark is None or ts is None or ts > mark]
+        report["expected"] += len(want)
+        report["stored"] += len(got)
+        same = next((i for i, (w, g) in enumerate(zip(want, got)) if w != g), min(len(want), len(got)))
+        report["matched"] += same
+        if want != got and len(report["mismatched_devices"]) < limit:
+            report["mismatched_devices"].append({
+                "device": device, "expected": len(want), "stored": len(got), "first_difference": same,
+                "expected_item": list(want[same]) if same < len(want) else None,
+                "stored_item": list(got[same]) if same < len(got) else None,
+            })
+    report["ok"] = report["expected"] == report["stored"] == report["matched"]
+    return report
+
+
+# ─────────────────────────────────────────────────────────────────────
+#  Main
+# ─────────────────────────────────────────────────────────────────────
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Replay recorded device traffic against a server module")
+    p.add_argument('files', nargs='+', help="captures, data/*.jsonl day files or journal/*.jsonl")
+    p.add_argument('--server', help="server module to launch, e.g. 'bms_server.py' or 'python server2.py'")
+    p.add_argument('--url', help="replay against an already running server instead")
+    p.add_argument('--target', help="which module is running at --url (picks route and store)")
+    p.add_argument('--speed', default='1', help="1 = recorded pace, N = N times faster, max = no waits")
+    p.add_argument('--transport', choices=('auto', 'http', 'tcp', 'udp'), default='auto',
+                   help="auto = as recorded, where the target has a TCP/UDP listener")
+    p.add_argument('--encoding', choices=('form', 'json'))
+    p.add_argument('--no-spread', dest='spread', action='store_false',
+                   help="send everything from 127.0.0.1 instead of one loopback address per sender")
+    p.add_argument('--no-verify', dest='verify', action='store_false')
+    p.add_argument('--rate-limit', action='store_true', help="turn the launched server's rate limiter on")
+    p.add_argument('--timeout', type=float, default=5.0)
+    p.add_argument('--out', default='replay_results.json')
+    args = p.parse_args(argv)
+    if not args.server and not args.url:
+        p.error("one of --server or --url is required")
+
+    args.target = os.path.basename(args.target or args.server or '')
+    http_port, path, encoding, tcp_port = TARGETS.get(args.target, (5000, "/update", "form", None))
+    url = urlparse(args.url or f"http://127.0.0.1:{http_port}")
+    args.host, args.http_port = url.hostname, url.port or http_port
+    args.spread = args.spread and args.host.startswith('127.')     # only loopback has spare addresses
+    args.path, args.tcp_port = path, tcp_port
+    args.encoding = args.encoding or encoding
+    args.speed = 0.0 if args.speed == 'max' else float(args.speed)
+    store_path, args.keep_peer = STORES.get(args.target, (None, False))
+    args.store_url = store_path and f"http://{args.host}:{args.http_port}" + \
+        store_path.format(today=datetime.now().strftime('%Y-%m-%d'))
+    return args
+
+
+def start_server(args):
+    """Launch ``args.server`` in a scratch directory; returns (process, directory)."""
+    script = os.path.abspath(args.server)
+    workdir = tempfile.mkdtemp(prefix='replay-')
+    env = dict(os.environ)
+    env.pop('BMS_CAPTURE', None)            # don't record the replay itself
+    env['BMS_RATE_LIMIT'] = '1' if args.rate_limit else '0'
+    # Own session so the Flask reloader child is torn down with it
+    proc = subprocess.Popen([sys.executable, script], cwd=workdir, stdin=subprocess.PIPE,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True, env=env)
+    print(f"🚀 Started {args.server} (pid {proc.pid}) in {workdir}")
+    if not wait_for_port(args.host, args.http_port, 15) or \
+            (args.tcp_port and not wait_for_port(args.host, args.tcp_port, 15)):
+        os.killpg(proc.pid, signal.SIGKILL)
+        sys.exit(f"❌ {args.server} never opened its ports")
+    return proc, workdir
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    events = load_events(args.files)
+    if not events:
+        sys.exit("❌ No traffic found in " + ", ".join(args.files))
+    span = events[-1].t - events[0].t
+    streams = len({e.stream for e in events})
+    print(f"📼 {len(events)} packets from {streams} devices over {span:.1f}s, "
+          f"replaying at {'max speed' if not args.speed else f'{args.speed:g}x'}")
+
+    proc = workdir = None
+    if args.server and not args.url:
+        proc, workdir = start_server(args)
+    verifying = args.verify and args.store_url
+    started_at = datetime.now().isoformat()
+    try:
+        before = fetch_store(args) if verifying else {}
+        results = Results()
+        elapsed, sources = replay(args, events, results)
+        after = fetch_store(args) if verifying else None
+    finally:
+        if proc is not None:
+            os.killpg(proc.pid, signal.SIGTERM)
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                os.killpg(proc.pid, signal.SIGKILL)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    late = sorted(results.late)
+    report = {
+        "started_at": started_at,
+        "revision": git_revision(),
+        "config": {k: v for k, v in vars(args).items()},
+        "packets": len(events),
+        "devices": streams,
+        "recorded_span_s": round(span, 3),
+        "elapsed_s": round(elapsed, 3),
+        "effective_speed": round(span / elapsed, 2) if elapsed else None,
+        "behind_schedule_ms": {"p50": _ms(percentile(late, 50)), "p99": _ms(percentile(late, 99)),
+                               "max": _ms(late[-1] if late else None)},
+        "summary": results.summary(elapsed),
+    }
+    if verifying:
+        report["verify"] = verify(expected_store(results, sources, args.keep_peer), before, after)
+    out_dir = os.path.dirname(args.out)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for transport, s in report["summary"].items():
+        lat = s["latency_ms"]
+        print(f"📊 {transport.upper()}: {s['acked']}/{s['sent']} acked, {s['throughput_pps']:.1f} pkt/s, "
+              f"p50={lat['p50']}ms p99={lat['p99']}ms, error rate {s['error_rate']:.2%}")
+    print(f"⏱️ {elapsed:.2f}s for {span:.2f}s of traffic ({report['effective_speed']}x), "
+          f"p99 {report['behind_schedule_ms']['p99']} ms behind schedule")
+    print(f"💾 Results written to {args.out}")
+    if not verifying:
+        print("ℹ️ Store not verified" + ("" if args.verify else " (--no-verify)")
+              + ("" if args.store_url else f": no read-back for {args.target or 'this server'}"))
+        return
+    v = report["verify"]
+    if v["ok"]:
+        print(f"✅ Store matches: {v['matched']} items across {v['devices']} devices")
+    else:
+        print(f"❌ Store mismatch: {v['matched']}/{v['expected']} expected items matched, {v['stored']} stored")
+        for m in v["mismatched_devices"]:
+            print(f"   {m['device']}: expected {m['expected']}, stored {m['stored']}, "
+                  f"first difference at #{m['first_difference']}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()